@@ -0,0 +1,148 @@
+from collections import defaultdict
+from contact_index import ContactIndex, contact_weights
+from keyword_extractor import KeywordExtractor
+from mail_service import header_fields, all_fields
+from time_buckets import TimestampColumn, count_by_bucket, weekday_hour_heatmap
+
+
+class Aggregator:
+    # folders the aggregator consumes ('sent', 'recieved') and the fields it reads from each message
+    folders = ('sent',)
+    fields = header_fields
+
+    def add(self, folder, message):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    def partial_result(self):
+        # aggregates of the messages added so far, while the analysis is still running
+        return self.result()
+
+    def close(self):
+        # called instead of result() when the analysis is cancelled or fails
+        pass
+
+
+class TimeCountAggregator(Aggregator):
+    def __init__(self, period_start, period_end, bucket, tz=None):
+        self.__period = (period_start, period_end)
+        self.__bucket = bucket
+        self.__tz = tz
+        self.__timestamps = TimestampColumn()
+
+    def add(self, folder, message):
+        self.__timestamps.append(message.timestamp)
+
+    def result(self):
+        return count_by_bucket(self.__timestamps.to_numpy(), *self.__period, self.__bucket, self.__tz)
+
+
+class HeatmapAggregator(Aggregator):
+    def __init__(self, tz=None):
+        self.__tz = tz
+        self.__timestamps = TimestampColumn()
+
+    def add(self, folder, message):
+        self.__timestamps.append(message.timestamp)
+
+    def result(self):
+        return weekday_hour_heatmap(self.__timestamps.to_numpy(), self.__tz)
+
+
+class DomainCountAggregator(Aggregator):
+    def __init__(self):
+        # counts by domain id of the messages' address book, shared by the messages of a MailTool;
+        # names are looked up once for the result
+        self.__domain_dict = defaultdict(int)
+        self.__address_book = None
+
+    def add(self, folder, message):
+        address_book = self.__address_book = message.address_book
+        address_ids = message.reciever_ids + (message.bcc_ids or ()) + (message.cc_ids or ())
+        for address_id in address_ids:
+            domain_id = address_book.domain_id(address_id)
+            if domain_id is not None:
+                self.__domain_dict[domain_id] += 1
+
+    def result(self):
+        if self.__address_book is None:
+            return {}
+        domains = {self.__address_book.domains[domain_id]: count for domain_id, count in self.__domain_dict.items()}
+        return sort_dictionary_by_value(domains)
+
+
+class KeywordAggregator(Aggregator):
+    fields = all_fields
+
+    def __init__(self, **options):
+        # options are passed on to KeywordExtractor, config.keyword_* are the defaults
+        self.__extractor = KeywordExtractor(**options)
+
+    def add(self, folder, message):
+        text_body = message.body
+        subject = message.subject
+        text_to_process = None
+        if text_body and subject:
+            text_to_process = text_body + " " + subject
+        elif text_body:
+            text_to_process = text_body
+        else:
+            text_to_process = subject
+
+        if text_to_process:
+            self.__extractor.add_text(text_to_process)
+
+    def result(self):
+        result = self.__extractor.result()
+        if self.error:
+            print(f"Keyword counts are approximate, each may be up to {self.error} below the true count")
+        return result
+
+    @property
+    def error(self):
+        return self.__extractor.error
+
+    def partial_result(self):
+        return self.__extractor.partial_result()
+
+    def close(self):
+        self.__extractor.close()
+
+
+class ContactWeightsAggregator(Aggregator):
+    folders = ('sent', 'recieved')
+
+    def __init__(self, email):
+        self.__email = email
+        self.index = ContactIndex()
+
+    def add(self, folder, message):
+        self.index.add_message(folder, message, self.__email)
+
+    def result(self):
+        return contact_weights(self.index)
+
+
+def create_aggregator(report, period_start, period_end, email):
+    if report == 'hourly':
+        return TimeCountAggregator(period_start, period_end, 'hour')
+    if report == 'daily':
+        return TimeCountAggregator(period_start, period_end, 'day')
+    if report == 'monthly':
+        return TimeCountAggregator(period_start, period_end, 'month')
+    if report == 'heatmap':
+        return HeatmapAggregator()
+    if report == 'domains':
+        return DomainCountAggregator()
+    if report == 'keywords':
+        return KeywordAggregator()
+    if report == 'contacts':
+        return ContactWeightsAggregator(email)
+    raise ValueError(f"Unknown report {report}")
+
+
+def sort_dictionary_by_value(dict):
+    sorted_ = {key: value for key, value in sorted(dict.items(), key=lambda item: item[1], reverse=True)}
+    return sorted_
@@ -0,0 +1,146 @@
+import threading
+import time
+from instrumentation import Metrics
+from mail_service import header_fields, all_fields, needs_body
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+class Progress:
+    # shared by the analyses of a MailTool: counts the messages of the current stage, calls
+    # callback(progress) at most every interval seconds and makes the running analysis raise
+    # AnalysisCancelled once cancel() is called, from any thread
+    def __init__(self, callback=None, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+        self.source = None
+        self.__cancelled = threading.Event()
+        self.reset()
+
+    def reset(self):
+        self.__cancelled.clear()
+        self.stage = None
+        self.done = 0
+        self.total = None
+        self.partial = None
+        self.__bytes_before = self.source.bytes_fetched if self.source else 0
+        self.__stage_started = time.monotonic()
+        self.__reported = 0
+
+    def cancel(self):
+        self.__cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self.__cancelled.is_set()
+
+    @property
+    def bytes_fetched(self):
+        return self.source.bytes_fetched - self.__bytes_before if self.source else 0
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.__stage_started
+        return self.done / elapsed if elapsed > 0 else 0
+
+    @property
+    def eta(self):
+        # seconds until the stage is done, None while the total or the rate is unknown
+        if self.total is None or self.rate == 0:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+    def start_stage(self, stage, total=None):
+        self.check()
+        self.stage = stage
+        self.done = 0
+        self.total = total
+        self.__stage_started = time.monotonic()
+        self.__report()
+
+    def advance(self, count=1, partial=None):
+        # partial is a function returning the aggregates so far, only called when a report is due
+        self.check()
+        self.done += count
+        if self.callback and time.monotonic() - self.__reported >= self.interval:
+            if partial:
+                self.partial = partial()
+            self.__report()
+
+    def check(self):
+        if self.__cancelled.is_set():
+            raise AnalysisCancelled()
+
+    def __report(self):
+        self.__reported = time.monotonic()
+        if self.callback:
+            self.callback(self)
+
+
+class AnalysisEngine:
+    def __init__(self, iter_messages, progress=None, metrics=None):
+        # iter_messages(folder, period_start, period_end, fields, filters) yields message records
+        self.__iter_messages = iter_messages
+        self.progress = progress or Progress()
+        self.metrics = metrics or Metrics()
+
+    def run(self, period_start, period_end, aggregators, filters=None):
+        # every folder is opened before any is consumed, so sources that prefetch can download them in parallel
+        streams = []
+        try:
+            for folder in self.__get_folders(aggregators.values()):
+                consumers = [(name, aggregator) for name, aggregator in aggregators.items() if folder in aggregator.folders]
+                fields = self.__merge_fields([aggregator for name, aggregator in consumers])
+                streams.append((folder, consumers, self.__iter_messages(folder, period_start, period_end, fields, filters)))
+            partial = lambda: {name: aggregator.partial_result() for name, aggregator in aggregators.items()}
+            for folder, consumers, messages in streams:
+                self.progress.start_stage(folder, getattr(messages, 'total', None))
+                self.__consume(folder, consumers, messages, partial)
+        except BaseException:
+            for aggregator in aggregators.values():
+                aggregator.close()
+            raise
+        finally:
+            # a cancelled or failed analysis stops the downloads still running
+            for folder, consumers, messages in streams:
+                if hasattr(messages, 'close'):
+                    messages.close()
+        results = {}
+        for name, aggregator in aggregators.items():
+            with self.metrics.stage(f"result {name}"):
+                results[name] = aggregator.result()
+        return results
+
+    def __consume(self, folder, consumers, messages, partial):
+        # the time of every aggregator is kept apart from the time spent waiting for the messages,
+        # which is the download, the parsing or the cache read the source did not do ahead
+        seconds = [0.0] * len(consumers)
+        count = 0
+        started = time.perf_counter()
+        try:
+            for message in messages:
+                for i, (name, aggregator) in enumerate(consumers):
+                    aggregator_started = time.perf_counter()
+                    aggregator.add(folder, message)
+                    seconds[i] += time.perf_counter() - aggregator_started
+                count += 1
+                self.progress.advance(partial=partial)
+        finally:
+            for (name, aggregator), aggregator_seconds in zip(consumers, seconds):
+                self.metrics.add(f"aggregate {name}", aggregator_seconds, count)
+            self.metrics.add(f"stream {folder}", time.perf_counter() - started - sum(seconds), count)
+
+    def __get_folders(self, aggregators):
+        folders = []
+        for aggregator in aggregators:
+            for folder in aggregator.folders:
+                if folder not in folders:
+                    folders.append(folder)
+        return folders
+
+    def __merge_fields(self, aggregators):
+        if any(needs_body(aggregator.fields) for aggregator in aggregators):
+            return all_fields
+        return header_fields
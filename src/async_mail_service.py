@@ -0,0 +1,500 @@
+import asyncio
+import contextlib
+import imaplib
+import itertools
+import math
+import re
+import ssl
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import config
+from instrumentation import Metrics
+from message_record import AddressBook
+from imap_response import iter_fetch_items, find_item
+from mail_service import (MessageStream, needs_body, header_data_items, parse_headers, text_part_fetches,
+                          decode_text_parts, to_message_set)
+from connection_pool import PrefetchingIterator
+from search_query import search_criteria, quote
+
+literal_pattern = re.compile(rb'\{(\d+)\}$')
+untagged_pattern = re.compile(rb'\* (?:\d+ )?([A-Za-z-]+)')
+uidvalidity_pattern = re.compile(rb'\[UIDVALIDITY (\d+)\]')
+# longest line read at once, e.g. the UIDs of a large SEARCH
+line_limit = 2 ** 24
+
+
+class PipelineAbort(imaplib.IMAP4.abort):
+    # a command the server never ran: queued behind the one the connection was lost on, or not sent at all
+    pass
+
+
+class ImapCommand:
+    # a command sent and not answered yet; servers answer pipelined commands in order, so the untagged
+    # responses arriving before its tagged one are its own. FETCH responses are parsed as they arrive
+    __slots__ = ('tag', 'done', 'responses', 'items', 'bytes', 'parse_seconds')
+
+    def __init__(self, tag, done):
+        self.tag = tag
+        self.done = done
+        self.responses = []
+        self.items = []
+        self.bytes = 0
+        self.parse_seconds = 0.0
+
+
+class AsyncMailService:
+    # the interface of MailService as coroutines. Commands are sent without waiting for the ones before
+    # to be answered, up to config.pipeline_depth at a time; a task reads the responses off the socket
+    # and hands them to their command, and messages are parsed in executor (the loop's default one
+    # when None) while the next responses arrive
+    def __init__(self, executor=None):
+        self.executor = executor
+        self.capabilities = ()
+        self.bytes_fetched = 0
+        # problems of the messages parsed, see message_parser
+        self.parse_stats = Counter()
+        # per-stage timings and the addresses of the messages, replaced by those of the MailTool using the service
+        self.metrics = Metrics()
+        self.address_book = AddressBook()
+        self.__reader = None
+        self.__writer = None
+        self.__reading = None
+        self.__pending = OrderedDict()
+        self.__tags = itertools.count(1)
+        self.__continuation = None
+        self.__write_lock = None
+        self.__in_flight = None
+        self.__mailbox_changed = None
+        self.__mailbox_users = 0
+        self.__selected_mailbox = None
+        self.__uidvalidity = None
+
+    @property
+    def connected(self):
+        return self.__reading is not None and not self.__reading.done()
+
+    @property
+    def selected_mailbox(self):
+        return self.__selected_mailbox
+
+    async def connect(self, server=None, port=None, use_ssl=None):
+        server = server or config.mail_server
+        port = port or config.mail_port
+        use_ssl = config.mail_use_ssl if use_ssl is None else use_ssl
+        if self.__write_lock is None:
+            self.__write_lock = asyncio.Lock()
+            self.__in_flight = asyncio.Semaphore(config.pipeline_depth)
+            self.__mailbox_changed = asyncio.Condition()
+        with self.metrics.stage('connect'):
+            context = ssl.create_default_context() if use_ssl else None
+            self.__reader, self.__writer = await asyncio.open_connection(server, port, ssl=context, limit=line_limit)
+            greeting = await self.__reader.readline()
+            if not greeting.startswith((b'* OK', b'* PREAUTH')):
+                self.__writer.close()
+                raise imaplib.IMAP4.error(f"Unexpected greeting {greeting!r}")
+            self.__selected_mailbox = None
+            self.__uidvalidity = None
+            self.__reading = asyncio.create_task(self.__read_responses())
+            command = await self.__command('CAPABILITY')
+        self.capabilities = tuple(capability for kind, parts in command.responses if kind == 'CAPABILITY'
+                                  for capability in parts[-1].decode('ascii', 'replace').upper().split()[2:])
+
+    async def authenticate(self, username, password):
+        with self.metrics.stage('login'):
+            await self.__command('LOGIN', f"{quote(username)} {quote(password)}")
+
+    async def list_folders(self):
+        command = await self.__command('LIST', '"" *')
+        return [parts[-1][len(b'* LIST '):].decode('utf8') for kind, parts in command.responses if kind == 'LIST']
+
+    async def select_mailbox(self, mailbox):
+        with self.metrics.stage('select'):
+            command = await self.__command('EXAMINE', quote(mailbox))
+        self.__selected_mailbox = mailbox
+        self.__uidvalidity = None
+        for kind, parts in command.responses:
+            match = uidvalidity_pattern.search(parts[-1])
+            if match:
+                self.__uidvalidity = int(match.group(1))
+
+    @contextlib.asynccontextmanager
+    async def use_mailbox(self, mailbox):
+        # commands in a mailbox are pipelined; another one is selected once they are all answered
+        async with self.__mailbox_changed:
+            while self.__selected_mailbox != mailbox and self.__mailbox_users:
+                await self.__mailbox_changed.wait()
+            if self.__selected_mailbox != mailbox:
+                await self.select_mailbox(mailbox)
+            self.__mailbox_users += 1
+        try:
+            yield self
+        finally:
+            async with self.__mailbox_changed:
+                self.__mailbox_users -= 1
+                self.__mailbox_changed.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def reconnecting(self):
+        # waits until every command on the lost connection has failed and keeps use_mailbox waiting
+        # until the connection is open again, so no command goes out before the login or the select
+        async with self.__mailbox_changed:
+            while self.__mailbox_users:
+                await self.__mailbox_changed.wait()
+            yield self
+
+    async def close_mailbox(self):
+        await self.__command('CLOSE')
+        self.__selected_mailbox = None
+
+    async def logout(self):
+        try:
+            await self.__command('LOGOUT')
+        finally:
+            self.__close()
+
+    async def get_uidvalidity(self):
+        if self.__uidvalidity is not None:
+            return self.__uidvalidity
+        command = await self.__command('STATUS', f"{quote(self.__selected_mailbox)} (UIDVALIDITY)")
+        return int(re.search(rb'UIDVALIDITY (\d+)', command.responses[0][1][-1]).group(1))
+
+    async def search_uids_since(self, last_uid):
+        command = await self.__search(f'UID {last_uid + 1}:*', None, by_uid=True)
+        # "n:*" always matches the highest UID, even when it is below n
+        return [uid for uid in search_results(command) if uid > last_uid]
+
+    async def search_uids(self, period_start=None, period_end=None, filters=None):
+        # filters are evaluated by the server, see search_query
+        criteria, literal = search_criteria(period_start, period_end, filters)
+        return search_results(await self.__search(criteria, literal, by_uid=True))
+
+    async def count_messages(self, period_start, period_end, filters=None):
+        # see MailService.count_messages
+        criteria, literal = search_criteria(period_start, period_end, filters, sent_date=True)
+        if literal is None and 'ESEARCH' in self.capabilities:
+            command = await self.__search(f'RETURN (COUNT) {criteria}', None)
+            data = next(parts[-1] for kind, parts in command.responses if kind == 'ESEARCH')
+            return int(re.search(rb'COUNT (\d+)', data).group(1))
+        return len(search_results(await self.__search(criteria, literal)))
+
+    async def get_message_info_for_period(self, period_start, period_end, batch_size=None, fields=None):
+        message_ids = await self.__search_period(period_start, period_end)
+        return [info async for info in self.__iter_message_info(message_ids, batch_size, fields)]
+
+    def iter_message_info_for_period(self, period_start, period_end, batch_size=None, fields=None):
+        return self.__iter_message_info_for_period(period_start, period_end, batch_size, fields)
+
+    async def get_message_info_for_uids(self, uids, batch_size=None, fields=None):
+        return [info async for info in self.__iter_message_info(uids, batch_size, fields, by_uid=True)]
+
+    def iter_message_info_for_uids(self, uids, batch_size=None, fields=None):
+        return self.__iter_message_info(uids, batch_size, fields, by_uid=True)
+
+    async def fetch_message_info(self, message_ids, fields=None, by_uid=True):
+        # one batch: its headers, then its text parts; both are parsed in the executor
+        with_body = needs_body(fields)
+        fetched = await self.__fetch(message_ids, header_data_items(with_body), by_uid)
+        # a Counter of its own, the executor's threads would race on parse_stats
+        stats = Counter()
+        with self.metrics.stage('parse headers', len(fetched)):
+            records, text_parts = await self.__in_executor(parse_headers, fetched, with_body, stats, self.address_book)
+        if text_parts:
+            fetches = text_part_fetches(text_parts)
+            responses = await asyncio.gather(*(self.__fetch(uids, data_items, True)
+                                               for uids, data_items, section_item in fetches))
+            texts = {}
+            for (uids, data_items, section_item), fetched in zip(fetches, responses):
+                for items in fetched:
+                    texts[int(items['UID'])] = find_item(items, section_item)
+            with self.metrics.stage('parse bodies', len(text_parts)):
+                await self.__in_executor(decode_text_parts, records, text_parts, texts, stats)
+        self.parse_stats.update(stats)
+        return records
+
+    async def __iter_message_info_for_period(self, period_start, period_end, batch_size, fields):
+        message_ids = await self.__search_period(period_start, period_end)
+        async for info in self.__iter_message_info(message_ids, batch_size, fields):
+            yield info
+
+    async def __iter_message_info(self, message_ids, batch_size, fields, by_uid=False):
+        # the records in order while the next config.pipeline_depth batches are on their way
+        batch_size = batch_size or config.fetch_batch_size
+        batches = deque(message_ids[i:i + batch_size] for i in range(0, len(message_ids), batch_size))
+        fetching = deque()
+        try:
+            while batches or fetching:
+                while batches and len(fetching) < config.pipeline_depth:
+                    fetching.append(asyncio.ensure_future(self.fetch_message_info(batches.popleft(), fields, by_uid)))
+                for info in await fetching.popleft():
+                    yield info
+        finally:
+            for task in fetching:
+                task.cancel()
+
+    async def __fetch(self, message_ids, data_items, by_uid):
+        with self.metrics.stage('fetch', len(message_ids)) as timing:
+            command = await self.__command('UID FETCH' if by_uid else 'FETCH',
+                                           f"{to_message_set(message_ids)} {data_items}")
+            timing.bytes = command.bytes
+        self.bytes_fetched += command.bytes
+        # parsed by the reader while the response arrived; unsolicited FETCH responses have no UID
+        self.metrics.add('parse response', command.parse_seconds, len(message_ids))
+        return [items for items in command.items if 'UID' in items]
+
+    async def __search(self, criteria, literal, by_uid=False):
+        if literal is not None:
+            criteria = f"CHARSET UTF-8 {criteria}"
+        with self.metrics.stage('search') as timing:
+            command = await self.__command('UID SEARCH' if by_uid else 'SEARCH', criteria, literal)
+            timing.bytes = command.bytes
+        self.bytes_fetched += command.bytes
+        return command
+
+    async def __search_period(self, period_start, period_end):
+        criteria, literal = search_criteria(period_start, period_end)
+        return search_results(await self.__search(criteria, literal))
+
+    async def __in_executor(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def __command(self, name, arguments=None, literal=None):
+        # sends the command as soon as fewer than config.pipeline_depth are in flight and waits for its answer
+        loop = asyncio.get_running_loop()
+        async with self.__in_flight:
+            command = ImapCommand(f"A{next(self.__tags)}", loop.create_future())
+            line = f"{command.tag} {name} {arguments}" if arguments else f"{command.tag} {name}"
+            try:
+                async with self.__write_lock:
+                    if not self.connected:
+                        raise PipelineAbort(f"{name}: not connected")
+                    self.__pending[command.tag] = command
+                    if literal is None:
+                        self.__writer.write(line.encode() + b'\r\n')
+                    else:
+                        # the literal is sent once the server asks for it, no other command can come in between
+                        self.__continuation = loop.create_future()
+                        self.__writer.write(f"{line} {{{len(literal)}}}\r\n".encode())
+                        await self.__writer.drain()
+                        await self.__continuation
+                        self.__writer.write(literal + b'\r\n')
+                    await self.__writer.drain()
+                status, text = await command.done
+            except OSError as error:
+                raise PipelineAbort(f"{name}: connection lost ({error!r})")
+            finally:
+                # answers to a command nobody waits for any more are dropped
+                command.done.cancel()
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"{name} failed: {status} {text}")
+        return command
+
+    async def __read_responses(self):
+        error = imaplib.IMAP4.abort("connection closed")
+        try:
+            while True:
+                parts, num_bytes = await self.__read_response()
+                self.__dispatch(parts, num_bytes)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as read_error:
+            error = imaplib.IMAP4.abort(f"connection lost ({read_error!r})")
+        except imaplib.IMAP4.abort as read_error:
+            error = read_error
+        finally:
+            # every command still waiting fails, the pool opens a new connection for them
+            for position, command in enumerate(self.__pending.values()):
+                if not command.done.done():
+                    command.done.set_exception(error if position == 0 else PipelineAbort(str(error)))
+            self.__pending.clear()
+            if self.__continuation is not None and not self.__continuation.done():
+                self.__continuation.set_exception(error)
+            self.__writer.close()
+
+    async def __read_response(self):
+        # one response in the shape imaplib gives it: bytes, or (bytes ending in {n}, literal) tuples
+        # followed by the bytes after the last literal
+        parts = []
+        num_bytes = 0
+        while True:
+            line = await self.__reader.readline()
+            if not line.endswith(b'\n'):
+                raise imaplib.IMAP4.abort("connection closed")
+            num_bytes += len(line)
+            line = line.rstrip(b'\r\n')
+            match = literal_pattern.search(line)
+            if not match:
+                parts.append(line)
+                return parts, num_bytes
+            literal = await self.__reader.readexactly(int(match.group(1)))
+            num_bytes += len(literal)
+            parts.append((line, literal))
+
+    def __dispatch(self, parts, num_bytes):
+        first = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+        if first.startswith(b'+'):
+            if self.__continuation is not None and not self.__continuation.done():
+                self.__continuation.set_result(first)
+            return
+        if first.startswith(b'* '):
+            # unsolicited responses while nothing is pending, e.g. BYE after LOGOUT, are dropped
+            command = next(iter(self.__pending.values()), None)
+            if command is None:
+                return
+            command.bytes += num_bytes
+            match = untagged_pattern.match(first)
+            kind = match.group(1).decode('ascii').upper() if match else ''
+            if kind == 'FETCH':
+                started = time.perf_counter()
+                command.items.extend(iter_fetch_items(parts))
+                command.parse_seconds += time.perf_counter() - started
+            else:
+                command.responses.append((kind, parts))
+            return
+        tag, _, rest = first.partition(b' ')
+        command = self.__pending.pop(tag.decode('ascii', 'replace'), None)
+        if command is None or command.done.done():
+            return
+        status, _, text = rest.partition(b' ')
+        command.done.set_result((status.decode('ascii', 'replace').upper(), text.decode('utf-8', 'replace')))
+
+    def __close(self):
+        if self.__reading is not None:
+            self.__reading.cancel()
+        if self.__writer is not None:
+            self.__writer.close()
+
+
+class AsyncMailServicePool:
+    # the interface of MailServicePool over AsyncMailService sessions; an event loop in a thread of its
+    # own runs their commands and MIME parsing goes to config.parse_workers threads. A folder is fetched
+    # in batches spread over the sessions and pipelined on each, so one connection keeps busy where
+    # the blocking pool needs several to hide the round trips
+    def __init__(self, size=None):
+        self.size = size or config.connections
+        self.__server = None
+        self.__credentials = None
+        self.__services = []
+        self.__busy = Counter()
+        self.__loop = None
+        self.__thread = None
+        self.__executor = None
+        # shared with every session, so their stages add up in one place and their messages share addresses
+        self.metrics = Metrics()
+        self.address_book = AddressBook()
+
+    @property
+    def bytes_fetched(self):
+        return sum(service.bytes_fetched for service in self.__services)
+
+    @property
+    def parse_stats(self):
+        return sum((service.parse_stats for service in self.__services), Counter())
+
+    def connect(self, server=None, port=None, use_ssl=None):
+        self.__server = (server, port, use_ssl)
+
+    def authenticate(self, username, password):
+        self.__credentials = (username, password)
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, daemon=True)
+        self.__thread.start()
+        self.__executor = ThreadPoolExecutor(config.parse_workers)
+        self.__services = [AsyncMailService(self.__executor) for i in range(self.size)]
+        for service in self.__services:
+            service.metrics = self.metrics
+            service.address_book = self.address_book
+        self.__call(self.__open_sessions())
+
+    def logout(self):
+        self.__call(self.__close_sessions())
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
+        self.__executor.shutdown()
+
+    def get_uidvalidity(self, folder):
+        return self.__call(self.__run(folder, lambda service: service.get_uidvalidity()))
+
+    def search_uids_since(self, folder, last_uid):
+        return self.__call(self.__run(folder, lambda service: service.search_uids_since(last_uid)))
+
+    def search_uids(self, folder, period_start=None, period_end=None, filters=None):
+        return self.__call(self.__run(folder, lambda service: service.search_uids(period_start, period_end, filters)))
+
+    def count_messages(self, folder, periods, filters=None):
+        # every SEARCH is sent at once, spread over the sessions
+        return self.__call(self.__count_messages(folder, periods, filters))
+
+    def iter_message_info_for_period(self, folder, period_start, period_end, fields=None):
+        uids = self.search_uids(folder, period_start, period_end)
+        return self.iter_message_info_for_uids(folder, uids, fields)
+
+    def iter_message_info_for_uids(self, folder, uids, fields=None):
+        return MessageStream(self.iter_uid_batches(folder, uids, fields), len(uids))
+
+    def iter_uid_batches(self, folder, uids, fields=None):
+        # batches come back in UID order; enough are in flight to fill every session's pipeline
+        in_flight = self.size * config.pipeline_depth
+        batch_size = max(1, min(config.fetch_batch_size, math.ceil(len(uids) / in_flight)))
+        batches = [uids[i:i + batch_size] for i in range(0, len(uids), batch_size)]
+        return PrefetchingIterator(self, lambda batch: self.__fetch_batch(folder, batch, fields), batches, in_flight)
+
+    def submit(self, function, *args):
+        # PrefetchingIterator's executor: runs the coroutine function returns on the event loop
+        return asyncio.run_coroutine_threadsafe(function(*args), self.__loop)
+
+    def __call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result()
+
+    async def __open_sessions(self):
+        await asyncio.gather(*(self.__open(service) for service in self.__services))
+
+    async def __close_sessions(self):
+        await asyncio.gather(*(service.logout() for service in self.__services if service.connected),
+                             return_exceptions=True)
+
+    async def __open(self, service):
+        await service.connect(*self.__server)
+        await service.authenticate(*self.__credentials)
+
+    async def __count_messages(self, folder, periods, filters):
+        count = lambda period: self.__run(folder, lambda service: service.count_messages(*period, filters))
+        return list(await asyncio.gather(*(count(period) for period in periods)))
+
+    async def __fetch_batch(self, folder, batch, fields):
+        return batch, await self.__run(folder, lambda service: service.fetch_message_info(batch, fields))
+
+    async def __run(self, folder, operation):
+        failures = 0
+        while True:
+            # the least busy session, preferring one that does not have to change mailboxes
+            service = min(self.__services, key=lambda service: (
+                self.__busy[service] > 0 and service.selected_mailbox != folder, self.__busy[service]))
+            self.__busy[service] += 1
+            try:
+                if not service.connected:
+                    await self.__reopen(service)
+                async with service.use_mailbox(folder):
+                    return await operation(service)
+            except (imaplib.IMAP4.abort, OSError) as error:
+                print(f"Connection failed ({error}), reconnecting")
+                self.metrics.count('connection_errors')
+                # the commands pipelined behind the one that failed do not use up an attempt
+                if not isinstance(error, PipelineAbort):
+                    failures += 1
+                if failures > config.connection_retries:
+                    raise
+                self.metrics.count('retries')
+            finally:
+                self.__busy[service] -= 1
+
+    async def __reopen(self, service):
+        # the commands that failed with the connection all retry, it is opened again once
+        async with service.reconnecting():
+            if not service.connected:
+                self.metrics.count('reconnects')
+                await self.__open(service)
+
+
+def search_results(command):
+    return [int(uid) for kind, parts in command.responses if kind == 'SEARCH' for uid in parts[-1].split()[2:]]
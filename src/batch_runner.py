@@ -0,0 +1,206 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+import config
+from file_source import FileMailSource
+from instrumentation import write_reports
+from mail_tool import MailTool
+
+job_file_help = """
+The job file is JSON. Every account is analyzed by its own MailTool; "defaults" apply to every
+account and an account's own keys override them. Results are keyed by the account's "name",
+its email by default:
+
+{
+  "defaults": {"server": "imap.gmail.com", "port": 993, "use_ssl": true, "connections": 2, "backend": "asyncio",
+               "cache_path": "cache/{email}.db",
+               "periods": [{"start": "2020-01-01", "end": "2021-01-01"}],
+               "reports": ["monthly", "domains", "keywords", "contacts"]},
+  "accounts": [
+    {"email": "custodian1@example.com", "password_env": "CUSTODIAN1_PASSWORD"},
+    {"email": "custodian2@example.com", "credentials_file": "custodian2.txt",
+     "sent_folder": "Sent Items", "recieved_folder": "INBOX"},
+    {"email": "custodian3@example.com", "sent_path": "exports/c3/sent.mbox", "recieved_path": "exports/c3/inbox"}
+  ]
+}
+
+The password is "password", the environment variable "password_env" or the first two lines
+(email, password) of "credentials_file". With "sent_path"/"recieved_path" the folders are read
+from mbox files, Maildirs or .eml directories instead of the server. Reports are the names
+MailTool.analyze accepts: hourly, daily, monthly, heatmap, domains, keywords, contacts.
+The "backend" is "imaplib" or "asyncio", see MailTool, and config.mail_backend by default.
+"cache_path" is formatted with the account's email, so every account has its own cache file;
+it is config.batch_cache_path by default and "" turns the cache off.
+"""
+
+
+def load_jobs(path):
+    with open(path) as file:
+        job_file = json.load(file)
+    defaults = job_file.get('defaults', {})
+    jobs = []
+    for account in job_file['accounts']:
+        job = dict(defaults)
+        job.update(account)
+        if not job.get('periods') or not job.get('reports'):
+            raise ValueError(f"{job['email']}: periods and reports are required")
+        jobs.append(job)
+    return jobs
+
+
+def get_password(job):
+    if 'password' in job:
+        return job['password']
+    if 'password_env' in job:
+        return os.environ[job['password_env']]
+    if 'credentials_file' in job:
+        with open(job['credentials_file']) as file:
+            file.readline()
+            return file.readline()
+    raise ValueError(f"{job['email']}: no password, password_env or credentials_file")
+
+
+def is_offline(job):
+    return bool(job.get('sent_path') or job.get('recieved_path'))
+
+
+def create_tool(job):
+    folders = {'sent': job.get('sent_folder', config.sent_folder),
+               'recieved': job.get('recieved_folder', config.recieved_folder)}
+    source = None
+    if is_offline(job):
+        paths = {folders['sent']: job.get('sent_path'), folders['recieved']: job.get('recieved_path')}
+        source = FileMailSource(folders={folder: path for folder, path in paths.items() if path})
+    cache_path = job.get('cache_path', config.batch_cache_path)
+    if cache_path:
+        cache_path = cache_path.format(email=job['email'])
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    return MailTool(cache_path=cache_path or '', connections=job.get('connections'), source=source, folders=folders,
+                    backend=job.get('backend'))
+
+
+def run_job(job):
+    # all periods of one account over one set of connections; every period reads each folder once.
+    # Returns the results and the run reports of the account's analyses, labelled with its name
+    started = time.perf_counter()
+    password = '' if is_offline(job) else get_password(job)
+    tool = create_tool(job)
+    tool.connect(job['email'], password, job.get('server'), job.get('port'), job.get('use_ssl'))
+    results = []
+    try:
+        for period in job['periods']:
+            period_start = datetime.fromisoformat(period['start'])
+            period_end = datetime.fromisoformat(period['end'])
+            reports = tool.analyze(period_start, period_end, job['reports'])
+            results.append((period['start'], period['end'], reports))
+    finally:
+        tool.disconnect()
+        if tool.cache:
+            tool.cache.close()
+    print(f"{job.get('name', job['email'])}: done in {time.perf_counter() - started:.1f}s, "
+          f"fetched {tool.mail_service.bytes_fetched} bytes")
+    for report in tool.run_reports:
+        report['labels'] = {'account': job.get('name', job['email'])}
+    return results, tool.run_reports
+
+
+def run_jobs(jobs, workers=None):
+    # accounts are analyzed concurrently, at most workers at a time; a failing account is reported
+    # and the others go on
+    results = {}
+    errors = {}
+    run_reports = []
+    with ThreadPoolExecutor(workers or config.batch_workers) as executor:
+        futures = {job.get('name', job['email']): executor.submit(run_job, job) for job in jobs}
+        for name, future in futures.items():
+            try:
+                results[name], account_reports = future.result()
+                run_reports.extend(account_reports)
+            except Exception as error:
+                print(f"{name}: failed, {error!r}")
+                errors[name] = repr(error)
+    return results, errors, run_reports
+
+
+def result_items(result):
+    # (key, value) pairs of a report; the heatmap's key is "weekday hour"
+    if isinstance(result, np.ndarray):
+        return [(f"{weekday} {hour:02d}", int(result[weekday, hour]))
+                for weekday in range(result.shape[0]) for hour in range(result.shape[1])]
+    return list(result.items())
+
+
+def result_rows(results):
+    for email, periods in results.items():
+        for period_start, period_end, reports in periods:
+            for report, result in reports.items():
+                for key, value in result_items(result):
+                    yield email, period_start, period_end, report, str(key), value
+
+
+def write_json(results, errors, path):
+    output = {email: [{'start': period_start, 'end': period_end,
+                       'reports': {report: dict(result_items(result)) for report, result in reports.items()}}
+                      for period_start, period_end, reports in periods]
+              for email, periods in results.items()}
+    with open(path, 'w') as file:
+        json.dump({'results': output, 'errors': errors}, file, indent=2)
+
+
+def write_csv(results, path):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(('account', 'period_start', 'period_end', 'report', 'key', 'value'))
+        writer.writerows(result_rows(results))
+
+
+def write_parquet(results, path):
+    # optional dependency, only needed for this format
+    import pyarrow
+    import pyarrow.parquet
+    columns = list(zip(*result_rows(results))) or [[]] * 6
+    names = ('account', 'period_start', 'period_end', 'report', 'key', 'value')
+    table = pyarrow.table({name: pyarrow.array(column, pyarrow.float64() if name == 'value' else pyarrow.string())
+                           for name, column in zip(names, columns)})
+    pyarrow.parquet.write_table(table, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run analyses for several accounts without the GUI",
+                                     epilog=job_file_help, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("job_file")
+    parser.add_argument("-o", "--output", default="results", help="output path without extension")
+    parser.add_argument("-f", "--format", nargs="+", choices=("json", "csv", "parquet"), default=["json"])
+    parser.add_argument("-w", "--workers", type=int, default=None, help="accounts analyzed at the same time")
+    parser.add_argument("-k", "--keyword-workers", type=int, default=None,
+                        help="processes counting keywords for every account, 0 for one per CPU; "
+                             "worth it on large mailboxes, keywords are counted in-process by default")
+    parser.add_argument("-m", "--metrics", choices=("json", "prometheus"), default=None,
+                        help="also write the timings of every analysis run")
+    args = parser.parse_args()
+
+    if args.keyword_workers is not None:
+        config.keyword_workers = args.keyword_workers or None
+    results, errors, run_reports = run_jobs(load_jobs(args.job_file), args.workers)
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    if "json" in args.format:
+        write_json(results, errors, args.output + ".json")
+    if "csv" in args.format:
+        write_csv(results, args.output + ".csv")
+    if "parquet" in args.format:
+        write_parquet(results, args.output + ".parquet")
+    if args.metrics:
+        write_reports(run_reports, args.output + (".prom" if args.metrics == "prometheus" else ".metrics.json"))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+import argparse
+import contextlib
+import io
+import time
+from datetime import datetime
+import config
+from connection_pool import MailServicePool
+from async_mail_service import AsyncMailServicePool
+from mail_service import header_fields
+from benchmarks.fake_imap_server import serve_in_process
+from benchmarks.synthetic_mailbox import generate_messages
+
+backends = {'imaplib': MailServicePool, 'asyncio': AsyncMailServicePool}
+
+
+def measure(backend, address, connections, folders, fields):
+    pool = backends[backend](connections)
+    pool.connect(address[0], address[1], use_ssl=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pool.authenticate("owner@example.com", "password")
+        start = time.perf_counter()
+        streams = [pool.iter_message_info_for_period(folder, datetime(2019, 12, 1), datetime(2021, 2, 1), fields)
+                   for folder in folders]
+        messages = [(message.uid, message.subject, message.body) for stream in streams for message in stream]
+        elapsed = time.perf_counter() - start
+        pool.logout()
+    return messages, elapsed, pool.bytes_fetched
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the blocking and the pipelined asyncio IMAP backends "
+                                                 "on a server with a long round trip")
+    parser.add_argument("--messages", type=int, default=4000, help="messages per folder")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated round trip in seconds")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--pipeline-depth", type=int, default=config.pipeline_depth)
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--headers-only", action="store_true")
+    args = parser.parse_args()
+
+    config.fetch_batch_size = args.batch_size
+    config.pipeline_depth = args.pipeline_depth
+    folders = ["Sent", "Inbox"]
+    mailboxes = {"Sent": generate_messages(args.messages, body_words=[20, 400], encoded_ratio=0.2),
+                 "Inbox": generate_messages(args.messages, seed=2, incoming=True, attachment_bytes=20000,
+                                            attachment_ratio=0.2)}
+    process, address = serve_in_process(mailboxes, latency=args.latency)
+    fields = header_fields if args.headers_only else None
+    print(f"{2 * args.messages} messages, {args.latency * 1000:g} ms round trip, batches of {args.batch_size}, "
+          f"pipeline depth {args.pipeline_depth}")
+    try:
+        for connections in args.connections:
+            results = {}
+            for backend in backends:
+                messages, elapsed, num_bytes = measure(backend, address, connections, folders, fields)
+                results[backend] = (messages, elapsed)
+                print(f"connections={connections} {backend:<8} messages={len(messages):<7} time={elapsed:7.2f}s "
+                      f"rate={len(messages) / elapsed:9.1f} msg/s {num_bytes / 2 ** 20:7.1f} MiB")
+            (sync_messages, sync_time), (async_messages, async_time) = results.values()
+            print(f"connections={connections} speedup={sync_time / async_time:4.2f}x "
+                  f"same messages: {sync_messages == async_messages}")
+    finally:
+        process.terminate()
+
+
+if __name__ == "__main__":
+    main()
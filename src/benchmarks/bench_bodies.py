@@ -0,0 +1,71 @@
+import argparse
+import contextlib
+import imaplib
+import io
+import time
+from mail_service import MailService, all_fields
+from message_parser import parse_message
+from benchmarks.fake_imap_server import FakeImapServer
+from benchmarks.synthetic_mailbox import generate_messages
+
+
+def fetch_whole_messages(address, batch_size):
+    # what analyses reading bodies fetched before: every message with its attachments
+    imap = imaplib.IMAP4(*address)
+    imap.login("owner@example.com", "password")
+    imap.select("INBOX", readonly=True)
+    start = time.perf_counter()
+    status, data = imap.uid('SEARCH', None, 'ALL')
+    uids = data[0].split()
+    bodies = {}
+    num_bytes = 0
+    for i in range(0, len(uids), batch_size):
+        status, data = imap.uid('FETCH', b','.join(uids[i:i + batch_size]), '(UID RFC822)')
+        for response_part in data:
+            if isinstance(response_part, tuple):
+                num_bytes += len(response_part[0]) + len(response_part[1])
+                uid = int(response_part[0].split(b'UID ')[1].split()[0])
+                bodies[uid] = parse_message(response_part[1], True, uid).body
+    elapsed = time.perf_counter() - start
+    imap.logout()
+    return bodies, num_bytes, elapsed
+
+
+def fetch_text_parts(address, batch_size):
+    service = MailService()
+    service.connect(address[0], address[1], use_ssl=False)
+    service.authenticate("owner@example.com", "password")
+    with contextlib.redirect_stdout(io.StringIO()):
+        service.select_mailbox("INBOX")
+        start = time.perf_counter()
+        uids = service.search_uids()
+        messages = service.get_message_info_for_uids(uids, batch_size, all_fields)
+        elapsed = time.perf_counter() - start
+    service.logout()
+    return {message.uid: message.body for message in messages}, service.bytes_fetched, elapsed, service.parse_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fetching whole messages and only their text parts")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--attachment-bytes", type=int, default=100000)
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated round trip in seconds")
+    parser.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args()
+
+    raw_messages = generate_messages(args.messages, attachment_bytes=args.attachment_bytes)
+    server = FakeImapServer({"INBOX": raw_messages}, latency=args.latency)
+    address = server.start()
+    try:
+        print(f"{args.messages} messages with a {args.attachment_bytes} byte attachment each")
+        old, old_bytes, old_time = fetch_whole_messages(address, args.batch_size)
+        print(f"{'before: RFC822':<28} {old_bytes / 2 ** 20:9.1f} MiB {old_time:8.2f}s")
+        new, new_bytes, new_time, stats = fetch_text_parts(address, args.batch_size)
+        print(f"{'BODYSTRUCTURE + BODY[n]':<28} {new_bytes / 2 ** 20:9.1f} MiB {new_time:8.2f}s")
+        print("same bodies:", old == new, dict(stats))
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
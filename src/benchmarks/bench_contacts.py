@@ -0,0 +1,76 @@
+import argparse
+import time
+from collections import defaultdict
+from datetime import datetime
+import numpy as np
+from contact_index import ContactIndex, contact_weights, roles
+
+
+def weights_like_before(index):
+    # the per-contact dict loops get_contact_interaction_weights used before
+    # (without the normalization by a zero range, which raised ZeroDivisionError)
+    params = defaultdict(lambda: {})
+    counts, first, last = index.counts.tolist(), index.first.min(axis=1), index.last.max(axis=1)
+    for i, contact in enumerate(index.contacts):
+        entry = dict(zip(roles, counts[i]))
+        num_recieved = entry['To-Me'] + entry['To-Me-Cc'] + entry['To-Me-Bcc'] + entry['To-Me-Groups']
+        num_sent = entry['From-Me'] + entry['From-Me-Cc'] + entry['From-Me-Bcc']
+        num_sec = num_recieved + num_sent - entry['To-Me'] - entry['From-Me']
+        num_total = num_recieved + num_sent
+        length = (datetime.fromtimestamp(last[i]) - datetime.fromtimestamp(first[i])).days
+        length = length if length > 0 else 1
+        params[contact]['Recen'] = (datetime.now() - datetime.fromtimestamp(last[i])).days
+        params[contact]['Sent-Freq'] = float(num_sent) / length
+        params[contact]['Recv-Freq'] = float(num_recieved) / length
+        params[contact]['To-Me'] = float(entry['To-Me']) / num_total
+        params[contact]['From-Me'] = float(entry['From-Me']) / num_total
+        params[contact]['Sec'] = float(num_sec) / num_total
+        params[contact]['Recip'] = 1 - (abs(num_recieved - num_sent) / float(num_total))
+    weights = defaultdict(int)
+    min_sent_freq = min(params.values(), key=lambda x: x['Sent-Freq'])['Sent-Freq']
+    max_sent_freq = max(params.values(), key=lambda x: x['Sent-Freq'])['Sent-Freq']
+    min_recv_freq = min(params.values(), key=lambda x: x['Recv-Freq'])['Recv-Freq']
+    max_recv_freq = max(params.values(), key=lambda x: x['Recv-Freq'])['Recv-Freq']
+    min_recen = min(params.values(), key=lambda x: x['Recen'])['Recen']
+    max_recen = max(params.values(), key=lambda x: x['Recen'])['Recen']
+    for contact in params:
+        entry = params[contact]
+        norm_sent_freq = (entry['Sent-Freq'] - min_sent_freq) / (max_sent_freq - min_sent_freq)
+        norm_recv_freq = (entry['Recv-Freq'] - min_recv_freq) / (max_recv_freq - min_recv_freq)
+        norm_recen = (entry['Recen'] - min_recen) / (max_recen - min_recen)
+        weights[contact] = entry['Recip'] + entry['From-Me'] + norm_sent_freq \
+            + 0.5 * (norm_recv_freq + entry['To-Me']) + 0.3 * (norm_recen + entry['Sec'])
+    return {key: value for key, value in sorted(weights.items(), key=lambda item: item[1], reverse=True)}
+
+
+def measure(label, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    print(f"{label:<28} {time.perf_counter() - start:8.3f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare dict-based and vectorized contact weights")
+    parser.add_argument("--contacts", type=int, default=100000)
+    parser.add_argument("--events", type=int, default=1000000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    contacts = [f"contact{i}@example.com" for i in range(args.contacts)]
+    period_start = datetime(2020, 1, 1).timestamp()
+    rows = list(zip(contacts * 2, rng.integers(0, len(roles), 2 * args.contacts).tolist(),
+                    rng.integers(1, 2 * args.events // args.contacts, 2 * args.contacts).tolist(),
+                    rng.uniform(period_start, period_start + 180 * 86400, 2 * args.contacts).tolist(),
+                    rng.uniform(period_start + 180 * 86400, period_start + 365 * 86400, 2 * args.contacts).tolist()))
+    print(f"{args.contacts} contacts")
+
+    index = measure("build index from rows", ContactIndex.from_rows, rows)
+    measure("merge two indexes", ContactIndex().merge(index).merge, index)
+    old = measure("before: dict loops", weights_like_before, index)
+    new = measure("vectorized", contact_weights, index)
+    print("same ranking:", list(old)[:100] == list(new)[:100])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import argparse
+import contextlib
+import io
+import time
+from datetime import datetime
+from mail_service import MailService
+from benchmarks.fake_imap_server import FakeImapServer
+from benchmarks.synthetic_mailbox import generate_messages
+
+
+def measure(address, period_start, period_end, batch_size):
+    service = MailService()
+    service.connect(address[0], address[1], use_ssl=False)
+    service.authenticate("owner@example.com", "password")
+    with contextlib.redirect_stdout(io.StringIO()):
+        service.select_mailbox("INBOX")
+        start = time.perf_counter()
+        messages = service.get_message_info_for_period(period_start, period_end, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        service.close_mailbox()
+    service.logout()
+    return len(messages), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-message and batched IMAP fetching")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated round trip in seconds")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 50, 500])
+    args = parser.parse_args()
+
+    server = FakeImapServer({"INBOX": generate_messages(args.messages)}, latency=args.latency)
+    address = server.start()
+    period_start, period_end = datetime(2019, 12, 1), datetime(2021, 2, 1)
+    try:
+        for batch_size in args.batch_sizes:
+            count, elapsed = measure(address, period_start, period_end, batch_size)
+            print(f"batch_size={batch_size:<5} messages={count:<7} time={elapsed:8.2f}s "
+                  f"rate={count / elapsed:10.1f} msg/s")
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import os
+import re
+import string
+import time
+from collections import defaultdict
+from email import message_from_bytes
+from keyword_extractor import KeywordExtractor
+from benchmarks.synthetic_mailbox import generate_messages
+
+
+def count_like_before(texts):
+    # the per-message loop count_most_used_keywords used before
+    from nltk import word_tokenize
+    token_dict = defaultdict(int)
+    for text_to_process in texts:
+        text = re.sub(r'(https|http){1}:\/\/[^\s]+\.[\w\d]+\/{0,1}', '', text_to_process, flags=re.MULTILINE)
+        text = re.sub('<.*>', '', text, flags=re.MULTILINE)
+        tokens = word_tokenize(text)
+        tokens = list(filter(lambda token: token not in string.punctuation and token not in ['``', '\'\'', '\"\"', '...', ], tokens))
+        for token in tokens:
+            token_dict[token] += 1
+    return token_dict
+
+
+def count_with_extractor(texts, **options):
+    extractor = KeywordExtractor(**options)
+    for text in texts:
+        extractor.add_text(text)
+    return extractor.result()
+
+
+def measure(label, function, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    except LookupError as error:
+        print(f"{label:<32} skipped, NLTK data missing")
+        return None
+    print(f"{label:<32} {time.perf_counter() - start:8.3f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare keyword counting strategies")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--body-words", type=int, default=300)
+    parser.add_argument("--workers", type=int, default=max(2, os.cpu_count()))
+    args = parser.parse_args()
+
+    texts = []
+    for raw in generate_messages(args.messages, body_words=args.body_words):
+        message = message_from_bytes(raw)
+        texts.append(message.get_payload() + " " + message['Subject'])
+    print(f"{args.messages} messages, {args.body_words} words each")
+
+    measure("before: nltk, single thread", count_like_before, texts)
+    measure("nltk tokenizer, process pool", count_with_extractor, texts, tokenizer='nltk', workers=args.workers)
+    measure("regex, single process", count_with_extractor, texts, workers=1)
+    measure("regex, process pool", count_with_extractor, texts, workers=args.workers)
+    measure("regex, bigrams, process pool", count_with_extractor, texts, ngrams=(1, 2), workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import contextlib
+import io
+import time
+from datetime import datetime
+import config
+from connection_pool import MailServicePool
+from mail_service import header_fields
+from benchmarks.fake_imap_server import serve_in_process
+from benchmarks.synthetic_mailbox import generate_messages
+
+
+def measure(address, connections, folders, fields):
+    pool = MailServicePool(connections)
+    pool.connect(address[0], address[1], use_ssl=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pool.authenticate("owner@example.com", "password")
+        start = time.perf_counter()
+        streams = [pool.iter_message_info_for_period(folder, datetime(2019, 12, 1), datetime(2021, 2, 1), fields)
+                   for folder in folders]
+        count = sum(1 for stream in streams for message in stream)
+        elapsed = time.perf_counter() - start
+        pool.logout()
+    return count, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure fetch throughput for 1-8 pooled IMAP connections")
+    parser.add_argument("--messages", type=int, default=4000, help="messages per folder")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated round trip in seconds")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--max-connections", type=int, default=8)
+    parser.add_argument("--headers-only", action="store_true")
+    args = parser.parse_args()
+
+    config.fetch_batch_size = args.batch_size
+    folders = ["Sent", "Inbox"]
+    mailboxes = {"Sent": generate_messages(args.messages), "Inbox": generate_messages(args.messages, seed=2)}
+    process, address = serve_in_process(mailboxes, latency=args.latency)
+    fields = header_fields if args.headers_only else None
+    try:
+        baseline = None
+        for connections in range(1, args.max_connections + 1):
+            count, elapsed = measure(address, connections, folders, fields)
+            rate = count / elapsed
+            baseline = baseline or rate
+            print(f"connections={connections} messages={count:<7} time={elapsed:7.2f}s "
+                  f"rate={rate:9.1f} msg/s speedup={rate / baseline:4.2f}x")
+    finally:
+        process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from datetime import datetime
+from message_record import AddressBook, MessageRecord
+
+address_book = AddressBook()
+
+
+def synthetic_headers(count, contacts, recipients, seed=1):
+    # the parsed header fields of count messages, every address string a fresh object as the parser
+    # decodes each header on its own
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1).timestamp()
+    domains = ['example.com', 'example.org', 'corp.example.com', 'mail.example.net']
+    for i in range(count):
+        recievers = [f"contact{n}@{domains[n % len(domains)]}" for n in rng.sample(range(contacts), recipients)]
+        cc = [f"contact{rng.randrange(contacts)}@example.com"] if i % 3 == 0 else None
+        yield (i + 1, start + 60 * i, "owner@example.com", recievers, cc, None,
+               f"Subject {rng.randrange(1000)} of the project")
+
+
+def as_dict(uid, timestamp, sender, recievers, cc, bcc, subject):
+    # the dict parse_message returned before
+    return {'UID': uid, 'Sender': sender, 'Recievers': recievers, 'CC': cc, 'BCC': bcc,
+            'Date': datetime.fromtimestamp(timestamp), 'Subject': subject, 'Text-Body': None}
+
+
+def as_record(uid, timestamp, sender, recievers, cc, bcc, subject):
+    return MessageRecord.from_addresses(uid, timestamp, sender, recievers, cc, bcc, subject, address_book=address_book)
+
+
+def measure(label, build, count, contacts, recipients):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    messages = [build(*headers) for headers in synthetic_headers(count, contacts, recipients)]
+    elapsed = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<28} {size / 2 ** 20:8.1f} MiB {size / count:8.0f} bytes/message "
+          f"(peak {peak / 2 ** 20:.1f} MiB) {elapsed:6.2f}s")
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-message memory of dict messages and MessageRecord")
+    parser.add_argument("--messages", type=int, default=500000)
+    parser.add_argument("--contacts", type=int, default=5000)
+    parser.add_argument("--recipients", type=int, default=3)
+    args = parser.parse_args()
+    print(f"{args.messages} messages, {args.contacts} contacts, {args.recipients} recipients each, headers only")
+
+    before = measure("before: dicts", as_dict, args.messages, args.contacts, args.recipients)
+    del before
+    # the address book is part of the measurement, it is filled by the first record of each address
+    after = measure("MessageRecord", as_record, args.messages, args.contacts, args.recipients)
+    print(f"address book: {len(address_book)} addresses, {len(address_book.domains)} domains")
+
+    start = time.perf_counter()
+    domains = {}
+    for message in after:
+        for address_id in message.reciever_ids:
+            domain_id = address_book.domain_id(address_id)
+            domains[domain_id] = domains.get(domain_id, 0) + 1
+    print(f"{'count domains by id':<28} {time.perf_counter() - start:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import argparse
+import contextlib
+import io
+import time
+from datetime import datetime
+import config
+from mail_tool import MailTool
+from benchmarks.fake_imap_server import FakeImapServer
+from benchmarks.synthetic_mailbox import generate_messages
+
+
+def measure(label, address, server_side, connections, period_start, period_end, bucket):
+    tool = MailTool(cache_path='', connections=connections)
+    tool.connect("owner@example.com", "password", address[0], address[1], use_ssl=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        counts = tool.count_sent_messages(period_start, period_end, bucket, server_side=server_side)
+        elapsed = time.perf_counter() - start
+    tool.disconnect()
+    print(f"{label:<32} messages={sum(counts.values()):<7} time={elapsed:7.2f}s "
+          f"bytes={tool.bytes_fetched['count_sent_messages']}")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare client-side and server-side (SEARCH) counting")
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated round trip in seconds")
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--bucket", default="day")
+    args = parser.parse_args()
+
+    period_start, period_end = datetime(2020, 1, 1), datetime(2021, 1, 1)
+    for esearch in (False, True):
+        server = FakeImapServer({config.sent_folder: generate_messages(args.messages)}, latency=args.latency,
+                                esearch=esearch)
+        address = server.start()
+        try:
+            suffix = ", ESEARCH server" if esearch else ""
+            fetched = measure("fetch headers" + suffix, address, False, args.connections, period_start, period_end, args.bucket)
+            searched = measure("SEARCH per bucket" + suffix, address, True, args.connections, period_start, period_end, args.bucket)
+            print("same counts:", fetched == searched)
+        finally:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
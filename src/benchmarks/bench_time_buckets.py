@@ -0,0 +1,50 @@
+import argparse
+import time
+from datetime import datetime
+import numpy as np
+from dateutil.relativedelta import *
+from time_buckets import count_by_bucket, bucket_counts, weekday_hour_heatmap
+
+
+def count_with_strftime(timestamps, period_start, period_end):
+    # the per-message loop count_sent_messages_hourly used before
+    time_dictionary = {}
+    day = period_start
+    while day < period_end:
+        time_dictionary[day.strftime("%Y-%m-%d %H:00")] = 0
+        day = day + relativedelta(hours=+1)
+    for timestamp in timestamps:
+        time_dictionary[datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:00")] += 1
+    return time_dictionary
+
+
+def measure(label, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    print(f"{label:<28} {time.perf_counter() - start:8.3f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare strftime-per-message and vectorized time bucketing")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--years", type=int, default=5)
+    args = parser.parse_args()
+
+    period_start = datetime(2015, 1, 1)
+    period_end = period_start + relativedelta(years=+args.years)
+    rng = np.random.default_rng(1)
+    timestamps = np.sort(rng.uniform(period_start.timestamp(), period_end.timestamp(), args.messages))
+    print(f"{args.messages} timestamps over {args.years} years")
+
+    old = measure("hourly, strftime loop", count_with_strftime, timestamps.tolist(), period_start, period_end)
+    new = measure("hourly, vectorized", count_by_bucket, timestamps, period_start, period_end, 'hour')
+    print(f"{'results identical':<28} {old == new}")
+    measure("minute, vectorized", count_by_bucket, timestamps, period_start, period_end, 'minute')
+    measure("minute, arrays only", bucket_counts, timestamps, period_start, period_end, 'minute')
+    measure("month, vectorized, UTC", count_by_bucket, timestamps, period_start, period_end, 'month', 'UTC')
+    measure("weekday x hour heatmap", weekday_hour_heatmap, timestamps)
+
+
+if __name__ == "__main__":
+    main()
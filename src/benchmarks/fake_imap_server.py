@@ -0,0 +1,490 @@
+import multiprocessing
+import queue
+import re
+import socket
+import socketserver
+import threading
+import time
+import email
+import email.policy
+import email.utils
+from datetime import date, datetime
+
+fetch_item_pattern = re.compile(r'BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|[A-Z0-9.]+', re.IGNORECASE)
+token_pattern = re.compile(r'"(?:[^"\\]|\\.)*"|\(|\)|[^\s()]+')
+literal_pattern = re.compile(rb'\{(\d+)\}$')
+partial_pattern = re.compile(r'<(\d+)\.(\d+)>$')
+flag_keys = {'SEEN': ('\\SEEN', True), 'UNSEEN': ('\\SEEN', False), 'ANSWERED': ('\\ANSWERED', True),
+             'UNANSWERED': ('\\ANSWERED', False), 'FLAGGED': ('\\FLAGGED', True), 'UNFLAGGED': ('\\FLAGGED', False),
+             'DRAFT': ('\\DRAFT', True), 'UNDRAFT': ('\\DRAFT', False), 'DELETED': ('\\DELETED', True),
+             'UNDELETED': ('\\DELETED', False)}
+
+
+class FakeMailbox:
+    def __init__(self, raw_messages, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.next_uid = 1
+        for raw in raw_messages:
+            self.append(raw)
+
+    def append(self, raw, flags=()):
+        message = email.message_from_bytes(raw)
+        date_tuple = email.utils.parsedate_tz(message['Date'])
+        internal_date = datetime.fromtimestamp(email.utils.mktime_tz(date_tuple))
+        self.messages.append({'uid': self.next_uid, 'raw': raw, 'date': internal_date.date(),
+                              'sent_date': date(*date_tuple[:3]), 'flags': {flag.upper() for flag in flags}})
+        self.next_uid += 1
+
+
+class FakeImapServer:
+    def __init__(self, mailboxes, latency=0.0, host='127.0.0.1', port=0, disconnect_every=0, esearch=False):
+        self.mailboxes = {name: box if isinstance(box, FakeMailbox) else FakeMailbox(box)
+                          for name, box in mailboxes.items()}
+        self.latency = latency
+        # drop the connection instead of answering every n-th FETCH, to exercise reconnects
+        self.disconnect_every = disconnect_every
+        self.esearch = esearch
+        self.fetches = 0
+        self.commands = 0
+        self.bytes_sent = 0
+        self.__lock = threading.Lock()
+        self.__server = socketserver.ThreadingTCPServer((host, port), self.__make_handler(), bind_and_activate=False)
+        self.__server.allow_reuse_address = True
+        self.__server.daemon_threads = True
+        self.__server.server_bind()
+        self.__server.server_activate()
+        self.__thread = None
+
+    @property
+    def address(self):
+        return self.__server.server_address
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self.address
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def _should_disconnect(self):
+        with self.__lock:
+            self.fetches += 1
+            return self.disconnect_every and self.fetches % self.disconnect_every == 0
+
+    def _record(self, num_bytes):
+        with self.__lock:
+            self.commands += 1
+            self.bytes_sent += num_bytes
+
+    def __make_handler(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            wbufsize = 64 * 1024
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                # commands are read as they arrive, so pipelined commands wait out their latency together
+                self.write_lock = threading.Lock()
+                session = FakeImapSession(server, self.wfile)
+                session.send(b'* OK fake IMAP4rev1 server ready')
+                self.wfile.flush()
+                commands = queue.Queue()
+                threading.Thread(target=self.read_commands, args=(commands,), daemon=True).start()
+                try:
+                    while not session.closed:
+                        received, line = commands.get()
+                        if line is None:
+                            break
+                        with self.write_lock:
+                            session.handle_line(line.decode('utf-8', 'replace'), received)
+                finally:
+                    # the reader stops and the client sees the connection close
+                    try:
+                        self.request.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+            def read_commands(self, commands):
+                try:
+                    while True:
+                        line = self.read_command()
+                        commands.put((time.monotonic(), line))
+                        if line is None:
+                            return
+                except (OSError, ValueError):
+                    commands.put((time.monotonic(), None))
+
+            def read_command(self):
+                # a command ending in {n} continues with an n byte literal after the "+" response;
+                # the literal is put back into the line as a quoted string
+                line = b''
+                while True:
+                    part = self.rfile.readline()
+                    if not part:
+                        return None
+                    part = part.rstrip(b'\r\n')
+                    match = literal_pattern.search(part)
+                    if not match:
+                        return line + part
+                    with self.write_lock:
+                        self.wfile.write(b'+ Ready for literal\r\n')
+                        self.wfile.flush()
+                    literal = self.rfile.read(int(match.group(1)))
+                    line += part[:match.start()] + b'"' + literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+        return Handler
+
+
+class FakeImapSession:
+    capabilities = "IMAP4rev1 UIDPLUS"
+
+    def __init__(self, server, wfile):
+        self.server = server
+        self.wfile = wfile
+        self.mailbox = None
+        self.closed = False
+        self.sent = 0
+
+    def send(self, data):
+        self.wfile.write(data + b'\r\n')
+        self.sent += len(data) + 2
+
+    def handle_line(self, line, received=None):
+        tag, _, rest = line.partition(' ')
+        self.tag = tag
+        command, _, arguments = rest.partition(' ')
+        command = command.upper()
+        self.sent = 0
+        # latency is the round trip: the response leaves latency seconds after its command arrived
+        delay = (received or time.monotonic()) + self.server.latency - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if 'FETCH' in rest.upper()[:10] and self.server._should_disconnect():
+            self.closed = True
+            return
+        try:
+            handler = getattr(self, 'do_' + command.lower(), None)
+            if handler is None:
+                self.send(f'{tag} BAD unknown command {command}'.encode())
+            else:
+                self.send(f'{tag} {handler(arguments)}'.encode())
+        except Exception as error:
+            self.send(f'{tag} BAD {error}'.encode())
+        self.wfile.flush()
+        self.server._record(self.sent)
+
+    def do_capability(self, arguments):
+        capabilities = self.capabilities + (" ESEARCH" if self.server.esearch else "")
+        self.send(f'* CAPABILITY {capabilities}'.encode())
+        return 'OK CAPABILITY completed'
+
+    def do_noop(self, arguments):
+        return 'OK NOOP completed'
+
+    def do_login(self, arguments):
+        return 'OK LOGIN completed'
+
+    def do_logout(self, arguments):
+        self.send(b'* BYE logging out')
+        self.closed = True
+        return 'OK LOGOUT completed'
+
+    def do_list(self, arguments):
+        for name in self.server.mailboxes:
+            self.send(f'* LIST (\\HasNoChildren) "/" "{name}"'.encode())
+        return 'OK LIST completed'
+
+    def do_select(self, arguments):
+        name = unquote(tokenize(arguments)[0])
+        if name not in self.server.mailboxes:
+            return 'NO no such mailbox'
+        self.mailbox = self.server.mailboxes[name]
+        self.send(f'* {len(self.mailbox.messages)} EXISTS'.encode())
+        self.send(b'* 0 RECENT')
+        self.send(f'* OK [UIDVALIDITY {self.mailbox.uidvalidity}] UIDs valid'.encode())
+        self.send(f'* OK [UIDNEXT {self.mailbox.next_uid}] predicted next UID'.encode())
+        return 'OK [READ-ONLY] SELECT completed'
+
+    do_examine = do_select
+
+    def do_status(self, arguments):
+        tokens = tokenize(arguments)
+        name = unquote(tokens[0])
+        mailbox = self.server.mailboxes[name]
+        items = {'MESSAGES': len(mailbox.messages), 'UIDNEXT': mailbox.next_uid,
+                 'UIDVALIDITY': mailbox.uidvalidity, 'RECENT': 0, 'UNSEEN': 0}
+        requested = [token.upper() for token in tokens[1:] if token not in '()']
+        status = " ".join(f'{item} {items[item]}' for item in requested)
+        self.send(f'* STATUS "{name}" ({status})'.encode())
+        return 'OK STATUS completed'
+
+    def do_close(self, arguments):
+        self.mailbox = None
+        return 'OK CLOSE completed'
+
+    def do_search(self, arguments, uid=False):
+        tokens = tokenize(arguments)
+        returns = None
+        if tokens[0].upper() == 'RETURN':
+            if not self.server.esearch:
+                return 'BAD ESEARCH not supported'
+            end = tokens.index(')')
+            returns = [token.upper() for token in tokens[2:end]]
+            tokens = tokens[end + 1:]
+        if tokens[0].upper() == 'CHARSET':
+            tokens = tokens[2:]
+        matches = self.search(tokens, uid)
+        if returns is None:
+            self.send(('* SEARCH ' + " ".join(str(n) for n in matches)).strip().encode())
+        else:
+            result = f' COUNT {len(matches)}' if 'COUNT' in returns else ''
+            self.send(f'* ESEARCH (TAG "{self.tag}"){" UID" if uid else ""}{result}'.encode())
+        return 'OK SEARCH completed'
+
+    def do_fetch(self, arguments, uid=False):
+        message_set, _, items = arguments.partition(' ')
+        items = [item.upper() for item in fetch_item_pattern.findall(items)]
+        if uid and 'UID' not in items:
+            items.insert(0, 'UID')
+        for number, message in self.select_messages(message_set, uid):
+            parts = []
+            for item in items:
+                value = self.fetch_item(message, item)
+                if isinstance(value, bytes):
+                    name = partial_pattern.sub(r'<\1>', item.replace(".PEEK", ""))
+                    parts.append((f'{name} {{{len(value)}}}'.encode(), value))
+                else:
+                    parts.append((f'{item} {value}'.encode(), None))
+            self.send_fetch_response(number, parts)
+        return 'OK FETCH completed'
+
+    def do_uid(self, arguments):
+        command, _, arguments = arguments.partition(' ')
+        return getattr(self, 'do_' + command.lower())(arguments, uid=True)
+
+    def send_fetch_response(self, number, parts):
+        data = f'* {number} FETCH ('.encode()
+        for i, (head, literal) in enumerate(parts):
+            data += (b' ' if i else b'') + head
+            if literal is not None:
+                self.send(data)
+                self.wfile.write(literal)
+                self.sent += len(literal)
+                data = b''
+        self.send(data + b')')
+
+    def fetch_item(self, message, item):
+        raw = message['raw']
+        if item == 'UID':
+            return str(message['uid'])
+        if item == 'RFC822.SIZE':
+            return str(len(raw))
+        if item == 'INTERNALDATE':
+            return message['date'].strftime('"%d-%b-%Y 00:00:00 +0000"')
+        if item == 'RFC822':
+            return raw
+        if item == 'BODYSTRUCTURE':
+            return body_structure(parsed_message(message))
+        partial = partial_pattern.search(item)
+        if partial:
+            offset, length = int(partial.group(1)), int(partial.group(2))
+            return self.fetch_item(message, item[:partial.start()])[offset:offset + length]
+        header, _, text = raw.partition(b'\r\n\r\n') if b'\r\n\r\n' in raw else raw.partition(b'\n\n')
+        if item == 'RFC822.HEADER':
+            return header + b'\r\n\r\n'
+        section = item[item.index('[') + 1:item.index(']')]
+        if section == '':
+            return raw
+        if section == 'HEADER':
+            return header + b'\r\n\r\n'
+        if section == 'TEXT':
+            return text
+        if section.startswith('HEADER.FIELDS'):
+            names = section[section.index('(') + 1:section.index(')')].split()
+            return self.header_fields(header, names)
+        if re.fullmatch(r'\d+(\.\d+)*', section):
+            return body_section(parsed_message(message), section)
+        raise ValueError(f'unsupported fetch item {item}')
+
+    def header_fields(self, header, names):
+        names = {name.lower() for name in names}
+        lines = []
+        keep = False
+        for line in header.splitlines():
+            if line[:1] in (b' ', b'\t'):
+                if keep:
+                    lines.append(line)
+                continue
+            keep = line.split(b':', 1)[0].decode('ascii', 'replace').lower() in names
+            if keep:
+                lines.append(line)
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+    def select_messages(self, message_set, uid):
+        messages = self.mailbox.messages
+        if not messages:
+            return []
+        highest = messages[-1]['uid'] if uid else len(messages)
+        wanted = parse_message_set(message_set, highest)
+        if uid:
+            return [(i + 1, message) for i, message in enumerate(messages) if wanted(message['uid'])]
+        return [(i + 1, message) for i, message in enumerate(messages) if wanted(i + 1)]
+
+    def search(self, tokens, uid):
+        messages = self.mailbox.messages
+        highest_uid = messages[-1]['uid'] if messages else 0
+        keys = []
+        position = 0
+        while position < len(tokens):
+            key, position = self.parse_search_key(tokens, position, highest_uid)
+            keys.append(key)
+        matches = []
+        for i, message in enumerate(messages):
+            if all(key(message) for key in keys):
+                matches.append(message['uid'] if uid else i + 1)
+        return matches
+
+    def parse_search_key(self, tokens, position, highest_uid):
+        # returns a predicate on a message and the position after the key
+        key = tokens[position].upper()
+        position += 1
+        if key == '(':
+            keys = []
+            while tokens[position] != ')':
+                nested, position = self.parse_search_key(tokens, position, highest_uid)
+                keys.append(nested)
+            return (lambda message: all(nested(message) for nested in keys)), position + 1
+        if key == 'ALL':
+            return (lambda message: True), position
+        if key == 'NOT':
+            negated, position = self.parse_search_key(tokens, position, highest_uid)
+            return (lambda message: not negated(message)), position
+        if key == 'OR':
+            left, position = self.parse_search_key(tokens, position, highest_uid)
+            right, position = self.parse_search_key(tokens, position, highest_uid)
+            return (lambda message: left(message) or right(message)), position
+        if key in flag_keys:
+            flag, present = flag_keys[key]
+            return (lambda message: (flag in message['flags']) == present), position
+        argument = unquote(tokens[position])
+        position += 1
+        if key in ('SINCE', 'BEFORE', 'ON', 'SENTSINCE', 'SENTBEFORE', 'SENTON'):
+            day = datetime.strptime(argument, '%d-%b-%Y').date()
+            field = 'sent_date' if key.startswith('SENT') else 'date'
+            compare = {'SINCE': lambda value: value >= day, 'BEFORE': lambda value: value < day,
+                       'ON': lambda value: value == day}[key.replace('SENT', '')]
+            return (lambda message: compare(message[field])), position
+        if key in ('FROM', 'TO', 'CC', 'BCC', 'SUBJECT', 'BODY', 'TEXT'):
+            text = argument.lower()
+            if key == 'TEXT':
+                return (lambda message: any(text in value for value in searchable_text(message).values())), position
+            return (lambda message: text in searchable_text(message)[key]), position
+        if key in ('LARGER', 'SMALLER'):
+            size = int(argument)
+            if key == 'LARGER':
+                return (lambda message: len(message['raw']) > size), position
+            return (lambda message: len(message['raw']) < size), position
+        if key == 'UID':
+            wanted = parse_message_set(argument, highest_uid)
+            return (lambda message: wanted(message['uid'])), position
+        raise ValueError(f'unsupported search key {key}')
+
+
+def searchable_text(message):
+    # decoded, lowercased headers and body of a mailbox message, parsed on the first text search
+    if 'text' not in message:
+        parsed = email.message_from_bytes(message['raw'], policy=email.policy.default)
+        body = parsed.get_body(('plain', 'html'))
+        message['text'] = {name.upper(): str(parsed[name] or '').lower() for name in ('From', 'To', 'Cc', 'Bcc', 'Subject')}
+        message['text']['BODY'] = (body.get_content() if body else '').lower()
+    return message['text']
+
+
+def parsed_message(message):
+    # the MIME tree of a mailbox message, parsed on the first structure or part fetch
+    if 'parsed' not in message:
+        message['parsed'] = email.message_from_bytes(message['raw'])
+    return message['parsed']
+
+
+def body_section(message, section):
+    # the content of part section, still in its transfer encoding, e.g. '1' of a single part message
+    part = message
+    for number in section.split('.'):
+        if part.get_content_maintype() == 'multipart':
+            part = part.get_payload()[int(number) - 1]
+        elif number != '1':
+            raise ValueError(f'no part {section}')
+    return part_content(part)
+
+
+def part_content(part):
+    payload = part.get_payload()
+    if isinstance(payload, list):
+        return b''.join(child.as_bytes() for child in payload)
+    # 8bit text comes back decoded with its charset, only the transfer decoding is lossless
+    if (part['Content-Transfer-Encoding'] or '').lower() in ('base64', 'quoted-printable'):
+        return payload.encode('ascii')
+    return part.get_payload(decode=True)
+
+
+def body_structure(part):
+    # BODYSTRUCTURE without the extension data other than the disposition
+    if part.get_content_maintype() == 'multipart':
+        children = ''.join(body_structure(child) for child in part.get_payload())
+        return f'({children} {quote(part.get_content_subtype().upper())})'
+    parameters = (part.get_params() or [])[1:]
+    parameters = '(' + ' '.join(f'{quote(name.upper())} {quote(value)}' for name, value in parameters) + ')' \
+        if parameters else 'NIL'
+    payload = part_content(part)
+    encoding = quote((part['Content-Transfer-Encoding'] or '7bit').upper())
+    disposition = part.get_content_disposition()
+    disposition = f'({quote(disposition.upper())} NIL)' if disposition else 'NIL'
+    fields = (f'{quote(part.get_content_maintype().upper())} {quote(part.get_content_subtype().upper())} '
+              f'{parameters} NIL NIL {encoding} {len(payload)}')
+    if part.get_content_maintype() == 'text':
+        lines = payload.count(b'\n')
+        return f'({fields} {lines} NIL {disposition})'
+    return f'({fields} NIL {disposition})'
+
+
+def quote(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def serve_in_process(mailboxes, latency=0.0, **options):
+    # a separate process keeps the server from competing with the client for the GIL
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(mailboxes, latency, options, ready), daemon=True)
+    process.start()
+    return process, ready.get()
+
+
+def _serve(mailboxes, latency, options, ready):
+    server = FakeImapServer(mailboxes, latency, **options)
+    ready.put(server.start())
+    threading.Event().wait()
+
+
+def tokenize(arguments):
+    return token_pattern.findall(arguments)
+
+
+def unquote(value):
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return value
+
+
+def parse_message_set(message_set, highest):
+    ranges = []
+    for part in message_set.split(','):
+        low, _, high = part.partition(':')
+        low = highest if low == '*' else int(low)
+        high = low if not high else highest if high == '*' else int(high)
+        ranges.append((min(low, high), max(low, high)))
+    return lambda number: any(low <= number <= high for low, high in ranges)
@@ -0,0 +1,213 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import config
+from mail_tool import MailTool
+from benchmarks.fake_imap_server import FakeImapServer, serve_in_process
+from benchmarks.synthetic_mailbox import generate_messages
+
+results_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+baseline_path = os.path.join(results_directory, 'baseline.json')
+owner = "owner@example.com"
+folders = {'sent': 'Sent', 'recieved': 'INBOX'}
+period = (datetime(2020, 1, 1), datetime(2021, 1, 1))
+
+# a scenario is a synthetic mailbox, the latency of the server serving it and the MailTool setup:
+# 'sent' and 'recieved' are message counts, scaled by --scale; 'mailbox' are generate_messages
+# options, 'config' are config values set while the scenario runs and 'backend' the MailTool backend
+scenarios = {
+    'small': {'sent': 1000, 'recieved': 500, 'latency': 0.002, 'connections': 1, 'cache': False},
+    'latency': {'sent': 2000, 'recieved': 1000, 'latency': 0.02, 'connections': 4, 'cache': False,
+                'config': {'fetch_batch_size': 200}},
+    'mime': {'sent': 1000, 'recieved': 500, 'latency': 0.002, 'connections': 2, 'cache': False,
+             'mailbox': {'recipients': [1, 8], 'body_words': [20, 2000], 'attachment_bytes': 50000,
+                         'attachment_ratio': 0.3, 'encoded_ratio': 0.3}},
+    'cached': {'sent': 2000, 'recieved': 1000, 'latency': 0.002, 'connections': 2, 'cache': True},
+}
+
+# name: MailTool method and its arguments
+analyses = {
+    'hourly': ('count_sent_messages_hourly', (datetime(2020, 3, 5),)),
+    'daily': ('count_sent_messages_daily', (datetime(2020, 3, 1),)),
+    'monthly': ('count_sent_messages_monthly', (datetime(2020, 1, 1),)),
+    'weekly': ('count_sent_messages', (*period, 'week')),
+    'heatmap': ('get_sent_messages_heatmap', period),
+    'domains': ('count_sent_messages_by_domain', period),
+    'keywords': ('count_most_used_keywords', period),
+    'contacts': ('get_contact_interaction_weights', period),
+    'analyze': ('analyze', (*period, ['monthly', 'heatmap', 'domains', 'keywords', 'contacts'])),
+}
+
+
+def run_scenario(scenario, scale, repeats, separate_process):
+    options = scenario.get('mailbox', {})
+    size = lambda folder: max(1, int(scenario[folder] * scale))
+    mailboxes = {folders['sent']: generate_messages(size('sent'), owner, seed=1, **options),
+                 folders['recieved']: generate_messages(size('recieved'), owner, seed=2, incoming=True, **options)}
+    mailbox_bytes = sum(len(message) for messages in mailboxes.values() for message in messages)
+    if separate_process:
+        process, address = serve_in_process(mailboxes, scenario['latency'])
+    else:
+        server = FakeImapServer(mailboxes, scenario['latency'])
+        address = server.start()
+    saved_config = {name: getattr(config, name) for name in scenario.get('config', {})}
+    cache_directory = tempfile.mkdtemp() if scenario['cache'] else None
+    try:
+        for name, value in scenario.get('config', {}).items():
+            setattr(config, name, value)
+        cache_path = os.path.join(cache_directory, 'cache.db') if cache_directory else ''
+        tool = MailTool(cache_path=cache_path, connections=scenario['connections'], folders=folders,
+                        backend=scenario.get('backend'))
+        results = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            tool.connect(owner, "password", address[0], address[1], use_ssl=False)
+            for name, (method, arguments) in analyses.items():
+                # the first run is cold: it fills the cache, or the server's parsed messages
+                runs = []
+                for repeat in range(repeats + 1):
+                    getattr(tool, method)(*arguments)
+                    runs.append(tool.run_reports[-1])
+                results[name] = summarize(runs)
+            tool.disconnect()
+        if tool.cache:
+            tool.cache.close()
+    finally:
+        for name, value in saved_config.items():
+            setattr(config, name, value)
+        if cache_directory:
+            shutil.rmtree(cache_directory)
+        if separate_process:
+            process.terminate()
+        else:
+            server.stop()
+    return {'settings': {**scenario, 'scale': scale, 'repeats': repeats},
+            'messages': {folder: len(messages) for folder, messages in mailboxes.items()},
+            'mailbox_bytes': mailbox_bytes, 'analyses': results}
+
+
+def summarize(runs):
+    # the median of the warm runs is compared, the stages are those of the fastest warm run
+    warm = runs[1:] or runs
+    fastest = min(warm, key=lambda report: report['seconds'])
+    return {'seconds': statistics.median(report['seconds'] for report in warm),
+            'min_seconds': fastest['seconds'], 'cold_seconds': runs[0]['seconds'],
+            'bytes_fetched': fastest['bytes_fetched'], 'stages': fastest['stages'],
+            'counters': fastest['counters']}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def compare(results, baseline, threshold, min_difference):
+    # analyses and stages slower than the baseline by more than threshold (a fraction) and more than
+    # min_difference seconds are regressions; returns how many analyses regressed
+    regressions = 0
+    print(f"\ncompared with {baseline['environment']['commit']} of {baseline['environment']['started']}")
+    for scenario, result in results['scenarios'].items():
+        if scenario not in baseline['scenarios']:
+            continue
+        if result['settings'] != baseline['scenarios'][scenario]['settings']:
+            print(f"{scenario}: settings differ from the baseline, not compared")
+            continue
+        for analysis, current in result['analyses'].items():
+            previous = baseline['scenarios'][scenario]['analyses'].get(analysis)
+            if previous is None:
+                continue
+            verdict = judge(current['seconds'], previous['seconds'], threshold, min_difference)
+            print(f"{scenario:<10} {analysis:<10} {previous['seconds']:8.3f}s -> {current['seconds']:8.3f}s "
+                  f"{ratio(current['seconds'], previous['seconds']):6.2f}x {verdict}")
+            if verdict != 'regression':
+                continue
+            regressions += 1
+            for stage, values in current['stages'].items():
+                seconds = previous['stages'].get(stage, {}).get('seconds', 0.0)
+                if judge(values['seconds'], seconds, threshold, min_difference) == 'regression':
+                    print(f"{'':<21} {stage:<30} {seconds:8.3f}s -> {values['seconds']:8.3f}s")
+    return regressions
+
+
+def judge(seconds, baseline_seconds, threshold, min_difference):
+    if abs(seconds - baseline_seconds) < min_difference:
+        return ''
+    if seconds > baseline_seconds * (1 + threshold):
+        return 'regression'
+    if seconds < baseline_seconds * (1 - threshold):
+        return 'faster'
+    return ''
+
+
+def ratio(seconds, baseline_seconds):
+    return seconds / baseline_seconds if baseline_seconds else float('inf')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every MailTool analysis on synthetic mailboxes served by a "
+                                                 "local IMAP server and compare the run with a stored baseline")
+    parser.add_argument("--scenario", action="append", choices=list(scenarios),
+                        help="run only these scenarios, all by default")
+    parser.add_argument("--scenarios", help="JSON file of scenarios to run instead of the built in ones")
+    parser.add_argument("--backend", choices=("imaplib", "asyncio"), help="mail backend of every scenario")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the message counts")
+    parser.add_argument("--repeats", type=int, default=3, help="warm runs of every analysis")
+    parser.add_argument("--separate-process", action="store_true",
+                        help="serve from a separate process instead of a thread of the benchmark")
+    parser.add_argument("--output", help=f"where to store the results, a timestamped file in {results_directory} by default")
+    parser.add_argument("--baseline", default=baseline_path, help="results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline as well")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown counted as a regression")
+    parser.add_argument("--min-difference", type=float, default=0.005, help="seconds below which differences are noise")
+    args = parser.parse_args()
+
+    selected = scenarios
+    if args.scenarios:
+        with open(args.scenarios) as file:
+            selected = json.load(file)
+    if args.scenario:
+        selected = {name: selected[name] for name in args.scenario}
+    if args.backend:
+        selected = {name: {**scenario, 'backend': args.backend} for name, scenario in selected.items()}
+    results = {'environment': environment(), 'scenarios': {}}
+    for name, scenario in selected.items():
+        result = run_scenario(scenario, args.scale, args.repeats, args.separate_process)
+        results['scenarios'][name] = result
+        print(f"{name}: {sum(result['messages'].values())} messages, {result['mailbox_bytes'] / 2 ** 20:.1f} MiB, "
+              f"latency {scenario['latency'] * 1000:g} ms, {scenario['connections']} connections"
+              f"{', cached' if scenario['cache'] else ''}{', ' + scenario['backend'] if scenario.get('backend') else ''}")
+        for analysis, values in result['analyses'].items():
+            print(f"  {analysis:<10} {values['seconds']:8.3f}s (cold {values['cold_seconds']:8.3f}s) "
+                  f"{values['bytes_fetched'] / 2 ** 20:8.2f} MiB")
+
+    os.makedirs(results_directory, exist_ok=True)
+    output = args.output or os.path.join(results_directory, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"results stored in {output}")
+    if args.save_baseline:
+        shutil.copyfile(output, baseline_path)
+        print(f"and as the baseline {baseline_path}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.threshold, args.min_difference):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
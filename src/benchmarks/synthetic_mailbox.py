@@ -0,0 +1,61 @@
+import random
+from datetime import datetime, timedelta
+from email.headerregistry import Address
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+words = ["forensic", "evidence", "invoice", "meeting", "report", "contract", "payment", "server",
+         "schedule", "project", "review", "budget", "deadline", "transfer", "account", "analysis"]
+encoded_words = ["izvještaj", "sastanak", "plaćanje", "ugovor", "dokaz", "račun", "čestitka", "Đorđe"]
+domains = ["example.com", "example.org", "mail.example.net", "corp.example.com"]
+names = ["Ana Petrović", "Đorđe Jovanović", "Milica Šarić", "Nikola Žarković", "Marko Ćosić", "Jelena Čolić"]
+
+
+def generate_messages(count, owner="owner@example.com", start=datetime(2020, 1, 1), days=365,
+                      recipients=3, body_words=80, seed=1, attachment_bytes=0, attachment_ratio=1.0,
+                      encoded_ratio=0.0, incoming=False):
+    # the same arguments always give the same messages. recipients and body_words are a number or
+    # a [low, high] range; attachment_ratio of the messages get a binary attachment of attachment_bytes;
+    # encoded_ratio of the messages have non-ASCII display names and subjects (RFC 2047 encoded words)
+    # and a quoted-printable ISO-8859-2 body. incoming messages are from a contact to the owner
+    rng = random.Random(seed)
+    contacts = [f"contact{i}@{domains[i % len(domains)]}" for i in range(200)]
+    step = timedelta(days=days) / max(count, 1)
+    messages = []
+    for i in range(count):
+        encoded = encoded_ratio and rng.random() < encoded_ratio
+        message = EmailMessage()
+        num_recipients = rng.randint(*recipients) if isinstance(recipients, (list, tuple)) else recipients
+        if incoming:
+            sender = rng.choice(contacts)
+            to = [owner] + rng.sample([contact for contact in contacts if contact != sender], num_recipients - 1)
+        else:
+            sender = owner
+            to = rng.sample(contacts, num_recipients)
+        if encoded:
+            message['From'] = display_address(rng.choice(names), sender)
+            message['To'] = [display_address(rng.choice(names), address) for address in to]
+        else:
+            message['From'] = sender
+            message['To'] = ", ".join(to)
+        if i % 3 == 0:
+            message['CC'] = rng.choice(contacts)
+        message['Subject'] = " ".join(rng.choices(encoded_words if encoded else words, k=4))
+        message['Date'] = format_datetime(start + step * i)
+        num_words = rng.randint(*body_words) if isinstance(body_words, (list, tuple)) else body_words
+        body = " ".join(rng.choices(words, k=num_words))
+        if encoded:
+            message.set_content(body + " " + " ".join(rng.choices(encoded_words[:-1], k=4)),
+                                charset='iso-8859-2', cte='quoted-printable')
+        else:
+            message.set_content(body)
+        if attachment_bytes and (attachment_ratio >= 1 or rng.random() < attachment_ratio):
+            message.add_attachment(rng.randbytes(attachment_bytes), maintype='application',
+                                   subtype='octet-stream', filename=f"evidence{i}.bin")
+        messages.append(message.as_bytes())
+    return messages
+
+
+def display_address(name, address):
+    username, domain = address.split('@')
+    return Address(name, username, domain)
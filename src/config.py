@@ -1,4 +1,32 @@
 mail_server = "imap.gmail.com"
 mail_port = 993
+mail_use_ssl = True
 sent_folder = "[Gmail]/&BB8EPgRBBDsEMARCBDU-"
-recieved_folder = "[Gmail]/&BBIEMAQ2BD0EPg-"
\ No newline at end of file
+recieved_folder = "[Gmail]/&BBIEMAQ2BD0EPg-"
+fetch_batch_size = 500
+cache_path = "message_cache.db"
+connections = 1
+connection_retries = 2
+ingest_workers = None
+ingest_batch_size = 500
+keyword_tokenizer = "regex"
+keyword_language = "english"
+keyword_remove_stopwords = False
+keyword_lowercase = False
+keyword_ngrams = (1, 1)
+keyword_top_k = None
+keyword_workers = 1
+keyword_batch_size = 200
+batch_workers = 4
+batch_cache_path = "cache/{email}.db"
+server_side_counts = False
+body_max_bytes = 262144
+body_charsets = ('utf-8', 'cp1252', 'latin-1')
+profiler = None
+profile_interval = 0.005
+profile_top = 30
+profile_path = None
+mail_backend = "imaplib"
+pipeline_depth = 4
+parse_workers = 2
+process_start_method = "spawn"
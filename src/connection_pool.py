@@ -0,0 +1,166 @@
+import imaplib
+import math
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import config
+from instrumentation import Metrics
+from message_record import AddressBook
+from mail_service import MailService, MessageStream
+
+
+class MailServicePool:
+    def __init__(self, size=None, service_factory=MailService):
+        self.size = size or config.connections
+        self.__service_factory = service_factory
+        self.__server = None
+        self.__credentials = None
+        self.__sessions = queue.Queue()
+        self.__services = []
+        self.__retired_bytes = 0
+        self.__retired_stats = Counter()
+        self.__lock = threading.Lock()
+        self.__executor = None
+        # shared with every session, so their stages add up in one place and their messages share addresses
+        self.metrics = Metrics()
+        self.address_book = AddressBook()
+
+    @property
+    def bytes_fetched(self):
+        with self.__lock:
+            return self.__retired_bytes + sum(service.bytes_fetched for service in self.__services)
+
+    @property
+    def parse_stats(self):
+        with self.__lock:
+            return sum((service.parse_stats for service in self.__services), Counter(self.__retired_stats))
+
+    def connect(self, server=None, port=None, use_ssl=None):
+        self.__server = (server, port, use_ssl)
+
+    def authenticate(self, username, password):
+        self.__credentials = (username, password)
+        self.__executor = ThreadPoolExecutor(self.size)
+        for service in self.__executor.map(lambda _: self.__open_session(), range(self.size)):
+            self.__sessions.put(service)
+
+    def logout(self):
+        self.__executor.shutdown()
+        while not self.__sessions.empty():
+            service = self.__sessions.get()
+            if service is not None:
+                self.__retire(service)
+
+    def get_uidvalidity(self, folder):
+        return self.__run(folder, lambda service: service.get_uidvalidity())
+
+    def search_uids_since(self, folder, last_uid):
+        return self.__run(folder, lambda service: service.search_uids_since(last_uid))
+
+    def search_uids(self, folder, period_start=None, period_end=None, filters=None):
+        return self.__run(folder, lambda service: service.search_uids(period_start, period_end, filters))
+
+    def count_messages(self, folder, periods, filters=None):
+        # one SEARCH per (start, end) period, spread over the sessions
+        count = lambda period: self.__run(folder, lambda service: service.count_messages(*period, filters))
+        return list(self.__executor.map(count, periods))
+
+    def iter_message_info_for_period(self, folder, period_start, period_end, fields=None):
+        uids = self.search_uids(folder, period_start, period_end)
+        return self.iter_message_info_for_uids(folder, uids, fields)
+
+    def iter_message_info_for_uids(self, folder, uids, fields=None):
+        return MessageStream(self.iter_uid_batches(folder, uids, fields), len(uids))
+
+    def iter_uid_batches(self, folder, uids, fields=None):
+        # fetching starts right away so several folders opened one after another download in parallel;
+        # batches come back in UID order no matter which session fetched them
+        batch_size = max(1, min(config.fetch_batch_size, math.ceil(len(uids) / self.size)))
+        batches = [uids[i:i + batch_size] for i in range(0, len(uids), batch_size)]
+        fetch = lambda batch: (batch, self.__run(folder, lambda service: service.get_message_info_for_uids(batch, fields=fields)))
+        return PrefetchingIterator(self.__executor, fetch, batches, 2 * self.size)
+
+    def __run(self, folder, operation):
+        for attempt in range(config.connection_retries + 1):
+            service = self.__sessions.get()
+            try:
+                if service is None:
+                    self.metrics.count('reconnects')
+                    service = self.__open_session()
+                if service.selected_mailbox != folder:
+                    service.select_mailbox(folder)
+                return operation(service)
+            except (imaplib.IMAP4.abort, OSError) as error:
+                print(f"Connection failed ({error}), reconnecting")
+                self.metrics.count('connection_errors')
+                if service is not None:
+                    self.__retire(service)
+                service = None
+                if attempt == config.connection_retries:
+                    raise
+                self.metrics.count('retries')
+            finally:
+                self.__sessions.put(service)
+
+    def __open_session(self):
+        service = self.__service_factory()
+        service.metrics = self.metrics
+        service.address_book = self.address_book
+        service.connect(*self.__server)
+        service.authenticate(*self.__credentials)
+        with self.__lock:
+            self.__services.append(service)
+        return service
+
+    def __retire(self, service):
+        with self.__lock:
+            self.__services.remove(service)
+            self.__retired_bytes += service.bytes_fetched
+            self.__retired_stats.update(service.parse_stats)
+        try:
+            service.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+
+class PrefetchingIterator:
+    def __init__(self, executor, function, items, window, on_result=None):
+        # on_result, when given, turns every result into the item yielded, on the consuming thread
+        self.__on_result = on_result
+        self.__closed = False
+        self.__futures = queue.Queue()
+        self.__slots = threading.Semaphore(window)
+        self.__submitter = threading.Thread(target=self.__submit, args=(executor, function, items), daemon=True)
+        self.__submitter.start()
+
+    def __iter__(self):
+        while True:
+            future = self.__futures.get()
+            if future is None:
+                return
+            try:
+                result = future.result()
+                yield result if self.__on_result is None else self.__on_result(result)
+            finally:
+                self.__slots.release()
+
+    def close(self):
+        # no more items are submitted and queued ones that did not start are cancelled
+        self.__closed = True
+        self.__slots.release()
+        while True:
+            try:
+                future = self.__futures.get_nowait()
+            except queue.Empty:
+                return
+            if future is not None:
+                future.cancel()
+
+    def __submit(self, executor, function, items):
+        for item in items:
+            self.__slots.acquire()
+            if self.__closed:
+                break
+            self.__futures.put(executor.submit(function, item))
+        self.__futures.put(None)
@@ -0,0 +1,169 @@
+import time
+from datetime import datetime
+import numpy as np
+
+roles = ('From-Me', 'From-Me-Cc', 'From-Me-Bcc', 'To-Me', 'To-Me-Cc', 'To-Me-Bcc', 'To-Me-Groups')
+day_seconds = 86400
+
+
+def message_roles(folder, message, email):
+    # (contact, role) pairs of one message; folder is 'sent' or 'recieved'
+    if folder == 'sent':
+        pairs = [(recipient, 0) for recipient in message.recievers]
+        if message.cc:
+            pairs.extend((recipient, 1) for recipient in message.cc)
+        if message.bcc:
+            pairs.extend((recipient, 2) for recipient in message.bcc)
+        return pairs
+    # the owner's address is compared by id, None when no message had it
+    email_id = message.address_book.find_id(email)
+    if email_id is not None and email_id in message.reciever_ids:
+        role = 3
+    elif email_id is not None and message.cc_ids is not None and email_id in message.cc_ids:
+        role = 4
+    elif email_id is not None and message.bcc_ids is not None and email_id in message.bcc_ids:
+        role = 5
+    else:
+        role = 6
+    return [(message.sender, role)]
+
+
+def daily_contact_rows(folder, messages, email):
+    # per (contact, local day, role) count, first and last timestamp of a batch of messages,
+    # the rows MessageCache keeps its persistent contact index in
+    rows = {}
+    for message in messages:
+        timestamp = message.timestamp
+        day = message.date.toordinal()
+        for contact, role in message_roles(folder, message, email):
+            row = rows.get((contact, day, role))
+            if row is None:
+                rows[(contact, day, role)] = [1, timestamp, timestamp]
+            else:
+                row[0] += 1
+                row[1] = min(row[1], timestamp)
+                row[2] = max(row[2], timestamp)
+    return [(contact, day, role, count, first, last) for (contact, day, role), (count, first, last) in rows.items()]
+
+
+class ContactIndex:
+    # per contact and role: message count and first/last contact as epoch seconds, one row per contact
+    def __init__(self):
+        self.contacts = []
+        self.__rows = {}
+        self.__counts = np.zeros((16, len(roles)), dtype=np.int64)
+        self.__first = np.full((16, len(roles)), np.inf)
+        self.__last = np.full((16, len(roles)), -np.inf)
+
+    def __len__(self):
+        return len(self.contacts)
+
+    @property
+    def counts(self):
+        return self.__counts[:len(self.contacts)]
+
+    @property
+    def first(self):
+        return self.__first[:len(self.contacts)]
+
+    @property
+    def last(self):
+        return self.__last[:len(self.contacts)]
+
+    @classmethod
+    def from_rows(cls, rows):
+        # rows of (contact, role, count, first, last)
+        index = cls()
+        if rows:
+            contacts, role_ids, counts, first, last = zip(*rows)
+            index.__merge_arrays(contacts, np.array(role_ids), np.array(counts), np.array(first), np.array(last))
+        return index
+
+    def add_message(self, folder, message, email):
+        timestamp = message.timestamp
+        for contact, role in message_roles(folder, message, email):
+            self.add(contact, role, timestamp)
+
+    def add(self, contact, role, timestamp):
+        row = self.__get_row(contact)
+        self.__counts[row, role] += 1
+        if timestamp < self.__first[row, role]:
+            self.__first[row, role] = timestamp
+        if timestamp > self.__last[row, role]:
+            self.__last[row, role] = timestamp
+
+    def merge(self, other):
+        # adds the aggregates of another index, e.g. the one of an adjacent period
+        contacts = [contact for contact in other.contacts for role in roles]
+        role_ids = np.tile(np.arange(len(roles)), len(other))
+        self.__merge_arrays(contacts, role_ids, other.counts.reshape(-1), other.first.reshape(-1), other.last.reshape(-1))
+        return self
+
+    def __merge_arrays(self, contacts, role_ids, counts, first, last):
+        rows = np.array([self.__get_row(contact) for contact in contacts], dtype=np.int64)
+        np.add.at(self.__counts, (rows, role_ids), counts)
+        np.minimum.at(self.__first, (rows, role_ids), first)
+        np.maximum.at(self.__last, (rows, role_ids), last)
+
+    def __get_row(self, contact):
+        row = self.__rows.get(contact)
+        if row is None:
+            row = len(self.contacts)
+            if row == len(self.__counts):
+                self.__grow()
+            self.__rows[contact] = row
+            self.contacts.append(contact)
+        return row
+
+    def __grow(self):
+        size = len(self.__counts)
+        self.__counts = np.concatenate([self.__counts, np.zeros_like(self.__counts)])
+        self.__first = np.concatenate([self.__first, np.full((size, len(roles)), np.inf)])
+        self.__last = np.concatenate([self.__last, np.full((size, len(roles)), -np.inf)])
+
+
+def contact_weights(index, now=None):
+    # scores every contact at once; returns {contact: weight}, highest weight first
+    if len(index) == 0:
+        return {}
+    now = time.time() if now is None else now
+    counts = index.counts.astype(np.float64)
+    num_sent = counts[:, 0:3].sum(axis=1)
+    num_recieved = counts[:, 3:7].sum(axis=1)
+    num_from_me = counts[:, 0]
+    num_to_me = counts[:, 3]
+    num_total = num_sent + num_recieved
+    num_sec = num_total - num_to_me - num_from_me
+    first_contact = index.first.min(axis=1)
+    last_contact = index.last.max(axis=1)
+
+    length = np.floor((last_contact - first_contact) / day_seconds)
+    length = np.where(length > 0, length, 1)
+    recen = np.floor((now - last_contact) / day_seconds)
+    sent_freq = num_sent / length
+    recv_freq = num_recieved / length
+    recip = 1 - np.abs(num_recieved - num_sent) / num_total
+
+    most_infl = recip + num_from_me / num_total + normalize(sent_freq)
+    medium_infl = normalize(recv_freq) + num_to_me / num_total
+    less_infl = normalize(recen) + num_sec / num_total
+    weights = most_infl + 0.5 * medium_infl + 0.3 * less_infl
+
+    order = np.argsort(-weights, kind='stable')
+    return dict(zip([index.contacts[i] for i in order], weights[order].tolist()))
+
+
+def normalize(values):
+    # min-max scaling to [0, 1]; when every contact has the same value there is nothing to rank, all get 0
+    value_range = values.max() - values.min()
+    if value_range == 0:
+        return np.zeros_like(values)
+    return (values - values.min()) / value_range
+
+
+def period_days(period_start, period_end):
+    # the whole local days [first, last) inside the period as ordinals
+    first = period_start.toordinal()
+    if period_start != datetime.fromordinal(first):
+        first += 1
+    return first, max(period_end.toordinal(), first)
@@ -0,0 +1,231 @@
+import hashlib
+import mmap
+import multiprocessing
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import config
+from connection_pool import PrefetchingIterator
+from instrumentation import Metrics
+from message_record import AddressBook, MessageRecord
+from mail_service import header_fields, all_fields, needs_body, MessageStream
+from message_parser import parse_message
+from search_query import message_matches
+
+escaped_from_pattern = re.compile(rb'\n>(>*From )')
+
+
+class FileMailSource:
+    # reads exported evidence instead of a live mailbox: every folder is an mbox file,
+    # a Maildir or a directory of .eml files, and a message's UID is its position in it
+    def __init__(self, sent=None, recieved=None, folders=None, workers=None):
+        self.__folders = dict(folders or {})
+        if sent:
+            self.__folders[config.sent_folder] = sent
+        if recieved:
+            self.__folders[config.recieved_folder] = recieved
+        self.__workers = workers or config.ingest_workers
+        self.__executor = None
+        self.__spans = {}
+        self.bytes_fetched = 0
+        self.parse_stats = Counter()
+        self.metrics = Metrics()
+        self.address_book = AddressBook()
+
+    def connect(self, server=None, port=None, use_ssl=None):
+        # messages are parsed on worker processes started with config.process_start_method; with spawn
+        # they import the main module again, so scripts need an if __name__ == '__main__' guard
+        self.__executor = ProcessPoolExecutor(self.__workers,
+                                              mp_context=multiprocessing.get_context(config.process_start_method))
+
+    def authenticate(self, username, password):
+        pass
+
+    def logout(self):
+        self.__executor.shutdown()
+
+    def list_folders(self):
+        return list(self.__folders)
+
+    def get_uidvalidity(self, folder):
+        # UIDs are positions in the sorted list of messages, so the folder is scanned again and any
+        # added, removed, renamed or modified file gives a new value, which drops the cached UIDs
+        self.__spans.pop(folder, None)
+        files = dict.fromkeys(path for path, offset, length in self.__get_spans(folder))
+        state = []
+        for path in files:
+            stat = os.stat(path)
+            state.append((path, stat.st_size, stat.st_mtime_ns))
+        return int.from_bytes(hashlib.sha256(repr(state).encode()).digest()[:7], 'big')
+
+    def search_uids_since(self, folder, last_uid):
+        return list(range(last_uid + 1, len(self.__get_spans(folder)) + 1))
+
+    def search_uids(self, folder, period_start=None, period_end=None, filters=None):
+        # there is no server to search, the filters are applied to the parsed messages;
+        # sizes are those of the stored messages, see message_sizes; flags are not kept in exports
+        filters = filters or {}
+        if filters.get('flags'):
+            raise ValueError("Flags can not be searched in mailbox exports")
+        spans = self.__get_spans(folder)
+        larger, smaller = filters.get('larger'), filters.get('smaller')
+        uids = list(range(1, len(spans) + 1))
+        if larger is not None or smaller is not None:
+            uids = [uid for uid, size in zip(uids, message_sizes(spans))
+                    if (larger is None or size > larger) and (smaller is None or size < smaller)]
+        fields = all_fields if filters.get('body') or filters.get('text') else header_fields
+        start = period_start.timestamp() if period_start else float('-inf')
+        end = period_end.timestamp() if period_end else float('inf')
+        return [message.uid for message in self.iter_message_info_for_uids(folder, uids, fields)
+                if start <= message.timestamp < end and message_matches(message, filters)]
+
+    def iter_message_info_for_period(self, folder, period_start, period_end, fields=None):
+        # every message is parsed to find its date, so the number in the period is not known up front
+        uids = self.search_uids_since(folder, 0)
+        start, end = period_start.timestamp(), period_end.timestamp()
+        return MessageStream(self.iter_uid_batches(folder, uids, fields),
+                             keep=lambda message: start <= message.timestamp < end)
+
+    def iter_message_info_for_uids(self, folder, uids, fields=None):
+        return MessageStream(self.iter_uid_batches(folder, uids, fields), len(uids))
+
+    def iter_uid_batches(self, folder, uids, fields=None):
+        spans = self.__get_spans(folder)
+        with_body = needs_body(fields)
+        batches = []
+        for i in range(0, len(uids), config.ingest_batch_size):
+            batch = uids[i:i + config.ingest_batch_size]
+            batch_spans = [spans[uid - 1] for uid in batch]
+            self.bytes_fetched += sum(length for path, offset, length in batch_spans)
+            batches.append((batch, batch_spans, with_body))
+        return PrefetchingIterator(self.__executor, parse_batch, batches, 2 * (self.__workers or os.cpu_count()),
+                                   self.__add_stats)
+
+    def __add_stats(self, result):
+        # the worker's time is reported as it comes back, summed over the workers
+        # the records come as addresses, interned in the source's address book
+        uids, message_fields, stats, read_seconds, parse_seconds, num_bytes = result
+        self.parse_stats.update(stats)
+        self.metrics.add('read', read_seconds, len(uids), num_bytes)
+        self.metrics.add('parse messages', parse_seconds, len(uids))
+        return uids, [MessageRecord.from_addresses(*fields, address_book=self.address_book) for fields in message_fields]
+
+    def __get_spans(self, folder):
+        path = self.__folders[folder]
+        if folder not in self.__spans:
+            if os.path.isdir(os.path.join(path, 'cur')) or os.path.isdir(os.path.join(path, 'new')):
+                self.__spans[folder] = self.__find_maildir_messages(path)
+            elif os.path.isdir(path):
+                self.__spans[folder] = self.__find_eml_files(path)
+            elif path.lower().endswith('.eml'):
+                self.__spans[folder] = [(path, 0, os.path.getsize(path))]
+            else:
+                self.__spans[folder] = find_mbox_messages(path)
+        return self.__spans[folder]
+
+    def __find_maildir_messages(self, path):
+        files = []
+        for subdirectory in ('cur', 'new'):
+            directory = os.path.join(path, subdirectory)
+            if os.path.isdir(directory):
+                files.extend(os.path.join(directory, name) for name in os.listdir(directory))
+        return [(file, 0, os.path.getsize(file)) for file in sorted(files)]
+
+    def __find_eml_files(self, path):
+        files = []
+        for directory, subdirectories, names in os.walk(path):
+            files.extend(os.path.join(directory, name) for name in names if name.lower().endswith('.eml'))
+        return [(file, 0, os.path.getsize(file)) for file in sorted(files)]
+
+
+def find_mbox_messages(path):
+    # scans the memory-mapped file for "From " separator lines without reading it into memory;
+    # returns (path, offset, length) of every message, separator line and the blank line before
+    # the next one excluded
+    spans = []
+    if os.path.getsize(path) == 0:
+        return spans
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        separator = 0 if mapped[:5] == b'From ' else mapped.find(b'\nFrom ')
+        while separator != -1:
+            start = mapped.find(b'\n', separator + 1)
+            if start == -1:
+                break
+            start += 1
+            next_separator = mapped.find(b'\nFrom ', start - 1)
+            end = next_separator + 1 if next_separator != -1 else len(mapped)
+            if end - start >= 2 and mapped[end - 2:end] == b'\n\n':
+                end -= 1
+            spans.append((path, start, end - start))
+            separator = next_separator
+    return spans
+
+
+def message_sizes(spans):
+    # sizes of the messages as a server stores them, i.e. of mbox messages once ">From " is unescaped
+    sizes = []
+    mapped_files = {}
+    try:
+        for path, offset, length in spans:
+            if offset == 0:
+                sizes.append(length)
+                continue
+            if path not in mapped_files:
+                with open(path, 'rb') as file:
+                    mapped_files[path] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            escapes = len(escaped_from_pattern.findall(mapped_files[path][offset:offset + length]))
+            sizes.append(length - escapes)
+    finally:
+        for mapped in mapped_files.values():
+            mapped.close()
+    return sizes
+
+
+def header_length(raw):
+    for separator in (b'\r\n\r\n', b'\n\n'):
+        position = raw.find(separator)
+        if position != -1:
+            return position + len(separator)
+    return len(raw)
+
+
+def parse_batch(batch):
+    # runs in a worker process; only offsets cross the process boundary, mbox files are mapped by the worker,
+    # and the records go back as their fields
+    uids, spans, with_body = batch
+    address_book = AddressBook()
+    message_fields = []
+    stats = Counter()
+    read_seconds = parse_seconds = 0
+    num_bytes = 0
+    mapped_files = {}
+    try:
+        for uid, (path, offset, length) in zip(uids, spans):
+            started = time.perf_counter()
+            if offset == 0:
+                with open(path, 'rb') as file:
+                    raw = file.read()
+            else:
+                if path not in mapped_files:
+                    with open(path, 'rb') as file:
+                        mapped_files[path] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                raw = escaped_from_pattern.sub(rb'\n\1', mapped_files[path][offset:offset + length])
+            if not with_body:
+                raw = raw[:header_length(raw)]
+            num_bytes += len(raw)
+            parse_started = time.perf_counter()
+            read_seconds += parse_started - started
+            try:
+                info = parse_message(raw, with_body, uid, stats, address_book)
+            except Exception:
+                stats['header_errors'] += 1
+                info = None
+            parse_seconds += time.perf_counter() - parse_started
+            if info is not None:
+                message_fields.append(info.fields())
+    finally:
+        for mapped in mapped_files.values():
+            mapped.close()
+    return uids, message_fields, stats, read_seconds, parse_seconds, num_bytes
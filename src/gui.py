@@ -1,14 +1,15 @@
 import math
+import threading
 import PySimpleGUI as sg
 from datetime import datetime
 from mail_tool import MailTool
+from analysis_engine import Progress, AnalysisCancelled
 import matplotlib.pyplot as plt
 
 truncate_limit = 30
 
 def slice_dict(dict):
     items = {k: dict[k] for k in list(dict)[:truncate_limit]}
-    print(items)
     return items
 
 def print_dict(dict):
@@ -16,80 +17,149 @@ def print_dict(dict):
         print(key, dict[key])
 
 def draw_bar_chart(dict, title):
+    # redraws the figure of the analysis, so partial results replace each other
     plt.style.use('ggplot')
+    plt.ion()
+    plt.figure(title)
+    plt.clf()
 
     labels = dict.keys()
     values = dict.values()
+    if not values:
+        return
 
     x_pos = [i for i, _ in enumerate(labels)]
     y_pos = [i for i, _ in enumerate(range(0, math.ceil(max(values))+1, 1))]
-    plt.ion()
     plt.barh(x_pos, values, color='green', align='edge')
     plt.title(title)
     plt.yticks(x_pos, labels)
     plt.xticks(y_pos, y_pos)
     plt.tight_layout()
-    fig = plt.gcf()
     plt.show()
+    plt.pause(0.001)
+
+def format_progress(progress):
+    text = f"{progress.stage}: {progress.done}"
+    if progress.total is not None:
+        text += f"/{progress.total}"
+    text += f" messages, {progress.rate:.0f} msg/s, {progress.bytes_fetched / 1e6:.1f} MB"
+    if progress.eta is not None:
+        text += f", ETA {progress.eta:.0f}s"
+    return text
+
+def report_progress(progress):
+    # called on the worker thread; write_event_value hands the snapshot to the event loop
+    partial = progress.partial
+    progress.partial = None
+    if partial:
+        partial = next(iter(partial.values()))
+    window.write_event_value('-PROGRESS-', (format_progress(progress), progress.done, progress.total, partial))
+
+def run_analysis(title, analysis, *args):
+    try:
+        result = analysis(*args)
+        window.write_event_value('-DONE-', (title, result))
+    except AnalysisCancelled:
+        window.write_event_value('-CANCELLED-', title)
+    except Exception as error:
+        window.write_event_value('-ERROR-', (title, error))
+
+def get_analysis(event, values):
+    if event == "Count sent messages monthly":
+        year = datetime.strptime(values['CountMonthlyInput'], '%Y')
+        return tool.count_sent_messages_monthly, (year,)
+    if event == "Count sent messages daily":
+        month = datetime.strptime(values['CountDailyInput'], '%Y-%m')
+        return tool.count_sent_messages_daily, (month,)
+    if event == "Count sent messages hourly":
+        day = datetime.strptime(values['CountHourlyInput'], '%Y-%m-%d')
+        return tool.count_sent_messages_hourly, (day,)
+    if event == "Count sent messages by domain":
+        start = datetime.strptime(values['CountDomainStartInput'], '%Y-%m-%d')
+        end = datetime.strptime(values['CountDomainEndInput'], '%Y-%m-%d')
+        return tool.count_sent_messages_by_domain, (start, end)
+    if event == "Count most used keywords":
+        start = datetime.strptime(values['CountKeywordsStartInput'], '%Y-%m-%d')
+        end = datetime.strptime(values['CountKeywordsEndInput'], '%Y-%m-%d')
+        return tool.count_most_used_keywords, (start, end)
+    if event == "Get contact interactions":
+        start = datetime.strptime(values['ContactStartInput'], '%Y-%m-%d')
+        end = datetime.strptime(values['ContactEndInput'], '%Y-%m-%d')
+        return tool.get_contact_interaction_weights, (start, end)
+    return None, None
+
+chart_titles = {"Count sent messages monthly": "Count sent messages monthly",
+                "Count sent messages daily": "Count sent messages daily",
+                "Count sent messages hourly": "Count sent messages hourly",
+                "Count sent messages by domain": "Count sent messages by domain",
+                "Count most used keywords": "Count keywords in sent messages",
+                "Get contact interactions": "Contact interaction weights"}
+
+def set_running(running):
+    for button in chart_titles:
+        window[button].update(disabled=running)
+    window['Cancel'].update(disabled=not running)
+    if not running:
+        window['ProgressBar'].update(current_count=0)
 
-sg.theme('DarkAmber')
-layout = [[sg.InputText(key="CountMonthlyInput", default_text='yyyy'), sg.Button('Count sent messages monthly')],
-          [sg.InputText(key="CountDailyInput", default_text='yyyy-mm'), sg.Button('Count sent messages daily')],
-          [sg.InputText(key="CountHourlyInput", default_text='yyyy-mm-dd'), sg.Button('Count sent messages hourly')],
-          [sg.InputText(key="CountDomainStartInput", default_text='yyyy-mm-dd'), sg.InputText(key="CountDomainEndInput", default_text='yyyy-mm-dd'), sg.Button('Count sent messages by domain')],
-          [sg.InputText(key="CountKeywordsStartInput", default_text='yyyy-mm-dd'), sg.InputText(key="CountKeywordsEndInput", default_text='yyyy-mm-dd'), sg.Button('Count most used keywords')],
-          [sg.InputText(key="ContactStartInput", default_text='yyyy-mm-dd'), sg.InputText(key="ContactEndInput", default_text='yyyy-mm-dd'), sg.Button('Get contact interactions')]]
+# spawned worker processes (keywords, mailbox exports) import this module again, so the window
+# is only opened when it is run
+if __name__ == '__main__':
+    sg.theme('DarkAmber')
+    layout = [[sg.InputText(key="CountMonthlyInput", default_text='yyyy'), sg.Button('Count sent messages monthly')],
+              [sg.InputText(key="CountDailyInput", default_text='yyyy-mm'), sg.Button('Count sent messages daily')],
+              [sg.InputText(key="CountHourlyInput", default_text='yyyy-mm-dd'), sg.Button('Count sent messages hourly')],
+              [sg.InputText(key="CountDomainStartInput", default_text='yyyy-mm-dd'), sg.InputText(key="CountDomainEndInput", default_text='yyyy-mm-dd'), sg.Button('Count sent messages by domain')],
+              [sg.InputText(key="CountKeywordsStartInput", default_text='yyyy-mm-dd'), sg.InputText(key="CountKeywordsEndInput", default_text='yyyy-mm-dd'), sg.Button('Count most used keywords')],
+              [sg.InputText(key="ContactStartInput", default_text='yyyy-mm-dd'), sg.InputText(key="ContactEndInput", default_text='yyyy-mm-dd'), sg.Button('Get contact interactions')],
+              [sg.ProgressBar(1000, orientation='h', size=(40, 20), key='ProgressBar'), sg.Button('Cancel', disabled=True)],
+              [sg.Text('', key='Status', size=(80, 1))]]
 
-window = sg.Window('Email forensics tool', layout, force_toplevel=True, finalize=True)
-tool = MailTool()
-tool.connect()
+    window = sg.Window('Email forensics tool', layout, force_toplevel=True, finalize=True)
+    tool = MailTool(progress=Progress(report_progress))
+    tool.connect()
+    title = None
 
-while True:
-    event, values = window.read()
-    if event == sg.WIN_CLOSED:
-        break
-    else:
-        try:
-            if event == "Count sent messages monthly":
-                year = datetime.strptime(values['CountMonthlyInput'], '%Y')
-                dict = tool.count_sent_messages_monthly(year)
-                print_dict(dict)
-                dict = slice_dict(dict)
-                draw_bar_chart(dict, "Count sent messages monthly")
-            if event == "Count sent messages daily":
-                month = datetime.strptime(values['CountDailyInput'], '%Y-%m')
-                dict = tool.count_sent_messages_daily(month)
-                print_dict(dict)
-                dict = slice_dict(dict)
-                draw_bar_chart(dict, "Count sent messages daily")
-            if event == "Count sent messages hourly":
-                day = datetime.strptime(values['CountHourlyInput'], '%Y-%m-%d')
-                dict = tool.count_sent_messages_hourly(day)
-                print_dict(dict)
-                dict = slice_dict(dict)
-                draw_bar_chart(dict, "Count sent messages hourly")
-            if event == "Count sent messages by domain":
-                start = datetime.strptime(values['CountDomainStartInput'], '%Y-%m-%d')
-                end = datetime.strptime(values['CountDomainEndInput'], '%Y-%m-%d')
-                dict = tool.count_sent_messages_by_domain(start, end)
-                print_dict(dict)
-                dict = slice_dict(dict)
-                draw_bar_chart(dict, "Count sent messages by domain")
-            if event == "Count most used keywords":
-                start = datetime.strptime(values['CountKeywordsStartInput'], '%Y-%m-%d')
-                end = datetime.strptime(values['CountKeywordsEndInput'], '%Y-%m-%d')
-                dict = tool.count_most_used_keywords(start, end)
-                print_dict(dict)
-                dict = slice_dict(dict)
-                draw_bar_chart(dict, "Count keywords in sent messages")
-            if event == "Get contact interactions":
-                start = datetime.strptime(values['ContactStartInput'], '%Y-%m-%d')
-                end = datetime.strptime(values['ContactEndInput'], '%Y-%m-%d')
-                dict = tool.get_contact_interaction_weights(start, end)
-                print_dict(dict)
-                dict = slice_dict(dict)
-                draw_bar_chart(dict, "Contact interaction weights")
-        except:
-            print("Error")
-window.close()
-tool.disconnect()
\ No newline at end of file
+    while True:
+        event, values = window.read()
+        if event == sg.WIN_CLOSED:
+            tool.progress.cancel()
+            break
+        elif event == 'Cancel':
+            tool.progress.cancel()
+            window['Status'].update('Cancelling...')
+        elif event == '-PROGRESS-':
+            text, done, total, partial = values[event]
+            window['Status'].update(text)
+            if total:
+                window['ProgressBar'].update(current_count=int(1000 * done / total))
+            if partial:
+                draw_bar_chart(slice_dict(partial), title)
+        elif event == '-DONE-':
+            title, dict = values[event]
+            print_dict(dict)
+            draw_bar_chart(slice_dict(dict), title)
+            window['Status'].update(f"{title}: done")
+            set_running(False)
+        elif event == '-CANCELLED-':
+            window['Status'].update(f"{values[event]}: cancelled")
+            set_running(False)
+        elif event == '-ERROR-':
+            failed_title, error = values[event]
+            print("Error", error)
+            window['Status'].update(f"{failed_title}: error {error}")
+            set_running(False)
+        else:
+            try:
+                analysis, args = get_analysis(event, values)
+            except ValueError:
+                print("Error")
+                continue
+            if analysis:
+                # one analysis at a time, on a worker thread so the window stays responsive
+                title = chart_titles[event]
+                tool.progress.reset()
+                set_running(True)
+                threading.Thread(target=run_analysis, args=(title, analysis) + args, daemon=True).start()
+    window.close()
+    tool.disconnect()
@@ -0,0 +1,74 @@
+import itertools
+import re
+
+token_pattern = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|\{\d+\}$|[^\s()"\[]+(?:\[[^\]]*\](?:<\d+>)?)?')
+escape_pattern = re.compile(rb'\\(.)')
+
+
+def iter_fetch_items(data):
+    # imaplib returns a FETCH response as bytes and (bytes, literal) tuples, the bytes before a
+    # literal ending in {n}; yields an {item name: value} dict per message, with lists for
+    # parenthesized values, bytes for strings and literals and None for NIL
+    stack = [[]]
+    for element in data:
+        if element is None:
+            continue
+        head, literal = element if isinstance(element, tuple) else (element, None)
+        for token in token_pattern.findall(head):
+            if token == b'(':
+                stack.append([])
+            elif token == b')':
+                if len(stack) == 1:
+                    continue
+                value = stack.pop()
+                stack[-1].append(value)
+                if len(stack) == 1:
+                    yield fetch_items(value)
+                    stack[0].clear()
+            elif token.startswith(b'{'):
+                stack[-1].append(literal)
+            elif token.startswith(b'"'):
+                stack[-1].append(escape_pattern.sub(rb'\1', token[1:-1]))
+            elif token.upper() == b'NIL':
+                stack[-1].append(None)
+            else:
+                stack[-1].append(token)
+
+
+def fetch_items(values):
+    return {values[i].decode('ascii', 'replace').upper(): values[i + 1] for i in range(0, len(values) - 1, 2)}
+
+
+def find_item(items, prefix):
+    # servers echo sections in their own spelling, e.g. BODY[1]<0> for BODY.PEEK[1]<0.100>
+    return next((value for name, value in items.items() if name.startswith(prefix)), None)
+
+
+def body_structure_parts(structure, section=''):
+    # (section, content type, charset, transfer encoding, size, disposition) of every leaf part
+    # of a BODYSTRUCTURE, numbered as BODY[section] expects; attached messages are leaves
+    if isinstance(structure[0], list):
+        parts = []
+        children = itertools.takewhile(lambda value: isinstance(value, list), structure)
+        for i, child in enumerate(children, 1):
+            parts.extend(body_structure_parts(child, f"{section}.{i}" if section else str(i)))
+        return parts
+    content_type = f"{text(structure[0])}/{text(structure[1])}".lower()
+    parameters = structure[2] or []
+    parameters = {text(parameters[i]).lower(): text(parameters[i + 1]) for i in range(0, len(parameters) - 1, 2)}
+    encoding = text(structure[5] or b'7bit').lower()
+    # the disposition follows the type specific fields and the MD5 of the extension data
+    if content_type.startswith('text/'):
+        disposition_index = 9
+    elif content_type == 'message/rfc822':
+        disposition_index = 11
+    else:
+        disposition_index = 8
+    disposition = None
+    if len(structure) > disposition_index and isinstance(structure[disposition_index], list):
+        disposition = text(structure[disposition_index][0]).lower()
+    return [(section or '1', content_type, parameters.get('charset'), encoding, int(structure[6]), disposition)]
+
+
+def text(value):
+    return '' if value is None else value.decode('utf-8', 'replace')
@@ -0,0 +1,205 @@
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+import config
+
+stage_fields = ('calls', 'seconds', 'items', 'bytes', 'errors')
+prometheus_prefix = 'email_forensics_'
+prometheus_metrics = {
+    'run_seconds': ('gauge', 'Wall time of the analysis run'),
+    'bytes_fetched': ('gauge', 'Bytes downloaded by the analysis run'),
+    'stage_calls_total': ('counter', 'Times the stage ran'),
+    'stage_seconds_total': ('counter', 'Seconds spent in the stage, summed over threads'),
+    'stage_items_total': ('counter', 'Messages the stage handled'),
+    'stage_bytes_total': ('counter', 'Bytes the stage transferred'),
+    'stage_errors_total': ('counter', 'Times the stage failed'),
+    'events_total': ('counter', 'Retries, reconnects and message parse problems'),
+}
+
+
+class StageTiming:
+    __slots__ = ('items', 'bytes', 'errors')
+
+    def __init__(self, items=0):
+        self.items = items
+        self.bytes = 0
+        self.errors = 0
+
+
+class Metrics:
+    # per stage: calls, wall time, messages, bytes and failures, plus named event counters
+    # (retries, reconnects); shared by a MailTool and its source and safe to use from any thread.
+    # Stages nest, e.g. "fetch" runs inside "sync", and are timed per batch, not per message
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__stages = {}
+            self.__counters = Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, items=0):
+        # times the block; items, bytes and errors can be updated on the StageTiming it yields
+        timing = StageTiming(items)
+        started = time.perf_counter()
+        try:
+            yield timing
+        except Exception:
+            timing.errors += 1
+            raise
+        finally:
+            self.add(name, time.perf_counter() - started, timing.items, timing.bytes, timing.errors)
+
+    def add(self, name, seconds, items=0, num_bytes=0, errors=0, calls=1):
+        with self.__lock:
+            stage = self.__stages.get(name)
+            if stage is None:
+                stage = self.__stages[name] = [0, 0.0, 0, 0, 0]
+            stage[0] += calls
+            stage[1] += seconds
+            stage[2] += items
+            stage[3] += num_bytes
+            stage[4] += errors
+
+    def count(self, name, value=1):
+        with self.__lock:
+            self.__counters[name] += value
+
+    def snapshot(self):
+        with self.__lock:
+            stages = {name: dict(zip(stage_fields, values)) for name, values in self.__stages.items()}
+            return stages, dict(self.__counters)
+
+
+class CProfiler:
+    # deterministic profile of the thread running the analysis; pool and worker threads are not
+    # seen, use the sampling profiler for those
+    def __init__(self):
+        self.__profile = cProfile.Profile()
+
+    def start(self):
+        self.__profile.enable()
+
+    def stop(self, name):
+        self.__profile.disable()
+        if config.profile_path:
+            os.makedirs(config.profile_path, exist_ok=True)
+            self.__profile.dump_stats(os.path.join(config.profile_path, f"{name}-{int(time.time())}.prof"))
+        rows = [(function_name(*function), calls, own, cumulative)
+                for function, (primitive_calls, calls, own, cumulative, callers)
+                in pstats.Stats(self.__profile).stats.items()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return [{'function': function, 'calls': calls, 'own_seconds': own, 'cumulative_seconds': cumulative}
+                for function, calls, own, cumulative in rows[:config.profile_top]]
+
+
+class SamplingProfiler:
+    # samples the stacks of every thread each interval seconds from a thread of its own; the
+    # profiled code is not slowed down beyond the GIL the sampler takes while it looks
+    def __init__(self, interval=None):
+        self.interval = interval or config.profile_interval
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+        self.__own = Counter()
+        self.__cumulative = Counter()
+        self.samples = 0
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self, name):
+        self.__stopped.set()
+        self.__thread.join()
+        return [{'function': function, 'own_samples': samples, 'cumulative_samples': self.__cumulative[function]}
+                for function, samples in self.__own.most_common(config.profile_top)]
+
+    def __sample(self):
+        while not self.__stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.__thread.ident:
+                    continue
+                seen = set()
+                key = function_name(frame.f_code.co_filename, frame.f_code.co_firstlineno, frame.f_code.co_name)
+                self.__own[key] += 1
+                while frame is not None:
+                    code = frame.f_code
+                    key = function_name(code.co_filename, code.co_firstlineno, code.co_name)
+                    if key not in seen:
+                        seen.add(key)
+                        self.__cumulative[key] += 1
+                    frame = frame.f_back
+            self.samples += 1
+
+
+def create_profiler(kind):
+    # kind is config.profiler: None, 'cprofile' or 'sampling'
+    if kind is None:
+        return None
+    if kind == 'cprofile':
+        return CProfiler()
+    if kind == 'sampling':
+        return SamplingProfiler()
+    raise ValueError(f"Unknown profiler {kind}")
+
+
+def function_name(filename, line, name):
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+
+def run_report(analysis, status, started, seconds, bytes_fetched, metrics, parse_stats, profile=None):
+    # the structured report of one analysis run, see to_json and to_prometheus
+    stages, counters = metrics.snapshot()
+    counters.update(parse_stats)
+    report = {'analysis': analysis, 'status': status,
+              'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+              'seconds': seconds, 'bytes_fetched': bytes_fetched, 'stages': stages, 'counters': counters}
+    if profile is not None:
+        report['profile'] = profile
+    return report
+
+
+def to_json(reports):
+    return json.dumps(reports, indent=2)
+
+
+def to_prometheus(reports):
+    # Prometheus text format; every run is told apart by its analysis and run number, and by the
+    # report's 'labels', e.g. the account of a batch run
+    samples = defaultdict(list)
+    for run, report in enumerate(reports):
+        labels = {**report.get('labels', {}), 'analysis': report['analysis'], 'run': str(run)}
+        samples['run_seconds'].append((labels, report['seconds']))
+        samples['bytes_fetched'].append((labels, report['bytes_fetched']))
+        for stage, values in report['stages'].items():
+            for field in stage_fields:
+                samples[f'stage_{field}_total'].append(({**labels, 'stage': stage}, values[field]))
+        for event, value in report['counters'].items():
+            samples['events_total'].append(({**labels, 'event': event}, value))
+    lines = []
+    for name, (kind, description) in prometheus_metrics.items():
+        if not samples[name]:
+            continue
+        lines.append(f"# HELP {prometheus_prefix}{name} {description}")
+        lines.append(f"# TYPE {prometheus_prefix}{name} {kind}")
+        for labels, value in samples[name]:
+            label_text = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+            lines.append(f"{prometheus_prefix}{name}{{{label_text}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_reports(reports, path):
+    # the format follows the extension: .prom for Prometheus, JSON otherwise
+    with open(path, 'w') as file:
+        file.write(to_prometheus(reports) if path.endswith('.prom') else to_json(reports))
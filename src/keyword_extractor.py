@@ -0,0 +1,149 @@
+import heapq
+import multiprocessing
+import os
+import re
+import string
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import config
+
+link_pattern = re.compile(r'(https|http){1}:\/\/[^\s]+\.[\w\d]+\/{0,1}', re.MULTILINE)
+tag_pattern = re.compile(r'<.*>', re.MULTILINE)
+token_pattern = re.compile(r"\w+(?:['’\-]\w+)*")
+ignored_tokens = set(string.punctuation) | {'``', '\'\'', '\"\"', '...'}
+
+# used when the NLTK stopwords corpus is not installed
+english_stopwords = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between
+both but by can could did do does doing down during each few for from further had has have having he her
+here hers herself him himself his how i if in into is it its itself just me more most my myself no nor not
+now of off on once only or other our ours ourselves out over own re same she should so some such than that
+the their theirs them themselves then there these they this those through to too under until up very was
+we were what when where which while who whom why will with would you your yours yourself yourselves
+""".split())
+
+
+def load_stopwords(language):
+    try:
+        from nltk.corpus import stopwords
+        return frozenset(stopwords.words(language))
+    except (LookupError, OSError):
+        if language == 'english':
+            return english_stopwords
+        print(f"No stopword list for {language}, keeping every token")
+        return frozenset()
+
+
+def tokenize(text, tokenizer='regex'):
+    text = link_pattern.sub('', text)
+    text = tag_pattern.sub('', text)
+    if tokenizer == 'nltk':
+        from nltk import word_tokenize
+        return [token for token in word_tokenize(text) if token not in ignored_tokens]
+    return token_pattern.findall(text)
+
+
+def count_keywords(texts, options):
+    # runs in a worker process for every batch of texts
+    tokenizer, stopwords, ngrams, lowercase = options
+    min_n, max_n = ngrams
+    counter = Counter()
+    for text in texts:
+        tokens = tokenize(text.lower() if lowercase else text, tokenizer)
+        if max_n > 1 and stopwords:
+            tokens = [token for token in tokens if token.lower() not in stopwords]
+        for n in range(min_n, max_n + 1):
+            if n == 1:
+                counter.update(tokens)
+            else:
+                counter.update(" ".join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+    if max_n == 1 and stopwords:
+        # unigrams only: cheaper to drop stopwords once per distinct token than once per occurrence
+        for token in [token for token in counter if token.lower() in stopwords]:
+            del counter[token]
+    return counter
+
+
+class TopKCounter:
+    # counts every key exactly while k is None. With k it is a mergeable Misra-Gries summary of at
+    # most 2 * k keys: once over that, the (2 * k + 1)-th largest count is subtracted from every key
+    # and the keys left at zero are dropped. A kept count is at most error below the true count,
+    # error is at most total / (2 * k + 1), and every key counted more than error times is kept
+    def __init__(self, k=None):
+        self.k = k
+        self.counter = Counter()
+        self.error = 0
+
+    def update(self, counts):
+        self.counter.update(counts)
+        capacity = 2 * self.k if self.k else None
+        if capacity and len(self.counter) > capacity:
+            cut = heapq.nlargest(capacity + 1, self.counter.values())[-1]
+            self.counter = Counter({key: count - cut for key, count in self.counter.items() if count > cut})
+            self.error += cut
+
+    def most_common(self):
+        return self.counter.most_common(self.k)
+
+
+class KeywordExtractor:
+    def __init__(self, tokenizer=None, language=None, remove_stopwords=None, ngrams=None, lowercase=None,
+                 top_k=None, workers=None, batch_size=None):
+        tokenizer = tokenizer or config.keyword_tokenizer
+        language = language or config.keyword_language
+        remove_stopwords = config.keyword_remove_stopwords if remove_stopwords is None else remove_stopwords
+        stopwords = load_stopwords(language) if remove_stopwords else frozenset()
+        lowercase = config.keyword_lowercase if lowercase is None else lowercase
+        self.__options = (tokenizer, stopwords, ngrams or config.keyword_ngrams, lowercase)
+        self.__counts = TopKCounter(top_k or config.keyword_top_k)
+        self.__workers = workers or config.keyword_workers
+        self.__batch_size = batch_size or config.keyword_batch_size
+        # in-process by default; a pool of workers only pays off on large inputs, and with the spawn
+        # (or forkserver) start method it needs the main module behind an if __name__ == '__main__' guard
+        self.__executor = None
+        if self.__workers != 1:
+            self.__executor = ProcessPoolExecutor(
+                self.__workers, mp_context=multiprocessing.get_context(config.process_start_method))
+        self.__pending = []
+        self.__texts = []
+
+    def add_text(self, text):
+        self.__texts.append(text)
+        if len(self.__texts) >= self.__batch_size:
+            self.__submit()
+
+    def result(self):
+        self.__submit()
+        for future in self.__pending:
+            self.__counts.update(future.result())
+        self.__pending = []
+        if self.__executor:
+            self.__executor.shutdown()
+        return dict(self.__counts.most_common())
+
+    def partial_result(self):
+        # counts of the batches finished so far, without waiting for the others
+        while self.__pending and self.__pending[0].done():
+            self.__counts.update(self.__pending.pop(0).result())
+        return dict(self.__counts.most_common())
+
+    @property
+    def error(self):
+        # how far below the true counts the returned counts may be, 0 unless top_k is set
+        return self.__counts.error
+
+    def close(self):
+        if self.__executor:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def __submit(self):
+        if not self.__texts:
+            return
+        if self.__executor is None:
+            self.__counts.update(count_keywords(self.__texts, self.__options))
+        else:
+            self.__pending.append(self.__executor.submit(count_keywords, self.__texts, self.__options))
+            # merge finished batches so at most two per worker are waiting in memory
+            while len(self.__pending) > 2 * (self.__workers or os.cpu_count()):
+                self.__counts.update(self.__pending.pop(0).result())
+        self.__texts = []
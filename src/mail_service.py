@@ -1,103 +1,261 @@
-import datetime
 import imaplib
-import email
 import re
-from email.header import decode_header
+from collections import Counter, defaultdict
 import config
+from instrumentation import Metrics
+from message_record import AddressBook
+from imap_response import iter_fetch_items, find_item, body_structure_parts
+from message_parser import parse_message, parse_text_part, is_body_text
+from search_query import search_criteria
+
+header_fields = ['Sender', 'Recievers', 'CC', 'BCC', 'Date', 'Subject']
+all_fields = header_fields + ['Text-Body']
+header_item = 'BODY.PEEK[HEADER.FIELDS (DATE FROM TO CC BCC SUBJECT)]'
+
+
+def needs_body(fields):
+    return fields is None or 'Text-Body' in fields
+
+
+def header_data_items(with_body):
+    # the headers, and for analyses that read bodies the structure of the message, which tells
+    # the text part to fetch; attachments and other binary parts are never downloaded
+    if with_body:
+        return f'(UID BODYSTRUCTURE {header_item})'
+    return f'(UID {header_item})'
+
+
+def parse_headers(fetched, with_body, stats, address_book):
+    # the records of the FETCH responses of header_data_items and, by UID, the text part to
+    # fetch for every record that has one; addresses are interned in address_book
+    records = []
+    text_parts = {}
+    for items in fetched:
+        try:
+            info = parse_message(find_item(items, 'BODY[HEADER'), False, int(items['UID']), stats, address_book)
+        except Exception:
+            stats['header_errors'] += 1
+            continue
+        if info is None:
+            continue
+        records.append(info)
+        if with_body:
+            text_part = find_text_part(items, stats)
+            if text_part:
+                text_parts[info.uid] = text_part
+    return records, text_parts
+
+
+def find_text_part(items, stats):
+    # the first inline text/plain part
+    try:
+        parts = body_structure_parts(items['BODYSTRUCTURE'])
+    except (KeyError, IndexError, TypeError, ValueError):
+        stats['structure_errors'] += 1
+        return None
+    text_part = None
+    for part in parts:
+        section, content_type, charset, encoding, size, disposition = part
+        if text_part is None and is_body_text(content_type, disposition):
+            text_part = part
+        elif not content_type.startswith('text/'):
+            stats['binary_parts_skipped'] += 1
+    return text_part
+
+
+def text_part_fetches(text_parts):
+    # (uids, FETCH data items, response item) per section, the text is in the same part of most
+    # messages; at most config.body_max_bytes of a part are downloaded
+    uids_by_section = defaultdict(list)
+    for uid, (section, *_) in text_parts.items():
+        uids_by_section[section].append(uid)
+    return [(uids, f'(UID BODY.PEEK[{section}]<0.{config.body_max_bytes}>)', f'BODY[{section}]')
+            for section, uids in uids_by_section.items()]
+
+
+def decode_text_parts(records, text_parts, texts, stats):
+    for info in records:
+        if info.uid in text_parts:
+            section, content_type, charset, encoding, size, disposition = text_parts[info.uid]
+            info.body = parse_text_part(texts.get(info.uid), encoding, charset,
+                                        size > config.body_max_bytes, stats)
+
+
+def to_message_set(message_ids):
+    # collapse sorted ids into IMAP ranges, e.g. [1, 2, 3, 7, 9, 10] -> "1:3,7,9:10"
+    ranges = []
+    for message_id in sorted(message_ids):
+        if ranges and message_id == ranges[-1][1] + 1:
+            ranges[-1][1] = message_id
+        else:
+            ranges.append([message_id, message_id])
+    return ",".join(str(low) if low == high else f"{low}:{high}" for low, high in ranges)
+
+
+class MessageStream:
+    # the records of a folder as their batches arrive; total is the number of messages when the
+    # source knows it up front, and close() stops fetching batches nobody will read any more
+    def __init__(self, batches, total=None, keep=None):
+        self.__batches = batches
+        self.__keep = keep
+        self.total = total
+
+    def __iter__(self):
+        for batch, message_info in self.__batches:
+            for info in message_info:
+                if self.__keep is None or self.__keep(info):
+                    yield info
+
+    def close(self):
+        if hasattr(self.__batches, 'close'):
+            self.__batches.close()
+
 
 class MailService:
     def __init__(self):
         self.__imap = None
+        self.__selected_mailbox = None
+        self.bytes_fetched = 0
+        # problems of the messages parsed, see message_parser
+        self.parse_stats = Counter()
+        # per-stage timings and the addresses of the messages, replaced by those of the MailTool using the service
+        self.metrics = Metrics()
+        self.address_book = AddressBook()
 
-    def connect(self):
-        self.__imap = imaplib.IMAP4_SSL(config.mail_server, config.mail_port)
+    def connect(self, server=None, port=None, use_ssl=None):
+        server = server or config.mail_server
+        port = port or config.mail_port
+        use_ssl = config.mail_use_ssl if use_ssl is None else use_ssl
+        with self.metrics.stage('connect'):
+            if use_ssl:
+                self.__imap = imaplib.IMAP4_SSL(server, port)
+            else:
+                self.__imap = imaplib.IMAP4(server, port)
 
     def authenticate(self, username, password):
-        self.__imap.login(username, password)
+        with self.metrics.stage('login'):
+            self.__imap.login(username, password)
 
     def list_folders(self):
         folder_names = [name.decode('utf8') for name in self.__imap.list()[1]]
         return folder_names
 
+    @property
+    def selected_mailbox(self):
+        return self.__selected_mailbox
+
     def select_mailbox(self, mailbox):
-        a = self.__imap.select(mailbox, readonly=True)
+        with self.metrics.stage('select'):
+            a = self.__imap.select(mailbox, readonly=True)
+        self.__selected_mailbox = mailbox
         print(a)
 
     def close_mailbox(self):
         self.__imap.close()
+        self.__selected_mailbox = None
 
     def logout(self):
         self.__imap.logout()
 
-    def get_message_info_for_period(self, period_start, period_end):
-        start = period_start.strftime('%d-%b-%Y')
-        end = period_end.strftime('%d-%b-%Y')
-        status, messages = self.__imap.search(None, f'(SINCE "{start}" BEFORE "{end}")')
-        message_info = []
-        i = 1
-        num_messages = len(messages[0].split())
-        for message_id in messages[0].split():
-            print(f"Fetching {i}/{num_messages}")
-            i += 1
-            status, data = self.__imap.fetch(message_id, '(RFC822)')
-            try:
-                for response_part in data:
-                    if isinstance(response_part, tuple):
-                        message = email.message_from_bytes(response_part[1])
-                        subject = self.__parse_subject(message['Subject'])
-                        sender = self.__parse_email(message['From'])[0]
-                        recievers = self.__parse_email(message['To'])
-                        cc = None
-                        if 'CC' in message:
-                            cc = self.__parse_email(message['CC'])
-                        bcc = None
-                        if 'BCC' in message:
-                            bcc = self.__parse_email(message['BCC'])
-                        date = self.__parse_email_datetime(message['Date'])
-                        body = self._parse_message_body(message)
-                        dict = {'Sender': sender, 'Recievers': recievers, 'CC': cc, 'BCC': bcc, 'Date': date,
-                                'Subject': subject, 'Text-Body': body}
-                        message_info.append(dict)
-            except:
-                print("Error")
-        return message_info
-
-    def __parse_subject(self, header):
-        subject = self.__header_to_decoded_string(header)
-        return subject
-
-    def __parse_email(self, header):
-        string_header = self.__header_to_decoded_string(header)
-        email = re.findall('[\w\-\.]+@[\w\-\.]+\.[\w\-\.]+', string_header)
-        return email
-
-    def __parse_email_datetime(self, header):
-        date_tuple = email.utils.parsedate_tz(header)
-        local_date = datetime.datetime.fromtimestamp(email.utils.mktime_tz(date_tuple))
-        return local_date
-
-    def _parse_message_body(self, message):
-        body = None
-        if message.is_multipart():
-            for part in message.walk():
-                content_type = part.get_content_type()
-                if content_type == "text/plain":
-                    body = part.get_payload(decode=True).decode()
-        else:
-            content_type = message.get_content_type()
-            if content_type == "text/plain":
-                body = message.get_payload(decode=True).decode()
-        return body
-
-    def __header_to_decoded_string(self, header):
-        parts = []
-        header = decode_header(header)
-        for content, encoding in header:
-            try:
-                if type(content) is str:
-                    parts.append(content)
-                else:
-                    parts.append(content.decode(encoding or "utf-8"))
-            except:
-                parts.append(content.decode("utf-8"))
-        return "".join(parts)
\ No newline at end of file
+    def get_uidvalidity(self):
+        status, data = self.__imap.response('UIDVALIDITY')
+        if data and data[0] is not None:
+            return int(data[0])
+        status, data = self.__imap.status(self.__selected_mailbox, '(UIDVALIDITY)')
+        return int(re.search(rb'UIDVALIDITY (\d+)', data[0]).group(1))
+
+    def search_uids_since(self, last_uid):
+        with self.metrics.stage('search'):
+            status, messages = self.__imap.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+        # "n:*" always matches the highest UID, even when it is below n
+        return [uid for uid in (int(uid) for uid in messages[0].split()) if uid > last_uid]
+
+    def search_uids(self, period_start=None, period_end=None, filters=None):
+        # filters are evaluated by the server, see search_query
+        criteria, literal = search_criteria(period_start, period_end, filters)
+        return [int(uid) for uid in self.__search(criteria, literal, by_uid=True)]
+
+    def count_messages(self, period_start, period_end, filters=None):
+        # counts the messages sent in the period without fetching any; servers with ESEARCH
+        # return just the number, the others the matching ids
+        criteria, literal = search_criteria(period_start, period_end, filters, sent_date=True)
+        if literal is None and 'ESEARCH' in self.__imap.capabilities:
+            self.__imap.response('ESEARCH')
+            self.__search(f'RETURN (COUNT) {criteria}', None)
+            status, data = self.__imap.response('ESEARCH')
+            self.bytes_fetched += len(data[0])
+            return int(re.search(rb'COUNT (\d+)', data[0]).group(1))
+        return len(self.__search(criteria, literal))
+
+    def get_message_info_for_period(self, period_start, period_end, batch_size=None, fields=None):
+        return list(self.iter_message_info_for_period(period_start, period_end, batch_size, fields))
+
+    def iter_message_info_for_period(self, period_start, period_end, batch_size=None, fields=None):
+        message_ids = self.__search_period(period_start, period_end)
+        return self.__iter_message_info(message_ids, batch_size, fields)
+
+    def get_message_info_for_uids(self, uids, batch_size=None, fields=None):
+        return list(self.iter_message_info_for_uids(uids, batch_size, fields))
+
+    def iter_message_info_for_uids(self, uids, batch_size=None, fields=None):
+        return self.__iter_message_info(uids, batch_size, fields, by_uid=True)
+
+    def __iter_message_info(self, message_ids, batch_size, fields, by_uid=False):
+        batch_size = batch_size or config.fetch_batch_size
+        with_body = needs_body(fields)
+        num_messages = len(message_ids)
+        for i in range(0, num_messages, batch_size):
+            batch = message_ids[i:i + batch_size]
+            print(f"Fetching {i + len(batch)}/{num_messages}")
+            fetched = self.__fetch(batch, header_data_items(with_body), by_uid)
+            with self.metrics.stage('parse headers', len(fetched)):
+                records, text_parts = parse_headers(fetched, with_body, self.parse_stats, self.address_book)
+            if text_parts:
+                self.__fetch_text_parts(records, text_parts)
+            yield from records
+
+    def __fetch_text_parts(self, records, text_parts):
+        texts = {}
+        for uids, data_items, section_item in text_part_fetches(text_parts):
+            for items in self.__fetch(uids, data_items, by_uid=True):
+                texts[int(items['UID'])] = find_item(items, section_item)
+        with self.metrics.stage('parse bodies', len(text_parts)):
+            decode_text_parts(records, text_parts, texts, self.parse_stats)
+
+    def __fetch(self, message_ids, data_items, by_uid):
+        with self.metrics.stage('fetch', len(message_ids)) as timing:
+            if by_uid:
+                status, data = self.__imap.uid('FETCH', to_message_set(message_ids), data_items)
+            else:
+                status, data = self.__imap.fetch(to_message_set(message_ids), data_items)
+            for response_part in data:
+                if isinstance(response_part, tuple):
+                    timing.bytes += len(response_part[0]) + len(response_part[1])
+                elif response_part is not None:
+                    timing.bytes += len(response_part)
+            self.bytes_fetched += timing.bytes
+        # unsolicited FETCH responses, e.g. flag changes, have no UID
+        with self.metrics.stage('parse response', len(message_ids)):
+            return [items for items in iter_fetch_items(data) if 'UID' in items]
+
+    def __search(self, criteria, literal, by_uid=False):
+        charset = None
+        if literal is not None:
+            charset = 'UTF-8'
+            self.__imap.literal = literal
+        with self.metrics.stage('search') as timing:
+            if by_uid:
+                status, data = self.__imap.uid('SEARCH', *(('CHARSET', charset) if charset else ()), criteria)
+            else:
+                status, data = self.__imap.search(charset, criteria)
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"SEARCH {criteria} failed: {data}")
+            if not data or data[0] is None:
+                return []
+            timing.bytes = len(data[0])
+        self.bytes_fetched += timing.bytes
+        return data[0].split()
+
+    def __search_period(self, period_start, period_end):
+        criteria, literal = search_criteria(period_start, period_end)
+        return [int(message_id) for message_id in self.__search(criteria, literal)]
@@ -1,265 +1,281 @@
+import time
 from datetime import datetime
-import re
-import string
-from collections import defaultdict
+from functools import wraps
 import config
-from mail_service import MailService
+from instrumentation import Metrics, create_profiler, run_report, write_reports
+from mail_service import header_fields, needs_body, MessageStream
+from connection_pool import MailServicePool
+from async_mail_service import AsyncMailServicePool
+from message_cache import MessageCache
+from message_record import AddressBook
+from analysis_engine import AnalysisEngine, Progress, AnalysisCancelled
+from aggregators import create_aggregator, TimeCountAggregator, HeatmapAggregator, KeywordAggregator
+from contact_index import ContactIndex, contact_weights, daily_contact_rows, period_days
+from time_buckets import parse_bucket, bucket_edges, format_keys
 from dateutil.relativedelta import *
-from nltk import word_tokenize
+
+def instrumented(analysis):
+    # every run of the analysis, finished or not, appends a report of its stages to run_reports;
+    # with config.profiler the report has a profile of the run as well, see instrumentation
+    @wraps(analysis)
+    def wrapper(self, *args, **kwargs):
+        name = analysis.__name__
+        bytes_before = self.mail_service.bytes_fetched
+        stats_before = self.mail_service.parse_stats.copy()
+        self.metrics.reset()
+        profiler = create_profiler(config.profiler)
+        status = 'failed'
+        started = time.time()
+        perf_started = time.perf_counter()
+        if profiler:
+            profiler.start()
+        try:
+            result = analysis(self, *args, **kwargs)
+            status = 'ok'
+        except AnalysisCancelled:
+            status = 'cancelled'
+            raise
+        finally:
+            profile = profiler.stop(name) if profiler else None
+            seconds = time.perf_counter() - perf_started
+            self.bytes_fetched[name] = self.mail_service.bytes_fetched - bytes_before
+            # messages kept without a body, dropped or cut, see message_parser
+            problems = self.mail_service.parse_stats - stats_before
+            self.run_reports.append(run_report(name, status, started, seconds, self.bytes_fetched[name],
+                                               self.metrics, problems, profile))
+        print(f"{name}: fetched {self.bytes_fetched[name]} bytes in {seconds:.1f}s")
+        if problems:
+            print(f"{name}: {dict(problems)}")
+        return result
+    return wrapper
+
+
+def create_mail_service(backend, connections=None):
+    # backend is config.mail_backend: 'imaplib', one command at a time per connection, or 'asyncio',
+    # several commands in flight per connection, see async_mail_service
+    if backend == 'imaplib':
+        return MailServicePool(connections)
+    if backend == 'asyncio':
+        return AsyncMailServicePool(connections)
+    raise ValueError(f"Unknown mail backend {backend}")
+
 
 class MailTool:
-    def __init__(self):
-        self.mail_service = MailService()
+    def __init__(self, cache_path=None, connections=None, source=None, progress=None, folders=None, metrics=None,
+                 backend=None):
+        # a pool of authenticated IMAP sessions; with more than one connection folders
+        # and large UID ranges are downloaded in parallel. Any object with the same
+        # folder-based interface can be used instead, e.g. a FileMailSource for mailbox exports
+        self.mail_service = source or create_mail_service(backend or config.mail_backend, connections)
         self.email = None
-
-    def connect(self):
-        email, password = self.__get_credentials()
-        self.mail_service.connect()
-        self.mail_service.authenticate(email, password)
+        self.bytes_fetched = {}
+        # mailbox names of the 'sent' and 'recieved' folders, config.sent_folder and config.recieved_folder by default
+        self.folders = {'sent': config.sent_folder, 'recieved': config.recieved_folder}
+        self.folders.update(folders or {})
+        # addresses of the messages read by this tool only, shared by the source and the cache and
+        # freed with the tool, see message_record.AddressBook
+        self.address_book = AddressBook()
+        self.mail_service.address_book = self.address_book
+        cache_path = config.cache_path if cache_path is None else cache_path
+        self.cache = MessageCache(cache_path, self.address_book) if cache_path else None
+        # progress reports the running analysis to a callback and cancels it, see analysis_engine.Progress
+        self.progress = progress or Progress()
+        self.progress.source = self.mail_service
+        # stage timings of the running analysis, shared with the source; run_reports keeps the
+        # report of every analysis run, see instrumentation
+        self.metrics = metrics or Metrics()
+        self.mail_service.metrics = self.metrics
+        self.run_reports = []
+        self.engine = AnalysisEngine(self.__iter_folder, self.progress, self.metrics)
+
+    def connect(self, email=None, password=None, server=None, port=None, use_ssl=None):
+        if email is None:
+            email, password = self.__get_credentials()
+        self.email = str.strip(email)
+        self.mail_service.connect(server, port, use_ssl)
+        self.mail_service.authenticate(self.email, str.strip(password or ''))
 
     def disconnect(self):
         self.mail_service.logout()
 
+    def write_run_reports(self, path):
+        # JSON, or the Prometheus text format for a path ending in .prom
+        write_reports(self.run_reports, path)
+
+    @instrumented
     def count_sent_messages_hourly(self, day):
         period_start = datetime(day.year, day.month, day.day)
         period_end = period_start + relativedelta(days=+1)
-        messages = self.__get_sent_messages(period_start, period_end)
-
-        time_dictionary = self.__generate_time_dictionary(period_start, period_end, "Hourly")
-        for message in messages:
-            key = message['Date'].strftime("%Y-%m-%d %H:00")
-            time_dictionary[key] += 1
-        return time_dictionary
+        return self.__run_report('hourly', period_start, period_end)
 
+    @instrumented
     def count_sent_messages_daily(self, month):
         period_start = datetime(month.year, month.month, 1)
         period_end = period_start + relativedelta(months=+1)
-        messages = self.__get_sent_messages(period_start, period_end)
-
-        time_dictionary = self.__generate_time_dictionary(period_start, period_end, "Daily")
-        for message in messages:
-            key = message['Date'].strftime("%Y-%m-%d")
-            time_dictionary[key] += 1
-        return time_dictionary
+        return self.__count_sent(period_start, period_end, 'day')
 
+    @instrumented
     def count_sent_messages_monthly(self, year):
         period_start = datetime(year.year, 1, 1)
         period_end = datetime(year.year, 12, 31)
-        messages = self.__get_sent_messages(period_start, period_end)
-
-        time_dictionary = self.__generate_time_dictionary(period_start, period_end, "Monthly")
-        for message in messages:
-            key = message['Date'].strftime("%Y-%m")
-            time_dictionary[key] += 1
-        return time_dictionary
-
-    def count_sent_messages_by_domain(self, period_start, period_end):
-        messages = self.__get_sent_messages(period_start, period_end)
-        domain_dict = defaultdict(int)
-        for message in messages:
-            recievers = message['Recievers']
-            if "BCC" in message and message['BCC']:
-                recievers.extend(message['BCC'])
-            if "CC" in message and message['CC']:
-                recievers.extend(message['CC'])
-            domains = self.__parse_domains(recievers)
-            for domain in domains:
-                domain_dict[domain] += 1
-        sorted_dict = self.__sort_dictionary_by_value(domain_dict)
-        return sorted_dict
-
-    def count_most_used_keywords(self, period_start, period_end):
-        messages = self.__get_sent_messages(period_start, period_end)
-        token_dict = defaultdict(int)
-        for message in messages:
-            text_body = message['Text-Body']
-            subject = message['Subject']
-            text_to_process = None
-            if text_body and subject:
-                text_to_process = text_body + " " + subject
-            elif text_body:
-                text_to_process = text_body
-            else:
-                text_to_process = subject
-
-            if text_to_process:
-                text = re.sub('(https|http){1}:\/\/[^\s]+\.[\w\d]+\/{0,1}', '', text_to_process, flags=re.MULTILINE)  # remove links
-                text = re.sub('<.*>', '', text, flags=re.MULTILINE)
-                tokens = word_tokenize(text)
-                tokens = list(filter(lambda token: token not in string.punctuation and token not in ['``', '\'\'', '\"\"', '...', ], tokens))
-                for token in tokens:
-                    token_dict[token] += 1
-
-        sorted_dict = self.__sort_dictionary_by_value(token_dict)
-        return sorted_dict
-
+        return self.__count_sent(period_start, period_end, 'month')
+
+    @instrumented
+    def count_sent_messages(self, period_start, period_end, bucket='day', tz=None, filters=None, server_side=None):
+        # bucket is any size from minutes to years, e.g. '15min', 'hour', '2 weeks', 'month', 'year';
+        # filters restrict the messages counted, see search_query. server_side, config.server_side_counts
+        # by default, counts whole-day buckets with IMAP SEARCH without downloading the messages, but
+        # by the sender's calendar date: a message sent at 23:30 -0800 is counted on that day, while
+        # the other counts use local time and put it on the next day in UTC
+        return self.__count_sent(period_start, period_end, bucket, tz, filters, server_side)
+
+    @instrumented
+    def get_sent_messages_heatmap(self, period_start, period_end, tz=None):
+        # 7 x 24 array of message counts, rows Monday..Sunday and columns hour of day
+        aggregator = HeatmapAggregator(tz)
+        return self.engine.run(period_start, period_end, {'heatmap': aggregator})['heatmap']
+
+    @instrumented
+    def count_sent_messages_by_domain(self, period_start, period_end, filters=None):
+        return self.__run_report('domains', period_start, period_end, filters)
+
+    @instrumented
+    def count_most_used_keywords(self, period_start, period_end, filters=None, **options):
+        # options: tokenizer ('regex' or 'nltk'), language, remove_stopwords, ngrams, lowercase, top_k, workers.
+        # the regex tokenizer splits contractions and punctuation differently from NLTK's word_tokenize;
+        # with top_k the counts are approximate and the bound is counted as keyword_count_error
+        aggregator = KeywordAggregator(**options)
+        result = self.engine.run(period_start, period_end, {'keywords': aggregator}, filters)['keywords']
+        if aggregator.error:
+            self.metrics.count('keyword_count_error', aggregator.error)
+        return result
+
+    @instrumented
     def get_contact_interaction_weights(self, period_start, period_end):
-        sent_messages = self.__get_sent_messages(period_start, period_end)
-        recieved_messages = self.__get_recieved_messages(period_start, period_end)
-
-        info = self.__get_contact_relationship_info(sent_messages, recieved_messages)
-        for c in info:
-            print(c, info[c])
-        params = self.__get_contact_params(info)
-        for c in params:
-            print(c, params[c])
-        weights = self.__get_contact_weights(params)
-
-        sorted_ = self.__sort_dictionary_by_value(weights)
-        for c in sorted_:
-            print(c, weights[c])
-        return sorted_
-
-    def __get_contact_relationship_info(self, sent_messages, recieved_messages):
-        contacts = defaultdict(lambda: {'First-Contact': datetime.max, 'Last-Contact': datetime.min,
-            'From-Me': 0, 'From-Me-Cc': 0, 'From-Me-Bcc': 0, 'To-Me': 0, 'To-Me-Cc': 0, 'To-Me-Bcc': 0, 'To-Me-Groups': 0})
-
-        #messages the current contact has sent
-        for i, message in enumerate(sent_messages):
-            for recipient in message['Recievers']:
-                contacts[recipient]['From-Me'] += 1
-                if message['Date'] < contacts[recipient]['First-Contact']:
-                    contacts[recipient]['First-Contact'] = message['Date']
-                if message['Date'] > contacts[recipient]['Last-Contact']:
-                    contacts[recipient]['Last-Contact'] = message['Date']
-            if message['CC']:
-                for cc_recipient in message['CC']:
-                    contacts[cc_recipient]['From-Me-Cc'] += 1
-                    if message['Date'] < contacts[cc_recipient]['First-Contact']:
-                        contacts[cc_recipient]['First-Contact'] = message['Date']
-                    if message['Date'] > contacts[cc_recipient]['Last-Contact']:
-                        contacts[cc_recipient]['Last-Contact'] = message['Date']
-            if message['BCC']:
-                for bcc_recipient in message['BCC']:
-                    contacts[bcc_recipient]['From-Me-Bcc'] += 1
-                    if message['Date'] < contacts[bcc_recipient]['First-Contact']:
-                        contacts[bcc_recipient]['First-Contact'] = message['Date']
-                    if message['Date'] > contacts[bcc_recipient]['Last-Contact']:
-                        contacts[bcc_recipient]['Last-Contact'] = message['Date']
-
-        #messages the current person has recieved
-        email = str.strip(self.__get_email())
-        print(email)
-        for i, message in enumerate(recieved_messages):
-            sender = message['Sender']
-            if email in message['Recievers']:
-                contacts[sender]['To-Me'] += 1
-            elif message['CC'] is not None and email in message['CC']:
-                contacts[sender]['To-Me-Cc'] += 1
-            elif message['BCC'] is not None and email in message['BCC']:
-                contacts[sender]['To-Me-Bcc'] += 1
-            else:
-                contacts[sender]['To-Me-Groups'] += 1
-
-            if message['Date'] < contacts[sender]['First-Contact']:
-                contacts[sender]['First-Contact'] = message['Date']
-            if message['Date'] > contacts[sender]['Last-Contact']:
-                contacts[sender]['Last-Contact'] = message['Date']
-        return contacts
-
-    def __get_contact_params(self, contact_info):
-        params = defaultdict(lambda: {})
-        for contact in contact_info:
-            entry = contact_info[contact]
-            num_recieved = entry['To-Me'] + entry['To-Me-Cc'] + entry['To-Me-Bcc'] + entry['To-Me-Groups']
-            num_sent = entry['From-Me'] + entry['From-Me-Cc'] + entry['From-Me-Bcc']
-            num_to_me = entry['To-Me']
-            num_from_me =  entry['From-Me']
-            num_sec = entry['To-Me-Cc'] + entry['To-Me-Bcc'] + entry['To-Me-Groups'] \
-                + entry['From-Me-Cc'] + entry['From-Me-Bcc']
-            num_total = num_to_me + num_from_me + num_sec
-            length = (entry['Last-Contact'] - entry['First-Contact']).days
-            length = length if length > 0 else 1
-
-            params[contact]['Recen'] = (datetime.now() - entry['Last-Contact']).days
-            params[contact]['Len'] = length
-            params[contact]['Sent-Freq'] = float(num_sent) / length
-            params[contact]['Recv-Freq'] = float(num_recieved) / length
-            params[contact]['To-Me'] = float(num_to_me) / num_total
-            params[contact]['From-Me'] = float(num_from_me) / num_total
-            params[contact]['Sec'] = float(num_sec) / num_total
-            params[contact]['Recip'] = 1 - (abs(num_recieved - num_sent) / float(num_total))
-        return params
-
-    def __get_contact_weights(self, params):
-        weights = defaultdict(int)
-        min_sent_freq = min(params.values(), key = lambda x : x['Sent-Freq'])['Sent-Freq']
-        max_sent_freq = max(params.values(), key = lambda x : x['Sent-Freq'])['Sent-Freq']
-        min_recv_freq = min(params.values(), key = lambda x : x['Recv-Freq'])['Recv-Freq']
-        max_recv_freq = max(params.values(), key = lambda x : x['Recv-Freq'])['Recv-Freq']
-        min_recen = min(params.values(), key=lambda x: x['Recen'])['Recen']
-        max_recen = max(params.values(), key=lambda x: x['Recen'])['Recen']
-
-        print('aaa', min_sent_freq, max_sent_freq, min_recv_freq, max_recv_freq, min_recen, max_recen)
-        for contact in params:
-            entry = params[contact]
-            norm_sent_freq = (entry['Sent-Freq'] - min_sent_freq) / (max_sent_freq - min_sent_freq)
-            norm_recv_freq = (entry['Recv-Freq'] - min_recv_freq) / (max_recv_freq - min_recv_freq)
-            norm_recen = (entry['Recen'] - min_recen) / (max_recen - min_recen)
-
-            most_infl = entry['Recip'] + entry['From-Me'] + norm_sent_freq
-            medium_infl = norm_recv_freq + entry['To-Me']
-            less_infl = norm_recen + entry['Sec']
-            weights[contact] = most_infl + 0.5 * medium_infl + 0.3 * less_infl
-        return weights
-
-    def __get_sent_messages(self, period_start, period_end):
-        self.mail_service.select_mailbox(config.sent_folder)
-        sent_messages = self.mail_service.get_message_info_for_period(period_start, period_end)
-        self.mail_service.close_mailbox()
-        return sent_messages
-
-    def __get_recieved_messages(self, period_start, period_end):
-        self.mail_service.select_mailbox(config.recieved_folder)
-        recieved_messages = self.mail_service.get_message_info_for_period(period_start, period_end)
-        self.mail_service.close_mailbox()
-        return recieved_messages
+        if not self.cache:
+            return self.__run_report('contacts', period_start, period_end)
+        # whole days come from the contact index the cache keeps while syncing,
+        # only messages of the partial days at the ends of the period are read
+        folders = self.folders
+        for folder in folders.values():
+            self.__sync_folder(folder)
+        first_day, last_day = period_days(period_start, period_end)
+        index = self.cache.get_contact_index(self.email, list(folders.values()), first_day, last_day)
+        if first_day == last_day:
+            edges = [(period_start, period_end)]
+        else:
+            edges = [(period_start, datetime.fromordinal(first_day)), (datetime.fromordinal(last_day), period_end)]
+        partial_days = ContactIndex()
+        for edge_start, edge_end in edges:
+            for name, folder in folders.items():
+                for message in self.cache.iter_messages(self.email, folder, edge_start, edge_end, False):
+                    partial_days.add_message(name, message, self.email)
+        return contact_weights(index.merge(partial_days))
+
+    @instrumented
+    def analyze(self, period_start, period_end, reports, filters=None):
+        # reports is a list of built-in report names, or a dict mapping result names to
+        # report names or Aggregator instances; each folder is fetched once for all of them
+        if not isinstance(reports, dict):
+            reports = {report: report for report in reports}
+        aggregators = {}
+        for name, report in reports.items():
+            if isinstance(report, str):
+                report = create_aggregator(report, period_start, period_end, self.email)
+            aggregators[name] = report
+        return self.engine.run(period_start, period_end, aggregators, filters)
+
+    def __run_report(self, report, period_start, period_end, filters=None):
+        aggregator = create_aggregator(report, period_start, period_end, self.email)
+        return self.engine.run(period_start, period_end, {report: aggregator}, filters)[report]
+
+    def __count_sent(self, period_start, period_end, bucket, tz=None, filters=None, server_side=None):
+        server_side = config.server_side_counts if server_side is None else server_side
+        if server_side and self.__can_count_on_server(period_start, period_end, bucket, tz):
+            return self.__count_on_server(period_start, period_end, bucket, filters)
+        aggregator = TimeCountAggregator(period_start, period_end, bucket, tz)
+        return self.engine.run(period_start, period_end, {'counts': aggregator}, filters)['counts']
+
+    def __can_count_on_server(self, period_start, period_end, bucket, tz):
+        # SEARCH compares calendar days of the Date header, so only whole-day buckets in the sender's
+        # time zone can be counted by the server; with a cache the headers are available locally
+        if self.cache or tz is not None:
+            return False
+        if not hasattr(self.mail_service, 'count_messages'):
+            return False
+        if parse_bucket(bucket)[1] not in ('day', 'week', 'month', 'year'):
+            return False
+        return all(time == datetime(time.year, time.month, time.day) for time in (period_start, period_end))
+
+    def __count_on_server(self, period_start, period_end, bucket, filters):
+        # one SEARCH per bucket, no message is downloaded
+        edges, key_unit = bucket_edges(period_start, period_end, bucket)
+        days = edges.astype('datetime64[D]').astype('datetime64[s]').astype(datetime)
+        periods = [(max(start, period_start), min(end, period_end)) for start, end in zip(days[:-1], days[1:])]
+        self.progress.start_stage("count on server", len(periods))
+        counts = self.mail_service.count_messages(self.folders['sent'], periods, filters)
+        return dict(zip(format_keys(edges[:-1], key_unit), counts))
+
+    def __iter_folder(self, folder, period_start, period_end, fields, filters=None):
+        folder = self.folders.get(folder, folder)
+        return self.__iter_messages(folder, period_start, period_end, fields, filters)
+
+    def __iter_messages(self, folder, period_start, period_end, fields, filters=None):
+        # with filters the server (or the source) picks the messages, see search_query
+        uids = self.mail_service.search_uids(folder, period_start, period_end, filters) if filters else None
+        if self.cache:
+            self.__sync_folder(folder)
+            if needs_body(fields):
+                self.__sync_bodies(folder, period_start, period_end, uids)
+            messages = self.cache.iter_messages(self.email, folder, period_start, period_end, needs_body(fields), uids)
+            total = self.cache.count_messages(self.email, folder, period_start, period_end) if uids is None else None
+            return MessageStream([(None, messages)], total)
+        if uids is not None:
+            return self.mail_service.iter_message_info_for_uids(folder, uids, fields)
+        return self.mail_service.iter_message_info_for_period(folder, period_start, period_end, fields=fields)
+
+    def __sync_folder(self, folder):
+        uidvalidity = self.mail_service.get_uidvalidity(folder)
+        cached_uidvalidity, last_uid = self.cache.get_folder_state(self.email, folder)
+        if cached_uidvalidity is not None and cached_uidvalidity != uidvalidity:
+            print(f"UIDVALIDITY of {folder} changed, dropping cached messages")
+            self.cache.invalidate_folder(self.email, folder)
+            last_uid = 0
+
+        # the folder is synced headers-only, bodies are fetched per period when an analysis needs them;
+        # every batch is stored as it arrives so an interrupted sync resumes where it stopped
+        uids = self.mail_service.search_uids_since(folder, last_uid)
+        name = 'sent' if folder == self.folders['sent'] else 'recieved'
+        self.progress.start_stage(f"sync {folder}", len(uids))
+        batches = self.mail_service.iter_uid_batches(folder, uids, header_fields)
+        try:
+            for batch, messages in batches:
+                with self.metrics.stage('contact rows', len(messages)):
+                    contacts = daily_contact_rows(name, messages, self.email)
+                with self.metrics.stage('cache write', len(messages)):
+                    self.cache.store_messages(self.email, folder, uidvalidity, messages, batch[-1], has_body=False,
+                                              contacts=contacts)
+                self.progress.advance(len(batch))
+        finally:
+            batches.close()
+
+    def __sync_bodies(self, folder, period_start, period_end, wanted_uids=None):
+        uids = self.cache.get_uids_without_body(self.email, folder, period_start, period_end)
+        if wanted_uids is not None:
+            wanted_uids = set(wanted_uids)
+            uids = [uid for uid in uids if uid in wanted_uids]
+        self.progress.start_stage(f"fetch bodies {folder}", len(uids))
+        batches = self.mail_service.iter_uid_batches(folder, uids)
+        try:
+            for batch, messages in batches:
+                with self.metrics.stage('cache write', len(messages)):
+                    self.cache.store_messages(self.email, folder, None, messages, None)
+                self.progress.advance(len(batch))
+        finally:
+            batches.close()
 
     def __get_credentials(self):
         f = open("credentials.txt", "r")
         email = f.readline(400)
         password = f.readline(400)
         return email, password
-
-    def __get_email(self):
-        f = open("credentials.txt", "r")
-        email = f.readline(400)
-        return email
-
-    def __generate_time_dictionary(self, period_start, period_end, mode):
-        day = period_start
-        time_dictionary = {}
-        while day < period_end:
-            if mode == "Hourly":
-                key = day.strftime("%Y-%m-%d %H:00")
-                day = day + relativedelta(hours=+1)
-            elif mode == "Daily":
-                key = day.strftime("%Y-%m-%d")
-                day = day + relativedelta(days=+1)
-            else:
-                key = day.strftime("%Y-%m")
-                day = day + relativedelta(months=+1)
-            time_dictionary[key] = 0
-        return time_dictionary
-
-    def __parse_domains(self, emails):
-        domains = []
-        for email in emails:
-            match = re.search('@[\w\-\.]+\.[\w\-\.]+', email)
-            if match:
-                domains.append(match.group(0))
-        return domains
-
-    def __sort_messages_by_date(self, messages):
-        sorted_ = sorted(messages, key=lambda message: message['Date'], reverse=True)
-        return sorted_
-
-    def __sort_dictionary_by_value(self, dict):
-        sorted_ = {key: value for key, value in sorted(dict.items(), key=lambda item: item[1], reverse=True)}
-        return sorted_
-
-
-
-
-
-
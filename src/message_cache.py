@@ -0,0 +1,139 @@
+import json
+import sqlite3
+from contact_index import ContactIndex
+from message_record import AddressBook, MessageRecord
+
+schema_version = 3
+# rows iter_messages reads per query, and seconds to wait while another connection writes
+read_batch_size = 1000
+busy_timeout = 30
+
+
+class MessageCache:
+    def __init__(self, path, address_book=None):
+        # the GUI runs analyses on a worker thread, one at a time. Accounts of a batch run may share
+        # the file: with WAL their readers do not block each other's writes
+        self.__connection = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self.__connection.execute('PRAGMA journal_mode = WAL')
+        self.address_book = AddressBook() if address_book is None else address_book
+        self.__create_tables()
+
+    def close(self):
+        self.__connection.close()
+
+    def get_folder_state(self, account, folder):
+        row = self.__connection.execute(
+            'SELECT uidvalidity, last_uid FROM folders WHERE account = ? AND folder = ?',
+            (account, folder)).fetchone()
+        if row is None:
+            return None, 0
+        return row
+
+    def invalidate_folder(self, account, folder):
+        with self.__connection:
+            self.__connection.execute('DELETE FROM messages WHERE account = ? AND folder = ?', (account, folder))
+            self.__connection.execute('DELETE FROM folders WHERE account = ? AND folder = ?', (account, folder))
+            self.__connection.execute('DELETE FROM contacts WHERE account = ? AND folder = ?', (account, folder))
+
+    def store_messages(self, account, folder, uidvalidity, messages, last_uid, has_body=True, contacts=None):
+        # contacts are the daily_contact_rows of messages not stored before; they are added to
+        # the contact index in the same transaction, so a message is never counted twice
+        rows = [(account, folder, message.uid, message.timestamp, message.sender,
+                 json.dumps(message.recievers), self.__dump_optional(message.cc),
+                 self.__dump_optional(message.bcc), message.subject, message.body, int(has_body))
+                for message in messages]
+        with self.__connection:
+            self.__connection.executemany(
+                'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            if last_uid is not None:
+                self.__connection.execute(
+                    'INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)', (account, folder, uidvalidity, last_uid))
+            if contacts:
+                self.__connection.executemany(
+                    'INSERT INTO contacts VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (account, folder, contact, day, role) DO UPDATE SET '
+                    'count = count + excluded.count, first = min(first, excluded.first), last = max(last, excluded.last)',
+                    [(account, folder) + row for row in contacts])
+
+    def get_uids_without_body(self, account, folder, period_start, period_end):
+        cursor = self.__connection.execute(
+            'SELECT uid FROM messages WHERE account = ? AND folder = ? AND date >= ? AND date < ? '
+            'AND has_body = 0 ORDER BY uid',
+            (account, folder, period_start.timestamp(), period_end.timestamp()))
+        return [uid for uid, in cursor]
+
+    def count_messages(self, account, folder, period_start, period_end):
+        return self.__connection.execute(
+            'SELECT COUNT(*) FROM messages WHERE account = ? AND folder = ? AND date >= ? AND date < ?',
+            (account, folder, period_start.timestamp(), period_end.timestamp())).fetchone()[0]
+
+    def get_body(self, account, folder, uid):
+        row = self.__connection.execute(
+            'SELECT body FROM messages WHERE account = ? AND folder = ? AND uid = ?', (account, folder, uid)).fetchone()
+        return row[0] if row else None
+
+    def iter_messages(self, account, folder, period_start, period_end, with_body=True, uids=None):
+        # uids, when given, restrict the messages to those, e.g. the result of a server-side search;
+        # without with_body a message's body is read from the cache when it is first accessed
+        uids = None if uids is None else set(uids)
+        body_loader = None if with_body else lambda uid: self.get_body(account, folder, uid)
+        body_column = 'body' if with_body else 'NULL'
+        # read in batches after the last (date, uid) read, each query done before its messages are
+        # yielded, so no statement stays open while the messages are aggregated
+        last = (period_start.timestamp(), 0)
+        while True:
+            rows = self.__connection.execute(
+                f'SELECT uid, date, sender, recievers, cc, bcc, subject, {body_column} FROM messages '
+                'WHERE account = ? AND folder = ? AND date >= ? AND date < ? AND (date, uid) > (?, ?) '
+                'ORDER BY date, uid LIMIT ?',
+                (account, folder, last[0], period_end.timestamp(), *last, read_batch_size)).fetchall()
+            for uid, date, sender, recievers, cc, bcc, subject, body in rows:
+                if uids is not None and uid not in uids:
+                    continue
+                yield MessageRecord.from_addresses(uid, date, sender, json.loads(recievers), self.__load_optional(cc),
+                                                   self.__load_optional(bcc), subject, body, body_loader,
+                                                   address_book=self.address_book)
+            if len(rows) < read_batch_size:
+                return
+            last = (rows[-1][1], rows[-1][0])
+
+    def get_contact_index(self, account, folders, first_day, last_day):
+        # ContactIndex of the whole local days [first_day, last_day), given as date ordinals
+        placeholders = ', '.join('?' * len(folders))
+        cursor = self.__connection.execute(
+            'SELECT contact, role, SUM(count), MIN(first), MAX(last) FROM contacts '
+            f'WHERE account = ? AND folder IN ({placeholders}) AND day >= ? AND day < ? GROUP BY contact, role',
+            (account, *folders, first_day, last_day))
+        return ContactIndex.from_rows(cursor.fetchall())
+
+    def __create_tables(self):
+        # the cache can always be rebuilt from the server, so an old layout is simply dropped
+        if self.__connection.execute('PRAGMA user_version').fetchone()[0] != schema_version:
+            with self.__connection:
+                self.__connection.execute('DROP TABLE IF EXISTS messages')
+                self.__connection.execute('DROP TABLE IF EXISTS folders')
+                self.__connection.execute('DROP TABLE IF EXISTS contacts')
+                self.__connection.execute(f'PRAGMA user_version = {schema_version}')
+        with self.__connection:
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS folders ('
+                'account TEXT, folder TEXT, uidvalidity INTEGER, last_uid INTEGER, '
+                'PRIMARY KEY (account, folder))')
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'account TEXT, folder TEXT, uid INTEGER, date REAL, sender TEXT, recievers TEXT, '
+                'cc TEXT, bcc TEXT, subject TEXT, body TEXT, has_body INTEGER, '
+                'PRIMARY KEY (account, folder, uid))')
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS contacts ('
+                'account TEXT, folder TEXT, contact TEXT, day INTEGER, role INTEGER, '
+                'count INTEGER, first REAL, last REAL, '
+                'PRIMARY KEY (account, folder, contact, day, role))')
+            self.__connection.execute(
+                'CREATE INDEX IF NOT EXISTS messages_by_date ON messages (account, folder, date)')
+
+    def __dump_optional(self, value):
+        return None if value is None else json.dumps(value)
+
+    def __load_optional(self, value):
+        return None if value is None else json.loads(value)
@@ -0,0 +1,157 @@
+import binascii
+import email
+import email.utils
+import quopri
+import re
+from collections import Counter
+from email.header import decode_header
+import config
+from message_record import MessageRecord
+
+# stats are a Counter of the problems met while parsing, by name:
+#   'undated': messages without a usable Date header, the only ones dropped
+#   'header_errors': messages whose headers could not be parsed at all, dropped by the caller
+#   'body_errors': bodies that could not be decoded, the message is kept without one
+#   'charset_fallbacks': texts not in their declared charset, decoded with config.body_charsets
+#   'bodies_truncated': texts longer than config.body_max_bytes, cut there (over IMAP before transfer decoding)
+#   'binary_parts_skipped': attachments and other parts that are not text, never decoded
+#   'structure_errors': BODYSTRUCTUREs that could not be read, the message is kept without a body
+
+
+def parse_message(raw_message, with_body=True, uid=None, stats=None, address_book=None):
+    stats = Counter() if stats is None else stats
+    message = email.message_from_bytes(raw_message)
+    try:
+        timestamp = parse_email_timestamp(message['Date'])
+    except (TypeError, ValueError, OverflowError):
+        stats['undated'] += 1
+        return None
+    subject = parse_subject(message['Subject'])
+    senders = parse_email(message['From'])
+    sender = senders[0] if senders else None
+    recievers = parse_email(message['To'])
+    cc = None
+    if 'CC' in message:
+        cc = parse_email(message['CC'])
+    bcc = None
+    if 'BCC' in message:
+        bcc = parse_email(message['BCC'])
+    body = parse_message_body(message, stats) if with_body else None
+    return MessageRecord.from_addresses(uid, timestamp, sender, recievers, cc, bcc, subject, body,
+                                        address_book=address_book)
+
+
+def parse_subject(header):
+    if header is None:
+        return None
+    subject = header_to_decoded_string(header)
+    return subject
+
+
+def parse_email(header):
+    string_header = header_to_decoded_string(header)
+    email = re.findall(r'[\w\-\.]+@[\w\-\.]+\.[\w\-\.]+', string_header)
+    return email
+
+
+def parse_email_timestamp(header):
+    date_tuple = email.utils.parsedate_tz(header)
+    return email.utils.mktime_tz(date_tuple)
+
+
+def parse_message_body(message, stats=None, max_bytes=None):
+    # the first inline text/plain part, at most max_bytes of it; binary parts are never decoded
+    stats = Counter() if stats is None else stats
+    max_bytes = config.body_max_bytes if max_bytes is None else max_bytes
+    text_part = None
+    for part in leaf_parts(message):
+        if text_part is None and is_body_text(part.get_content_type(), part.get_content_disposition()):
+            text_part = part
+        elif part.get_content_maintype() != 'text':
+            stats['binary_parts_skipped'] += 1
+    if text_part is None:
+        return None
+    try:
+        data = text_part.get_payload(decode=True) or b''
+    except (ValueError, TypeError):
+        stats['body_errors'] += 1
+        return None
+    truncated = len(data) > max_bytes
+    if truncated:
+        stats['bodies_truncated'] += 1
+        data = data[:max_bytes]
+    return decode_text(data, text_part.get_content_charset(), stats, truncated)
+
+
+def parse_text_part(data, encoding, charset, truncated=False, stats=None):
+    # a text part fetched on its own, e.g. BODY[1] over IMAP, still in its transfer encoding
+    stats = Counter() if stats is None else stats
+    if data is None:
+        stats['body_errors'] += 1
+        return None
+    if truncated:
+        stats['bodies_truncated'] += 1
+    try:
+        data = decode_transfer_encoding(data, encoding)
+    except ValueError:
+        stats['body_errors'] += 1
+        return None
+    return decode_text(data, charset, stats, truncated)
+
+
+def leaf_parts(message):
+    # attached messages are not looked into, their text is not the message's body
+    if message.is_multipart() and message.get_content_maintype() == 'multipart':
+        for part in message.get_payload():
+            yield from leaf_parts(part)
+    else:
+        yield message
+
+
+def is_body_text(content_type, disposition):
+    return content_type == 'text/plain' and disposition != 'attachment'
+
+
+def decode_transfer_encoding(data, encoding):
+    if encoding == 'base64':
+        # a truncated part can end in the middle of a group of 4 characters
+        data = b''.join(data.split())
+        return binascii.a2b_base64(data[:len(data) - len(data) % 4])
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    return data
+
+
+def decode_text(data, charset=None, stats=None, truncated=False):
+    # the declared charset, then config.body_charsets in turn; a truncated text can end in the
+    # middle of a character, which is dropped
+    charsets = ([charset] if charset else []) + list(config.body_charsets)
+    for candidate in charsets:
+        try:
+            try:
+                text = data.decode(candidate)
+            except UnicodeDecodeError as error:
+                if not truncated or error.end != len(data):
+                    raise
+                text = data[:error.start].decode(candidate)
+        except (LookupError, UnicodeDecodeError):
+            continue
+        if candidate != charsets[0] and stats is not None:
+            stats['charset_fallbacks'] += 1
+        return text
+    if stats is not None:
+        stats['charset_fallbacks'] += 1
+    return data.decode('utf-8', 'replace')
+
+
+def header_to_decoded_string(header):
+    if header is None:
+        return ''
+    parts = []
+    header = decode_header(header)
+    for content, encoding in header:
+        if type(content) is str:
+            parts.append(content)
+        else:
+            parts.append(decode_text(content, encoding))
+    return "".join(parts)
@@ -0,0 +1,127 @@
+import re
+import threading
+from datetime import datetime
+
+domain_pattern = re.compile(r'@[\w\-\.]+\.[\w\-\.]+')
+
+
+class AddressBook:
+    # every distinct address is stored once; messages keep its id. The dicts hand out the same
+    # int objects every time, so an id in a record costs one reference
+    def __init__(self):
+        self.addresses = []
+        self.domains = []
+        self.address_domains = []
+        self.__address_ids = {}
+        self.__domain_ids = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def get_id(self, address):
+        address_id = self.__address_ids.get(address)
+        if address_id is None:
+            with self.__lock:
+                address_id = self.__address_ids.get(address)
+                if address_id is None:
+                    address_id = self.__add(address)
+        return address_id
+
+    def get_ids(self, addresses):
+        return tuple(self.get_id(address) for address in addresses)
+
+    def find_id(self, address):
+        # None for an address no message had
+        return self.__address_ids.get(address)
+
+    def domain_id(self, address_id):
+        # None when the address has no domain part
+        return self.address_domains[address_id]
+
+    def __add(self, address):
+        match = domain_pattern.search(address)
+        domain_id = None
+        if match:
+            domain_id = self.__domain_ids.get(match.group(0))
+            if domain_id is None:
+                domain_id = self.__domain_ids[match.group(0)] = len(self.domains)
+                self.domains.append(match.group(0))
+        address_id = self.__address_ids[address] = len(self.addresses)
+        self.addresses.append(address)
+        self.address_domains.append(domain_id)
+        return address_id
+
+
+class MessageRecord:
+    # one parsed message: addresses are ids in its address_book, the date is epoch seconds and the
+    # body is either kept or loaded on first access through body_loader(uid)
+    __slots__ = ('address_book', 'uid', 'timestamp', 'sender_id', 'reciever_ids', 'cc_ids', 'bcc_ids', 'subject',
+                 '__body', '__body_loader')
+
+    def __init__(self, address_book, uid, timestamp, sender_id, reciever_ids, cc_ids, bcc_ids, subject, body=None,
+                 body_loader=None):
+        self.address_book = address_book
+        self.uid = uid
+        self.timestamp = timestamp
+        self.sender_id = sender_id
+        self.reciever_ids = reciever_ids
+        self.cc_ids = cc_ids
+        self.bcc_ids = bcc_ids
+        self.subject = subject
+        self.__body = body
+        self.__body_loader = body_loader
+
+    @classmethod
+    def from_addresses(cls, uid, timestamp, sender, recievers, cc, bcc, subject, body=None, body_loader=None,
+                       address_book=None):
+        # the sources share the address book of their MailTool, see MailTool.address_book
+        address_book = AddressBook() if address_book is None else address_book
+        sender_id = address_book.get_id(sender) if sender is not None else None
+        return cls(address_book, uid, int(timestamp), sender_id, address_book.get_ids(recievers),
+                   None if cc is None else address_book.get_ids(cc),
+                   None if bcc is None else address_book.get_ids(bcc), subject, body, body_loader)
+
+    def __reduce__(self):
+        # ids only mean something in their address book, so records are pickled as addresses
+        return (MessageRecord.from_addresses, self.fields())
+
+    def fields(self):
+        # the from_addresses arguments of the record
+        return (self.uid, self.timestamp, self.sender, self.recievers, self.cc, self.bcc, self.subject, self.body)
+
+    @property
+    def date(self):
+        return datetime.fromtimestamp(self.timestamp)
+
+    @property
+    def sender(self):
+        return None if self.sender_id is None else self.address_book.addresses[self.sender_id]
+
+    @property
+    def recievers(self):
+        return [self.address_book.addresses[address_id] for address_id in self.reciever_ids]
+
+    @property
+    def cc(self):
+        return None if self.cc_ids is None else [self.address_book.addresses[address_id] for address_id in self.cc_ids]
+
+    @property
+    def bcc(self):
+        return None if self.bcc_ids is None else [self.address_book.addresses[address_id] for address_id in self.bcc_ids]
+
+    @property
+    def body(self):
+        if self.__body is None and self.__body_loader is not None:
+            self.__body = self.__body_loader(self.uid)
+            self.__body_loader = None
+        return self.__body
+
+    @body.setter
+    def body(self, body):
+        self.__body = body
+        self.__body_loader = None
+
+    @property
+    def has_body(self):
+        return self.__body is not None
@@ -0,0 +1,94 @@
+text_keys = {'from': 'FROM', 'to': 'TO', 'cc': 'CC', 'bcc': 'BCC', 'subject': 'SUBJECT', 'body': 'BODY', 'text': 'TEXT'}
+size_keys = {'larger': 'LARGER', 'smaller': 'SMALLER'}
+flag_keys = {'seen': 'SEEN', 'unseen': 'UNSEEN', 'answered': 'ANSWERED', 'unanswered': 'UNANSWERED',
+             'flagged': 'FLAGGED', 'unflagged': 'UNFLAGGED', 'draft': 'DRAFT', 'undraft': 'UNDRAFT',
+             'deleted': 'DELETED', 'undeleted': 'UNDELETED', 'recent': 'RECENT', 'new': 'NEW', 'old': 'OLD'}
+imap_months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# filters are a dict of
+#   'from', 'to', 'cc', 'bcc', 'subject', 'body', 'text': substring or list of substrings (any of them),
+#       e.g. {'to': ['@example.com', '@example.org']} for messages to either domain
+#   'larger', 'smaller': size in bytes
+#   'flags': list of flag_keys, e.g. ['seen', 'unflagged']
+
+
+def search_criteria(period_start=None, period_end=None, filters=None, sent_date=False):
+    # returns (criteria, literal) for SEARCH; values outside ASCII need CHARSET UTF-8, and as imaplib
+    # sends at most one literal, at the end of the command, only one such value is supported.
+    # sent_date compares the Date header (SENTSINCE/SENTBEFORE) instead of the arrival date
+    filters = filters or {}
+    unknown = set(filters) - set(text_keys) - set(size_keys) - {'flags'}
+    if unknown:
+        raise ValueError(f"Unknown search filters {sorted(unknown)}")
+    criteria = []
+    if period_start:
+        criteria.append(f"{'SENTSINCE' if sent_date else 'SINCE'} {imap_date(period_start)}")
+    if period_end:
+        criteria.append(f"{'SENTBEFORE' if sent_date else 'BEFORE'} {imap_date(period_end)}")
+    for name, key in size_keys.items():
+        if filters.get(name) is not None:
+            criteria.append(f"{key} {int(filters[name])}")
+    for flag in filters.get('flags', []):
+        if flag.lower() not in flag_keys:
+            raise ValueError(f"Unknown flag {flag}")
+        criteria.append(flag_keys[flag.lower()])
+
+    literal = None
+    literal_clause = None
+    for name, key in text_keys.items():
+        values = filters.get(name)
+        if not values:
+            continue
+        values = [values] if isinstance(values, str) else list(values)
+        non_ascii = [value for value in values if not value.isascii()]
+        if non_ascii and (literal is not None or len(non_ascii) > 1):
+            raise ValueError("Only one search value outside ASCII is supported")
+        if non_ascii:
+            # the literal goes last, so its clause is moved to the end of the criteria
+            values.remove(non_ascii[0])
+            values.append(non_ascii[0])
+            literal = non_ascii[0].encode('utf-8')
+            literal_clause = any_of(key, values, literal_last=True)
+        else:
+            criteria.append(any_of(key, values))
+    if literal_clause:
+        criteria.append(literal_clause)
+    return " ".join(criteria) or "ALL", literal
+
+
+def any_of(key, values, literal_last=False):
+    # OR is binary in IMAP: a OR b OR c is "OR a OR b c"
+    clauses = [f"{key} {quote(value)}" for value in values]
+    if literal_last:
+        clauses[-1] = key
+    clause = clauses[-1]
+    for other in reversed(clauses[:-1]):
+        clause = f"OR {other} {clause}"
+    return clause
+
+
+def quote(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def imap_date(day):
+    # SEARCH dates are English whatever the locale, e.g. 1-Mar-2020
+    return f"{day.day}-{imap_months[day.month - 1]}-{day.year}"
+
+
+def message_matches(message, filters):
+    # the text filters on a parsed message record, for sources that cannot search on a server
+    fields = {'from': lambda: [message.sender], 'to': lambda: message.recievers,
+              'cc': lambda: message.cc or [], 'bcc': lambda: message.bcc or [],
+              'subject': lambda: [message.subject], 'body': lambda: [message.body],
+              'text': lambda: [message.sender, message.subject, message.body,
+                               *message.recievers, *(message.cc or []), *(message.bcc or [])]}
+    for name, get_values in fields.items():
+        wanted = filters.get(name)
+        if not wanted:
+            continue
+        wanted = [wanted] if isinstance(wanted, str) else wanted
+        haystack = " ".join(value for value in get_values() if value).lower()
+        if not any(value.lower() in haystack for value in wanted):
+            return False
+    return True
@@ -0,0 +1,189 @@
+import mailbox
+import os
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+from email.message import EmailMessage
+from file_source import find_mbox_messages, message_sizes, parse_batch
+from imap_response import iter_fetch_items, find_item, body_structure_parts
+from message_parser import parse_message, parse_subject, parse_text_part
+
+
+class FetchItemsTest(unittest.TestCase):
+    def test_literals(self):
+        # imaplib splits a response at its literals, which may hold anything, parentheses and quotes included
+        header = b'From: "Owner (work)" <owner@example.com>\r\nSubject: a ) b "c\r\n\r\n'
+        data = [(b'1 (UID 5 RFC822.SIZE 1200 BODY[HEADER.FIELDS (FROM SUBJECT)] {%d}' % len(header), header),
+                b' FLAGS (\\Seen))',
+                (b'2 (UID 6 BODY[HEADER.FIELDS (FROM SUBJECT)] {0}', b''),
+                b')']
+        first, second = iter_fetch_items(data)
+        self.assertEqual(first['UID'], b'5')
+        self.assertEqual(first['RFC822.SIZE'], b'1200')
+        self.assertEqual(first['BODY[HEADER.FIELDS (FROM SUBJECT)]'], header)
+        self.assertEqual(first['FLAGS'], [b'\\Seen'])
+        self.assertEqual(second['UID'], b'6')
+        self.assertEqual(find_item(second, 'BODY['), b'')
+
+    def test_strings_and_nil(self):
+        data = [b'3 (UID 7 X-NAME "a \\"quoted\\" (name)" X-NONE NIL X-LIST (NIL "b" c))']
+        items, = iter_fetch_items(data)
+        self.assertEqual(items['X-NAME'], b'a "quoted" (name)')
+        self.assertIsNone(items['X-NONE'])
+        self.assertEqual(items['X-LIST'], [None, b'b', b'c'])
+
+    def test_echoed_section(self):
+        data = [(b'4 (UID 8 BODY[1]<0> {5}', b'hello'), b')']
+        items, = iter_fetch_items(data)
+        self.assertEqual(find_item(items, 'BODY[1]'), b'hello')
+
+
+class BodyStructureTest(unittest.TestCase):
+    def structure(self, body_structure):
+        items, = iter_fetch_items([b'1 (UID 9 BODYSTRUCTURE ' + body_structure + b')'])
+        return items['BODYSTRUCTURE']
+
+    def test_single_part(self):
+        structure = self.structure(b'("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 10 1)')
+        self.assertEqual(body_structure_parts(structure), [('1', 'text/plain', 'us-ascii', '7bit', 10, None)])
+
+    def test_nested_multipart(self):
+        alternative = (b'(("TEXT" "PLAIN" ("CHARSET" "iso-8859-1") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL NIL)'
+                       b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "BASE64" 300 5 NIL NIL NIL NIL)'
+                       b' "ALTERNATIVE" ("BOUNDARY" "b2") NIL NIL NIL)')
+        attachment = (b'("APPLICATION" "PDF" ("NAME" "a (1).pdf") NIL NIL "BASE64" 5000 NIL'
+                      b' ("ATTACHMENT" ("FILENAME" "a (1).pdf")) NIL NIL)')
+        attached_message = (b'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 800'
+                            b' (NIL "inner" NIL NIL NIL NIL NIL NIL NIL NIL)'
+                            b' ("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 10 1) 20 NIL ("INLINE" NIL) NIL)')
+        structure = self.structure(b'(' + alternative + attachment + attached_message +
+                                   b' "MIXED" ("BOUNDARY" "b1") NIL NIL NIL)')
+        self.assertEqual(body_structure_parts(structure), [
+            ('1.1', 'text/plain', 'iso-8859-1', 'quoted-printable', 120, None),
+            ('1.2', 'text/html', 'utf-8', 'base64', 300, None),
+            ('2', 'application/pdf', None, 'base64', 5000, 'attachment'),
+            ('3', 'message/rfc822', None, '7bit', 800, 'inline'),
+        ])
+
+    def test_text_part(self):
+        stats = Counter()
+        self.assertEqual(parse_text_part(b'caf=C3=A9 =\r\nau lait', 'quoted-printable', 'utf-8', stats=stats),
+                         'café au lait')
+        # a part cut by a partial fetch ends inside a base64 group and a character
+        self.assertEqual(parse_text_part(b'Y2Fmw6kgYXUgbGFpdA==', 'base64', 'utf-8')[:4], 'café')
+        self.assertEqual(parse_text_part(b'Y2Fmw6k', 'base64', 'utf-8', truncated=True, stats=stats), 'caf')
+        self.assertEqual(stats, Counter({'bodies_truncated': 1}))
+
+
+class EncodedHeaderTest(unittest.TestCase):
+    def test_encoded_words(self):
+        self.assertEqual(parse_subject('=?utf-8?q?Caf=C3=A9_au_lait?='), 'Café au lait')
+        self.assertEqual(parse_subject('=?iso-8859-1?b?Q2Fm6Q==?= au lait'), 'Café au lait')
+        self.assertEqual(parse_subject('plain subject'), 'plain subject')
+        self.assertIsNone(parse_subject(None))
+
+    def test_unknown_charset(self):
+        # falls back to config.body_charsets
+        self.assertEqual(parse_subject('=?x-unknown?q?invoice?='), 'invoice')
+
+    def test_encoded_addresses(self):
+        raw = (b'From: =?utf-8?q?J=C3=BCrgen_M=C3=BCller?= <juergen@example.com>\r\n'
+               b'To: =?iso-8859-1?q?Fran=E7ois?= <francois@example.org>, other@example.net\r\n'
+               b'Cc: =?utf-8?b?w4lsb2RpZQ==?= <elodie@example.com>\r\n'
+               b'Subject: =?utf-8?b?UsOpdW5pb24=?=\r\n'
+               b'Date: Mon, 02 Mar 2020 10:00:00 +0000\r\n'
+               b'\r\n'
+               b'body\r\n')
+        record = parse_message(raw, uid=1)
+        self.assertEqual(record.sender, 'juergen@example.com')
+        self.assertEqual(record.recievers, ['francois@example.org', 'other@example.net'])
+        self.assertEqual(record.cc, ['elodie@example.com'])
+        self.assertIsNone(record.bcc)
+        self.assertEqual(record.subject, 'Réunion')
+        self.assertEqual(record.timestamp, 1583143200)
+
+
+class MboxTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sent.mbox')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def message(self, i, body):
+        message = EmailMessage()
+        message['From'] = "owner@example.com"
+        message['To'] = f"contact{i}@example.com"
+        message['Subject'] = f"message {i}"
+        message['Date'] = f"Tue, {10 + i:02d} Mar 2020 10:00:00 +0000"
+        message.set_content(body)
+        return message
+
+    def parse(self, spans):
+        uids = list(range(1, len(spans) + 1))
+        _, message_fields, stats, _, _, _ = parse_batch((uids, spans, True))
+        return message_fields, stats
+
+    def test_escaped_from_lines(self):
+        bodies = ["no separators here\n",
+                  "forwarded:\nFrom the archive\nsaid From me\n",
+                  "From the top\n\nFrom the bottom\n"]
+        messages = [self.message(i, body) for i, body in enumerate(bodies)]
+        box = mailbox.mbox(self.path)
+        for message in messages:
+            box.add(message)
+        box.close()
+        spans = find_mbox_messages(self.path)
+        self.assertEqual(len(spans), 3)
+        with open(self.path, 'rb') as file:
+            content = file.read()
+        for _, offset, length in spans:
+            # spans start after the separator line and end before the blank line that precedes the next one
+            self.assertEqual(content[offset - 1:offset], b'\n')
+            self.assertTrue(content[offset:].startswith(b'From: '))
+            self.assertNotEqual(content[offset + length - 2:offset + length], b'\n\n')
+        self.assertEqual(message_sizes(spans), [len(message.as_bytes()) for message in messages])
+        message_fields, stats = self.parse(spans)
+        self.assertEqual([fields[7] for fields in message_fields], bodies)
+        self.assertEqual([fields[6] for fields in message_fields], ["message 0", "message 1", "message 2"])
+        self.assertEqual(stats, Counter())
+
+    def test_mboxrd_unescaping(self):
+        # one level of ">" is removed from ">From " lines, deeper quoting is kept
+        with open(self.path, 'wb') as file:
+            file.write(b'From owner@example.com Tue Mar 10 10:00:00 2020\n'
+                       b'From: owner@example.com\n'
+                       b'To: contact@example.com\n'
+                       b'Subject: quoting\n'
+                       b'Date: Tue, 10 Mar 2020 10:00:00 +0000\n'
+                       b'\n'
+                       b'>From here\n'
+                       b'>>From there\n'
+                       b'>not a separator\n'
+                       b'\n'
+                       b'From owner@example.com Wed Mar 11 10:00:00 2020\n'
+                       b'From: owner@example.com\n'
+                       b'To: contact@example.com\n'
+                       b'Subject: last\n'
+                       b'Date: Wed, 11 Mar 2020 10:00:00 +0000\n'
+                       b'\n'
+                       b'no blank line at the end')
+        spans = find_mbox_messages(self.path)
+        self.assertEqual(len(spans), 2)
+        message_fields, _ = self.parse(spans)
+        self.assertEqual(message_fields[0][7], "From here\n>From there\n>not a separator\n")
+        self.assertEqual(message_fields[1][7], "no blank line at the end")
+        self.assertEqual(message_sizes(spans)[0], spans[0][2] - 2)
+
+    def test_empty_and_missing_separator(self):
+        open(self.path, 'wb').close()
+        self.assertEqual(find_mbox_messages(self.path), [])
+        with open(self.path, 'wb') as file:
+            file.write(b'not an mbox\n')
+        self.assertEqual(find_mbox_messages(self.path), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
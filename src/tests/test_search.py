@@ -0,0 +1,180 @@
+import contextlib
+import io
+import mailbox
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from email.message import EmailMessage
+import config
+from connection_pool import MailServicePool
+from file_source import FileMailSource
+from mail_tool import MailTool
+from message_record import MessageRecord
+from search_query import search_criteria, quote, imap_date, message_matches
+from benchmarks.fake_imap_server import FakeImapServer
+from benchmarks.synthetic_mailbox import generate_messages
+
+
+def late_message():
+    message = EmailMessage()
+    message['From'] = "owner@example.com"
+    message['To'] = "contact@example.com"
+    message['Subject'] = "late"
+    message['Date'] = "Mon, 02 Mar 2020 23:30:00 -0800"
+    message.set_content("sent late in the evening")
+    return message.as_bytes()
+
+
+def escaped_message(i):
+    # bodies with "From " lines, which an mbox stores as ">From "
+    message = EmailMessage()
+    message['From'] = "owner@example.com"
+    message['To'] = "contact@example.com"
+    message['Subject'] = f"quoted {i}"
+    message['Date'] = f"Tue, {10 + i:02d} Mar 2020 10:00:00 +0000"
+    message.set_content("forwarded:\n" + "From the archive\n" * i)
+    return message.as_bytes()
+
+
+class SearchCriteriaTest(unittest.TestCase):
+    def test_period(self):
+        self.assertEqual(search_criteria(), ("ALL", None))
+        self.assertEqual(search_criteria(datetime(2020, 3, 1), datetime(2020, 4, 1)),
+                         ("SINCE 1-Mar-2020 BEFORE 1-Apr-2020", None))
+        self.assertEqual(search_criteria(datetime(2020, 12, 25), sent_date=True), ("SENTSINCE 25-Dec-2020", None))
+
+    def test_imap_date(self):
+        # English month names whatever the locale
+        self.assertEqual([imap_date(datetime(2020, month, 9)) for month in (1, 5, 12)],
+                         ["9-Jan-2020", "9-May-2020", "9-Dec-2020"])
+
+    def test_quote(self):
+        self.assertEqual(quote('say "hi"'), '"say \\"hi\\""')
+        self.assertEqual(quote('a\\b'), '"a\\\\b"')
+
+    def test_filters(self):
+        criteria, literal = search_criteria(filters={'to': ['@a.com', '@b.com', '@c.com'], 'from': 'owner',
+                                                     'larger': 500, 'smaller': 9000.5, 'flags': ['Seen', 'unflagged']})
+        self.assertEqual(criteria, 'LARGER 500 SMALLER 9000 SEEN UNFLAGGED FROM "owner" '
+                                   'OR TO "@a.com" OR TO "@b.com" TO "@c.com"')
+        self.assertIsNone(literal)
+
+    def test_literal_last(self):
+        criteria, literal = search_criteria(filters={'subject': ['café', 'tea'], 'to': '@a.com'})
+        self.assertEqual(criteria, 'TO "@a.com" OR SUBJECT "tea" SUBJECT')
+        self.assertEqual(literal, 'café'.encode('utf-8'))
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            search_criteria(filters={'subject': 'café', 'body': 'naïve'})
+        with self.assertRaises(ValueError):
+            search_criteria(filters={'attachment': 'pdf'})
+        with self.assertRaises(ValueError):
+            search_criteria(filters={'flags': ['important']})
+
+    def test_message_matches(self):
+        message = MessageRecord.from_addresses(1, 0, "owner@example.com", ["a@example.org"], ["b@example.net"],
+                                               None, "Invoice 42", "see attached")
+        self.assertTrue(message_matches(message, {'to': ['@example.com', '@EXAMPLE.org'], 'subject': 'invoice'}))
+        self.assertTrue(message_matches(message, {'text': 'b@example.net'}))
+        self.assertFalse(message_matches(message, {'bcc': 'a@example.org'}))
+        self.assertFalse(message_matches(message, {'body': 'invoice'}))
+
+
+@unittest.skipUnless(hasattr(time, 'tzset'), "needs time.tzset to count in UTC")
+class ServerSideCountsTest(unittest.TestCase):
+    # the client counts by local time, set to UTC here, the server by the sender's calendar date:
+    # they agree for messages dated in UTC and differ for the late message of another time zone
+    @classmethod
+    def setUpClass(cls):
+        cls.saved_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'UTC'
+        time.tzset()
+        sent = generate_messages(400, start=datetime(2020, 1, 1), days=120) + [late_message()]
+        cls.servers = [FakeImapServer({config.sent_folder: sent, config.recieved_folder: []}, esearch=esearch)
+                       for esearch in (False, True)]
+        cls.addresses = [server.start() for server in cls.servers]
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.stop()
+        if cls.saved_tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = cls.saved_tz
+        time.tzset()
+
+    def count(self, address, period_start, period_end, bucket, server_side):
+        tool = MailTool(cache_path='')
+        with contextlib.redirect_stdout(io.StringIO()):
+            tool.connect("owner@example.com", "password", address[0], address[1], use_ssl=False)
+            try:
+                counts = tool.count_sent_messages(period_start, period_end, bucket, server_side=server_side)
+            finally:
+                tool.disconnect()
+        return counts, tool.progress.stage
+
+    def test_server_counts_match_client_counts(self):
+        for address in self.addresses:
+            for bucket in ('day', 'week', 'month'):
+                with self.subTest(address=address, bucket=bucket):
+                    period = (datetime(2020, 1, 1), datetime(2020, 3, 1))
+                    server_counts, stage = self.count(address, *period, bucket, server_side=True)
+                    client_counts, client_stage = self.count(address, *period, bucket, server_side=False)
+                    self.assertEqual(stage, "count on server")
+                    self.assertNotEqual(client_stage, "count on server")
+                    self.assertEqual(server_counts, client_counts)
+                    self.assertGreater(sum(server_counts.values()), 0)
+
+    def test_server_counts_by_sender_date(self):
+        period = (datetime(2020, 3, 2), datetime(2020, 3, 4))
+        server_counts, stage = self.count(self.addresses[0], *period, 'day', server_side=True)
+        client_counts, client_stage = self.count(self.addresses[0], *period, 'day', server_side=False)
+        self.assertEqual(server_counts['2020-03-02'] - client_counts['2020-03-02'], 1)
+        self.assertEqual(client_counts['2020-03-03'] - server_counts['2020-03-03'], 1)
+
+
+class SizeFilterTest(unittest.TestCase):
+    # LARGER and SMALLER on an mbox export select the messages the server selects for the same mailbox
+    @classmethod
+    def setUpClass(cls):
+        cls.messages = generate_messages(20, days=30) + [escaped_message(i) for i in range(1, 6)]
+        cls.directory = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.directory, 'sent.mbox')
+        export = mailbox.mbox(cls.path)
+        for message in cls.messages:
+            export.add(message)
+        export.close()
+        cls.server = FakeImapServer({'Sent': cls.messages})
+        address = cls.server.start()
+        cls.pool = MailServicePool(1)
+        cls.pool.connect(address[0], address[1], use_ssl=False)
+        cls.source = FileMailSource(folders={'Sent': cls.path}, workers=1)
+        cls.source.connect()
+        with contextlib.redirect_stdout(io.StringIO()):
+            cls.pool.authenticate("owner@example.com", "password")
+
+    @classmethod
+    def tearDownClass(cls):
+        with contextlib.redirect_stdout(io.StringIO()):
+            cls.pool.logout()
+        cls.source.logout()
+        cls.server.stop()
+        shutil.rmtree(cls.directory)
+
+    def test_sizes_match_server(self):
+        sizes = sorted({len(message) for message in self.messages})
+        for size in sizes[::3] + sizes[-5:]:
+            for filters in ({'larger': size}, {'smaller': size}, {'larger': size - 1, 'smaller': size + 1}):
+                with self.subTest(filters=filters):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        expected = self.pool.search_uids('Sent', filters=filters)
+                    self.assertEqual(self.source.search_uids('Sent', filters=filters), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import re
+from array import array
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+import numpy as np
+
+# numpy unit, multiplier and key format of every bucket unit
+bucket_units = {
+    'minute': ('m', 1, 'm'),
+    'hour': ('h', 1, 'h'),
+    'day': ('D', 1, 'D'),
+    'week': ('D', 7, 'D'),
+    'month': ('M', 1, 'M'),
+    'year': ('Y', 1, 'Y'),
+}
+unit_aliases = {'min': 'minute', 'h': 'hour', 'd': 'day', 'w': 'week', 'm': 'month', 'y': 'year'}
+bucket_pattern = re.compile(r'^\s*(\d*)\s*([a-zA-Z]+?)s?\s*$')
+
+
+class TimestampColumn:
+    # epoch seconds of every message, appended one at a time and binned in one go
+    def __init__(self):
+        self.__values = array('d')
+
+    def __len__(self):
+        return len(self.__values)
+
+    def append(self, timestamp):
+        self.__values.append(timestamp)
+
+    def extend(self, timestamps):
+        self.__values.extend(timestamps)
+
+    def to_numpy(self):
+        return np.frombuffer(self.__values, dtype=np.float64) if self.__values else np.empty(0)
+
+
+def parse_bucket(bucket):
+    match = bucket_pattern.match(bucket)
+    if not match:
+        raise ValueError(f"Invalid bucket size {bucket}")
+    count = int(match.group(1) or 1)
+    unit = match.group(2).lower()
+    unit = unit_aliases.get(unit, unit)
+    if unit not in bucket_units or count < 1:
+        raise ValueError(f"Invalid bucket size {bucket}")
+    return count, unit
+
+
+def get_timezone(tz):
+    if tz is None or not isinstance(tz, str):
+        return tz
+    return timezone.utc if tz.upper() == 'UTC' else ZoneInfo(tz)
+
+
+def bucket_edges(period_start, period_end, bucket='day', tz=None):
+    # local wall-clock bucket starts from period_start up to period_end, plus the end of the last bucket
+    count, unit = parse_bucket(bucket)
+    numpy_unit, multiplier, key_unit = bucket_units[unit]
+    step = np.timedelta64(count * multiplier, numpy_unit)
+    start = np.datetime64(period_start.replace(tzinfo=None), numpy_unit)
+    end = np.datetime64(period_end.replace(tzinfo=None), numpy_unit)
+    if end < np.datetime64(period_end.replace(tzinfo=None), 's'):
+        end += 1
+    edges = np.arange(start, end, step)
+    if len(edges) == 0:
+        edges = np.array([start])
+    return np.append(edges, edges[-1] + step), key_unit
+
+
+def local_to_epoch(local_times, tz=None):
+    # wall-clock datetime64 values in tz (system local time when None) to epoch seconds;
+    # offsets are looked up once per day, and once per hour on days with a DST change
+    seconds = local_times.astype('datetime64[s]')
+    tz = get_timezone(tz)
+    days, inverse = np.unique(seconds.astype('datetime64[D]'), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    day_offsets = np.array([utc_offset(day.astype('datetime64[s]').astype(datetime), tz) for day in np.append(days, days[-1] + 1)],
+                           dtype=np.int64)
+    offsets = day_offsets[:-1][inverse]
+    changing = np.flatnonzero(day_offsets[:-1] != day_offsets[1:])
+    if len(changing):
+        on_changing_day = np.isin(inverse, changing)
+        hours, hour_inverse = np.unique(seconds[on_changing_day].astype('datetime64[h]'), return_inverse=True)
+        hour_offsets = np.array([utc_offset(hour.astype(datetime), tz) for hour in hours], dtype=np.int64)
+        offsets[on_changing_day] = hour_offsets[hour_inverse.reshape(-1)]
+    return seconds.astype(np.int64) - offsets
+
+
+def utc_offset(local_time, tz):
+    if tz is None:
+        return int(local_time.astimezone().utcoffset().total_seconds())
+    return int(local_time.replace(tzinfo=tz).utcoffset().total_seconds())
+
+
+def count_by_bucket(timestamps, period_start, period_end, bucket='day', tz=None):
+    # returns {bucket key: message count} for every bucket of the period, empty buckets included
+    starts, counts, key_unit = bucket_counts(timestamps, period_start, period_end, bucket, tz)
+    return dict(zip(format_keys(starts, key_unit), counts.tolist()))
+
+
+def bucket_counts(timestamps, period_start, period_end, bucket='day', tz=None):
+    # columnar form of count_by_bucket: local bucket starts, counts and the unit keys are formatted with
+    edges, key_unit = bucket_edges(period_start, period_end, bucket, tz)
+    counts = bin_timestamps(np.asarray(timestamps, dtype=np.float64), local_to_epoch(edges, tz))
+    return edges[:-1], counts, key_unit
+
+
+def bin_timestamps(timestamps, epoch_edges):
+    num_buckets = len(epoch_edges) - 1
+    indexes = np.searchsorted(epoch_edges, timestamps, side='right') - 1
+    indexes = indexes[(indexes >= 0) & (indexes < num_buckets)]
+    return np.bincount(indexes, minlength=num_buckets)
+
+
+def weekday_hour_heatmap(timestamps, tz=None):
+    # 7 x 24 message counts, rows Monday..Sunday and columns hour of day in tz
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    heatmap = np.zeros((7, 24), dtype=np.int64)
+    if len(timestamps) == 0:
+        return heatmap
+    tz = get_timezone(tz)
+    first = datetime.fromtimestamp(timestamps.min(), tz).replace(tzinfo=None)
+    last = datetime.fromtimestamp(timestamps.max(), tz).replace(tzinfo=None)
+    edges = np.arange(np.datetime64(first, 'h') - 1, np.datetime64(last, 'h') + 2)
+    counts = bin_timestamps(timestamps, local_to_epoch(edges, tz))
+    days = edges[:-1].astype('datetime64[D]')
+    weekdays = (days.astype(np.int64) + 3) % 7
+    hours = (edges[:-1] - days).astype(np.int64)
+    np.add.at(heatmap, (weekdays, hours), counts)
+    return heatmap
+
+
+def format_keys(edges, key_unit):
+    keys = np.datetime_as_string(edges, unit=key_unit)
+    if key_unit in ('h', 'm'):
+        keys = np.char.replace(keys, 'T', ' ')
+    if key_unit == 'h':
+        keys = np.char.add(keys, ':00')
+    return keys.tolist()